@@ -2,8 +2,11 @@
 from anthill.common import admin as a
 from anthill.common import to_int
 
-from . model.content import ContentError, ContentNotFound
+from . model.content import ContentAdapter, ContentError, ContentNotFound
 from . model.promo import PromoError, PromoNotFound
+from . model.pools import ADMIN, BULK
+from . model.bulk import BulkJobsModel, BulkFilter, BulkJobError, BulkJobNotFound
+from . model.shards import ShardError
 
 import ujson
 import datetime
@@ -14,11 +17,18 @@ class RootAdminController(a.AdminController):
         return ["promo_admin"]
 
     def render(self, data):
+        links = [
+            a.link("contents", "Edit contents", icon="paper-plane"),
+            a.link("promos", "Edit promo codes", icon="gift"),
+            a.link("status", "Service status", icon="heartbeat"),
+            a.link("slow_queries", "Slow queries", icon="hourglass")
+        ]
+
+        if self.token.has_scope("promo_shards_admin"):
+            links.insert(3, a.link("shards", "Database shard", icon="database"))
+
         return [
-            a.links("Promo service", [
-                a.link("contents", "Edit contents", icon="paper-plane"),
-                a.link("promos", "Edit promo codes", icon="gift")
-            ])
+            a.links("Promo service", links)
         ]
 
 
@@ -41,7 +51,7 @@ class ContentsController(a.AdminController):
 
     async def get(self):
         contents = self.application.contents
-        items = await contents.list_contents(self.gamespace)
+        items = await contents.list_contents(self.gamespace, columns=ContentAdapter.NAME_COLUMNS)
 
         result = {
             "items": items
@@ -177,7 +187,9 @@ class PromosController(a.AdminController):
             a.links("Navigate", [
                 a.link("index", "Go back", icon="chevron-left"),
                 a.link("new_promo", "Create a new promo code", icon="plus"),
-                a.link("new_promos", "Create multiple promo codes", icon="plus-square")
+                a.link("new_promos", "Create multiple promo codes", icon="plus-square"),
+                a.link("pools", "Code pools", icon="archive"),
+                a.link("bulk_jobs", "Bulk operations", icon="tasks")
             ])
         ]
 
@@ -190,7 +202,7 @@ class PromosController(a.AdminController):
             raise a.ActionError(e.message)
 
         try:
-            promo = await promos.find_promo(self.gamespace, code)
+            promo = await promos.find_promo(self.gamespace, code, workload=ADMIN, columns=[])
         except PromoNotFound:
             raise a.ActionError("No such promo code")
 
@@ -211,7 +223,9 @@ class NewPromoController(a.AdminController):
                 "promo_amount": a.field("Promo uses amount", "text", "primary", "number"),
                 "promo_expires": a.field("Expire date", "date", "primary", "non-empty"),
                 "promo_contents": a.field("Promo items", "kv", "primary", "non-empty",
-                                          values=data["content_items"])
+                                          values=data["content_items"]),
+                "promo_bitmap": a.field("High-volume code (keep the accounts used it in a compressed bitmap)",
+                                        "switch", "primary")
             }, methods={
                 "create": a.method("Create", "primary")
             }, data=data),
@@ -225,17 +239,18 @@ class NewPromoController(a.AdminController):
         contents = self.application.contents
         content_items = {
             item.content_id: item.name
-            for item in (await contents.list_contents(self.gamespace))
+            for item in (await contents.list_contents(self.gamespace, columns=ContentAdapter.NAME_COLUMNS))
         }
 
         return {
             "promo_key": "<random>",
             "promo_amount": "1",
             "content_items": content_items,
-            "promo_expires": str(datetime.datetime.now() + datetime.timedelta(days=30))
+            "promo_expires": str(datetime.datetime.now() + datetime.timedelta(days=30)),
+            "promo_bitmap": "false"
         }
 
-    async def create(self, promo_key, promo_amount, promo_expires, promo_contents):
+    async def create(self, promo_key, promo_amount, promo_expires, promo_contents, promo_bitmap="false"):
         promos = self.application.promos
 
         try:
@@ -252,7 +267,8 @@ class NewPromoController(a.AdminController):
             raise a.ActionError(e.message)
 
         try:
-            promo_id = await promos.new_promo(self.gamespace, promo_key, promo_amount, promo_expires, promo_contents)
+            promo_id = await promos.new_promo(self.gamespace, promo_key, promo_amount, promo_expires, promo_contents,
+                                              workload=ADMIN, bitmap=promo_bitmap == "true")
         except ContentError as e:
             raise a.ActionError("Failed to create new promo: " + e.args[0])
 
@@ -301,7 +317,7 @@ class NewPromosController(a.AdminController):
         contents = self.application.contents
         content_items = {
             item.content_id: item.name
-            for item in (await contents.list_contents(self.gamespace))
+            for item in (await contents.list_contents(self.gamespace, columns=ContentAdapter.NAME_COLUMNS))
         }
 
         return {
@@ -332,7 +348,8 @@ class NewPromosController(a.AdminController):
                 raise a.ActionError(e.message)
 
             try:
-                await promos.new_promo(self.gamespace, promo_key, promo_amount, promo_expires, promo_contents)
+                await promos.new_promo(self.gamespace, promo_key, promo_amount, promo_expires, promo_contents,
+                                       workload=BULK)
             except ContentError:
                 continue
             else:
@@ -344,10 +361,22 @@ class NewPromosController(a.AdminController):
 
 
 class PromoController(a.AdminController):
+    # amount of accounts listed on the page
+    USAGES_LIMIT = 100
+
     def access_scopes(self):
         return ["promo_admin"]
 
     def render(self, data):
+        methods = {
+            "update": a.method("Update", "primary"),
+            "delete": a.method("Delete this promo code", "danger")
+        }
+
+        if not data["promo_bitmap"]:
+            methods["convert"] = a.method("Keep the accounts used it in a compressed bitmap (high-volume code)",
+                                          "primary")
+
         return [
             a.breadcrumbs([
                 a.link("promos", "Promo codes")
@@ -357,12 +386,10 @@ class PromoController(a.AdminController):
                 "promo_amount": a.field("Usage amount left", "text", "primary", "number"),
                 "promo_expires": a.field("Expire date", "date", "primary", "non-empty"),
                 "promo_contents": a.field("Promo items", "kv", "primary", "non-empty",
-                                          values=data["content_items"])
-            }, methods={
-                "update": a.method("Update", "primary"),
-                "delete": a.method("Delete this promo code", "danger")
-            }, data=data),
-            a.links("Accounts used this promo code", [a.link(
+                                          values=data["content_items"]),
+                "promo_used": a.field("Accounts used this promo code", "readonly", "primary")
+            }, methods=methods, data=data),
+            a.links("Accounts used this promo code (first {0})".format(PromoController.USAGES_LIMIT), [a.link(
                 "/profile/profile", "@" + account, account=account) for account in data["usages"]]),
             a.links("Navigate", [
                 a.link("contents", "Go back", icon="chevron-left")
@@ -375,7 +402,7 @@ class PromoController(a.AdminController):
         contents = self.application.contents
         content_items = {
             item.content_id: item.name
-            for item in (await contents.list_contents(self.gamespace))
+            for item in (await contents.list_contents(self.gamespace, columns=ContentAdapter.NAME_COLUMNS))
         }
 
         try:
@@ -384,7 +411,8 @@ class PromoController(a.AdminController):
             raise a.ActionError("No such promo code")
 
         try:
-            usages = await promos.get_promo_usages(self.gamespace, promo_id)
+            usages = await promos.get_promo_usages(self.gamespace, promo_id, limit=PromoController.USAGES_LIMIT)
+            used = await promos.count_promo_usages(self.gamespace, promo_id)
         except PromoError as e:
             raise a.ActionError(e.message)
 
@@ -394,12 +422,14 @@ class PromoController(a.AdminController):
             "promo_contents": promo.contents,
             "content_items": content_items,
             "promo_expires": str(promo.expires),
+            "promo_bitmap": promo.bitmap,
+            "promo_used": str(used),
             "usages": usages
         }
 
         return result
 
-    async def update(self, promo_code, promo_amount, promo_expires, promo_contents):
+    async def update(self, promo_code, promo_amount, promo_expires, promo_contents, **ignored):
 
         promo_id = self.context.get("promo_id")
 
@@ -430,3 +460,533 @@ class PromoController(a.AdminController):
             raise a.ActionError("Failed to delete promo: " + e.args[0])
 
         raise a.Redirect("promos", message="Promo code has been deleted")
+
+    # noinspection PyUnusedLocal
+    async def convert(self, **ignored):
+
+        promo_id = self.context.get("promo_id")
+        promos = self.application.promos
+
+        try:
+            await promos.convert_promo_usages(self.gamespace, promo_id)
+        except PromoError as e:
+            raise a.ActionError("Failed to convert promo code usages: " + e.message)
+        except PromoNotFound:
+            raise a.ActionError("No such promo code")
+
+        raise a.Redirect("promo", message="Promo code usages are kept in a bitmap now", promo_id=promo_id)
+
+
+class PoolsController(a.AdminController):
+    def access_scopes(self):
+        return ["promo_admin"]
+
+    def render(self, data):
+        return [
+            a.breadcrumbs([
+                a.link("promos", "Promo codes")
+            ], "Code pools"),
+            a.links("Pools", [
+                a.link("pool", pool.name, icon="archive", pool_id=pool.pool_id)
+                for pool in data["pools"]
+            ]),
+            a.links("Navigate", [
+                a.link("promos", "Go back", icon="chevron-left"),
+                a.link("new_pool", "Create a new pool", icon="plus")
+            ])
+        ]
+
+    async def get(self):
+        promos = self.application.promos
+
+        try:
+            pools = await promos.list_pools(self.gamespace)
+        except PromoError as e:
+            raise a.ActionError(e.message)
+
+        return {
+            "pools": pools
+        }
+
+
+class NewPoolController(a.AdminController):
+    def access_scopes(self):
+        return ["promo_admin"]
+
+    def render(self, data):
+        return [
+            a.breadcrumbs([
+                a.link("promos", "Promo codes"),
+                a.link("pools", "Code pools")
+            ], "New pool"),
+            a.form("New code pool", fields={
+                "pool_name": a.field("Pool unique name (used by the players to claim a code)", "text",
+                                     "primary", "non-empty")
+            }, methods={
+                "create": a.method("Create", "primary")
+            }, data=data),
+            a.links("Navigate", [
+                a.link("pools", "Go back", icon="chevron-left")
+            ])
+        ]
+
+    async def create(self, pool_name):
+        promos = self.application.promos
+
+        try:
+            pool_id = await promos.new_pool(self.gamespace, pool_name)
+        except PromoError as e:
+            raise a.ActionError("Failed to create new pool: " + e.message)
+
+        raise a.Redirect("pool", message="Pool has been created", pool_id=pool_id)
+
+
+class PoolController(a.AdminController):
+    def access_scopes(self):
+        return ["promo_admin"]
+
+    def render(self, data):
+        return [
+            a.breadcrumbs([
+                a.link("promos", "Promo codes"),
+                a.link("pools", "Code pools")
+            ], "Pool '{0}'".format(data["pool_name"])),
+            a.form("Pool '{0}'".format(data["pool_name"]), fields={
+                "pool_claimed": a.field("Codes claimed", "readonly", "primary"),
+                "pool_total": a.field("Codes total", "readonly", "primary")
+            }, methods={
+                "delete": a.method("Delete this pool", "danger")
+            }, data=data),
+            a.form("Add codes to the pool", fields={
+                "promo_keys": a.field("Number of single-use codes to generate", "text", "primary", "number"),
+                "promo_expires": a.field("Expire date", "date", "primary", "non-empty"),
+                "promo_contents": a.field("Promo items", "kv", "primary", "non-empty",
+                                          values=data["content_items"])
+            }, methods={
+                "fill": a.method("Generate", "primary")
+            }, data=data),
+            a.links("Navigate", [
+                a.link("pools", "Go back", icon="chevron-left")
+            ])
+        ]
+
+    async def get(self, pool_id):
+        promos = self.application.promos
+        contents = self.application.contents
+
+        try:
+            pool = await promos.get_pool(self.gamespace, pool_id)
+        except PromoNotFound:
+            raise a.ActionError("No such pool")
+        except PromoError as e:
+            raise a.ActionError(e.message)
+
+        content_items = {
+            item.content_id: item.name
+            for item in (await contents.list_contents(self.gamespace, columns=ContentAdapter.NAME_COLUMNS))
+        }
+
+        return {
+            "pool_name": pool.name,
+            "pool_claimed": str(pool.claimed),
+            "pool_total": str(pool.total),
+            "promo_keys": "100",
+            "content_items": content_items,
+            "promo_expires": str(datetime.datetime.now() + datetime.timedelta(days=30))
+        }
+
+    async def fill(self, promo_keys, promo_expires, promo_contents):
+        pool_id = self.context.get("pool_id")
+        bulk = self.application.bulk
+
+        try:
+            promo_contents = ujson.loads(promo_contents)
+        except (KeyError, ValueError):
+            raise a.ActionError("Corrupted JSON")
+
+        try:
+            job_id = await bulk.fill_pool(self.gamespace, pool_id, to_int(promo_keys), promo_expires,
+                                          promo_contents)
+        except BulkJobError as e:
+            raise a.ActionError("Failed to fill the pool: " + e.args[0])
+
+        raise a.Redirect("bulk_job", message="The codes are being generated", job_id=job_id)
+
+    # noinspection PyUnusedLocal
+    async def delete(self, **ignored):
+        pool_id = self.context.get("pool_id")
+        promos = self.application.promos
+
+        try:
+            await promos.delete_pool(self.gamespace, pool_id)
+        except PromoError as e:
+            raise a.ActionError("Failed to delete the pool: " + e.message)
+
+        raise a.Redirect("pools", message="Pool has been deleted")
+
+
+class BulkJobsController(a.AdminController):
+    def access_scopes(self):
+        return ["promo_admin"]
+
+    def render(self, data):
+        return [
+            a.breadcrumbs([
+                a.link("promos", "Promo codes")
+            ], "Bulk operations"),
+            a.content("Recent jobs", [
+                {"id": "job", "title": "Job"},
+                {"id": "action", "title": "Action"},
+                {"id": "status", "title": "Status"},
+                {"id": "progress", "title": "Progress"},
+                {"id": "updated", "title": "Updated"}
+            ], [
+                {
+                    "job": [a.link("bulk_job", job.job_id, icon="tasks", job_id=job.job_id)],
+                    "action": job.action,
+                    "status": job.status,
+                    "progress": "{0} / {1}".format(job.processed, job.total),
+                    "updated": str(job.updated)
+                }
+                for job in data["jobs"]
+            ], "default"),
+            a.form("New bulk operation", fields={
+                "action": a.field("Action", "select", "primary", "non-empty", values={
+                    BulkJobsModel.ACTION_EXPIRE: "Expire the codes now",
+                    BulkJobsModel.ACTION_EXTEND: "Change expire date of the codes",
+                    BulkJobsModel.ACTION_DELETE: "Delete the codes along with their usages"
+                }, order=1),
+                "key_prefix": a.field("Filter: promo code key starts with", "text", "primary", order=2),
+                "expires_from": a.field("Filter: expires at or after (YYYY-MM-DD HH:MM:SS)", "text", "primary",
+                                        order=3),
+                "expires_to": a.field("Filter: expires before (YYYY-MM-DD HH:MM:SS)", "text", "primary", order=4),
+                "content_id": a.field("Filter: rewards with content", "select", "primary",
+                                      values=data["content_items"], order=5),
+                "expires": a.field("New expire date (for changing expire date only)", "date", "primary", order=6)
+            }, methods={
+                "start": a.method("Start", "danger")
+            }, data=data),
+            a.links("Navigate", [
+                a.link("promos", "Go back", icon="chevron-left")
+            ])
+        ]
+
+    async def get(self):
+        contents = self.application.contents
+        bulk = self.application.bulk
+
+        content_items = {"": "Any"}
+        content_items.update({
+            item.content_id: item.name
+            for item in (await contents.list_contents(self.gamespace, columns=ContentAdapter.NAME_COLUMNS))
+        })
+
+        try:
+            jobs = await bulk.list_jobs(self.gamespace)
+        except BulkJobError as e:
+            raise a.ActionError(e.args[0])
+
+        return {
+            "jobs": jobs,
+            "action": BulkJobsModel.ACTION_EXPIRE,
+            "content_items": content_items,
+            "content_id": "",
+            "expires": str(datetime.datetime.now() + datetime.timedelta(days=30))
+        }
+
+    async def start(self, action, key_prefix="", expires_from="", expires_to="", content_id="", expires=""):
+        bulk = self.application.bulk
+
+        code_filter = BulkFilter(
+            key_prefix=key_prefix,
+            expires_from=expires_from,
+            expires_to=expires_to,
+            content_id=content_id)
+
+        try:
+            job_id = await bulk.new_job(self.gamespace, action, code_filter, {"expires": expires})
+        except BulkJobError as e:
+            raise a.ActionError("Failed to start a bulk job: " + e.args[0])
+
+        raise a.Redirect("bulk_job", message="Bulk job has been started", job_id=job_id)
+
+
+class BulkJobController(a.AdminController):
+    def access_scopes(self):
+        return ["promo_admin"]
+
+    def render(self, data):
+        job = data["job"]
+
+        methods = {}
+
+        if job.status == BulkJobsModel.STATUS_RUNNING:
+            methods["cancel"] = a.method("Cancel", "danger")
+        elif job.status in BulkJobsModel.RESUMABLE:
+            methods["resume"] = a.method("Resume", "primary")
+
+        return [
+            a.breadcrumbs([
+                a.link("promos", "Promo codes"),
+                a.link("bulk_jobs", "Bulk operations")
+            ], "Job " + job.job_id),
+            a.form("Job " + job.job_id, fields={
+                "action": a.field("Action", "readonly", "primary", order=1),
+                "filter": a.field("Filter", "json", "primary", order=2),
+                "status": a.field("Status", "readonly", "primary", order=3),
+                "progress": a.field("Progress", "readonly", "primary", order=4),
+                "error": a.field("Last error", "readonly", "danger", order=5)
+            }, methods=methods, data={
+                "action": job.action,
+                "filter": job.filter.dump(),
+                "status": job.status,
+                "progress": "{0}% ({1} of {2} codes)".format(job.progress(), job.processed, job.total),
+                "error": job.error
+            }),
+            a.links("Navigate", [
+                a.link("bulk_job", "Refresh", icon="refresh", job_id=job.job_id),
+                a.link("bulk_jobs", "Go back", icon="chevron-left")
+            ])
+        ]
+
+    async def get(self, job_id):
+        bulk = self.application.bulk
+
+        try:
+            job = await bulk.get_job(self.gamespace, job_id)
+        except BulkJobNotFound:
+            raise a.ActionError("No such job")
+        except BulkJobError as e:
+            raise a.ActionError(e.args[0])
+
+        return {
+            "job": job
+        }
+
+    # noinspection PyUnusedLocal
+    async def cancel(self, **ignored):
+        job_id = self.context.get("job_id")
+        bulk = self.application.bulk
+
+        try:
+            await bulk.cancel_job(self.gamespace, job_id)
+        except BulkJobError as e:
+            raise a.ActionError("Failed to cancel the job: " + e.args[0])
+
+        raise a.Redirect("bulk_job", message="Job has been cancelled", job_id=job_id)
+
+    # noinspection PyUnusedLocal
+    async def resume(self, **ignored):
+        job_id = self.context.get("job_id")
+        bulk = self.application.bulk
+
+        try:
+            await bulk.resume_job(self.gamespace, job_id)
+        except BulkJobNotFound:
+            raise a.ActionError("No such job")
+        except BulkJobError as e:
+            raise a.ActionError("Failed to resume the job: " + e.args[0])
+
+        raise a.Redirect("bulk_job", message="Job has been resumed", job_id=job_id)
+
+
+class StatusController(a.AdminController):
+    def access_scopes(self):
+        return ["promo_admin"]
+
+    def render(self, data):
+        return [
+            a.breadcrumbs([], "Service status"),
+            a.content("Redemption admission control", [
+                {"id": "name", "title": "Name"},
+                {"id": "value", "title": "Value"}
+            ], [
+                {"name": name, "value": str(value)}
+                for name, value in data["admission"].items()
+            ], "default"),
+            a.content("Redemption slots of this gamespace", [
+                {"id": "gamespace", "title": "Gamespace"},
+                {"id": "weight", "title": "Weight"},
+                {"id": "in_flight", "title": "In progress"},
+                {"id": "queued", "title": "Waiting"},
+                {"id": "admitted", "title": "Admitted"},
+                {"id": "rejected", "title": "Rejected"},
+                {"id": "wait_average", "title": "Average wait (ms)"},
+                {"id": "wait_max", "title": "Max wait (ms)"}
+            ], [
+                {
+                    "gamespace": tenant.gamespace_id,
+                    "weight": str(tenant.weight),
+                    "in_flight": str(tenant.in_flight),
+                    "queued": str(len(tenant.queue)),
+                    "admitted": str(tenant.admitted),
+                    "rejected": str(tenant.shed + tenant.timed_out),
+                    "wait_average": "{0:.1f}".format(tenant.wait_average() * 1000),
+                    "wait_max": "{0:.1f}".format(tenant.waited_max * 1000)
+                }
+                for tenant in data["tenants"]
+            ], "default"),
+            a.content("Most contended promo codes (retries after deadlocks or lock wait timeouts)", [
+                {"id": "key", "title": "Promo code"},
+                {"id": "retries", "title": "Retries"}
+            ], [
+                {"key": key, "retries": str(retries)}
+                for key, retries in data["contention"]
+            ], "default"),
+            a.links("Navigate", [
+                a.link("status", "Refresh", icon="refresh"),
+                a.link("index", "Go back", icon="chevron-left")
+            ])
+        ]
+
+    async def get(self):
+        admission = self.application.admission
+        stats = admission.stats()
+        tenant = admission.tenant_stats(self.gamespace)
+
+        return {
+            "admission": {
+                "Redemptions in progress": "{0} of {1}".format(stats.in_flight, admission.max_in_flight),
+                "Redemptions waiting": "{0} of {1}".format(stats.queued, admission.max_queue),
+                "Admitted since start": stats.admitted,
+                "Rejected (queue is full) since start": stats.shed,
+                "Rejected (timed out in queue) since start": stats.timed_out,
+                "Slots a single gamespace can take while others wait": admission.tenant_max_in_flight
+            },
+            "tenants": [tenant] if tenant is not None else [],
+            "contention": [
+                (promo_key, retries)
+                for (gamespace_id, promo_key), retries in self.application.promos.most_contended()
+                if gamespace_id == self.gamespace
+            ]
+        }
+
+
+class ShardsController(a.AdminController):
+    # moving gamespaces and reloading the shard map affect the whole service, not just one gamespace,
+    # so that takes a scope of its own, to be given to the operators of the service only
+    def access_scopes(self):
+        return ["promo_admin", "promo_shards_admin"]
+
+    def render(self, data):
+        result = [
+            a.breadcrumbs([], "Database shard"),
+            a.form("Database shard of this gamespace", fields={
+                "shard": a.field("Current shard", "readonly", "primary", order=1),
+                "target": a.field("Move the gamespace to shard", "select", "danger", "non-empty",
+                                  values=data["shards"], order=2)
+            }, methods={
+                "move": a.method("Move (the gamespace is unavailable while moving)", "danger", order=1),
+                "reload": a.method("Reload the shard map", "primary", order=2)
+            }, data=data)
+        ]
+
+        move = data["move"]
+
+        if move:
+            result.append(a.form("Last move", fields={
+                "direction": a.field("Move", "readonly", "primary", order=1),
+                "status": a.field("Status", "readonly", "primary", order=2),
+                "stage": a.field("Stage", "readonly", "primary", order=3),
+                "copied": a.field("Rows copied", "json", "primary", order=4),
+                "error": a.field("Error", "readonly", "danger", order=5)
+            }, methods={}, data={
+                "direction": "{0} -> {1}".format(move.source, move.target),
+                "status": move.status,
+                "stage": move.stage,
+                "copied": move.copied,
+                "error": move.error or ""
+            }))
+
+        result.append(a.links("Navigate", [
+            a.link("shards", "Refresh", icon="refresh"),
+            a.link("index", "Go back", icon="chevron-left")
+        ]))
+
+        return result
+
+    async def get(self):
+        shards = self.application.shards
+        shard = shards.shard_of(self.gamespace)
+
+        try:
+            move = await shards.get_move(self.gamespace)
+        except ShardError as e:
+            raise a.ActionError("Failed to get the last move: " + e.args[0])
+
+        return {
+            "shard": shard,
+            "target": shard,
+            "shards": {name: name for name in shards.list_shards()},
+            "move": move
+        }
+
+    async def move(self, target, **ignored):
+        shards = self.application.shards
+
+        try:
+            await shards.move(self.gamespace, target)
+        except ShardError as e:
+            raise a.ActionError("Failed to move the gamespace: " + e.args[0])
+
+        raise a.Redirect("shards", message="The gamespace is being moved")
+
+    # noinspection PyUnusedLocal
+    async def reload(self, **ignored):
+        shards = self.application.shards
+
+        try:
+            await shards.reload()
+        except ShardError as e:
+            raise a.ActionError("Failed to reload the shard map: " + e.args[0])
+
+        raise a.Redirect("shards", message="Shard map has been reloaded")
+
+
+class SlowQueriesController(a.AdminController):
+    def access_scopes(self):
+        return ["promo_admin"]
+
+    def render(self, data):
+        if not data["enabled"]:
+            return [
+                a.breadcrumbs([], "Slow queries"),
+                a.notice("Disabled", "Slow query log is disabled, enable it with slow_query_log option"),
+                a.links("Navigate", [
+                    a.link("index", "Go back", icon="chevron-left")
+                ])
+            ]
+
+        return [
+            a.breadcrumbs([], "Slow queries"),
+            a.content("Most recent slow queries of this gamespace", [
+                {"id": "time", "title": "Time"},
+                {"id": "duration", "title": "Duration, ms"},
+                {"id": "method", "title": "Method"},
+                {"id": "query", "title": "Query"},
+                {"id": "args", "title": "Parameters"},
+                {"id": "plan", "title": "Plan"}
+            ], [
+                {
+                    "time": str(query.time),
+                    "duration": "{0:.1f}".format(query.duration * 1000),
+                    "method": query.method,
+                    "query": query.query,
+                    "args": query.args,
+                    "plan": query.plan_summary() or query.error or ""
+                }
+                for query in data["queries"]
+            ], "default"),
+            a.links("Navigate", [
+                a.link("slow_queries", "Refresh", icon="refresh"),
+                a.link("index", "Go back", icon="chevron-left")
+            ])
+        ]
+
+    async def get(self):
+        slow_log = self.application.slow_log
+
+        return {
+            "enabled": slow_log is not None,
+            "queries": slow_log.recent(self.gamespace) if slow_log is not None else []
+        }
@@ -0,0 +1,322 @@
+import collections
+import asyncio
+import time
+
+
+class AdmissionRejected(Exception):
+    def __init__(self, message, retry_after):
+        self.message = message
+        self.retry_after = retry_after
+
+    def __str__(self):
+        return self.message
+
+
+class AdmissionStats(object):
+    def __init__(self, in_flight, queued, admitted, shed, timed_out):
+        self.in_flight = in_flight
+        self.queued = queued
+        self.admitted = admitted
+        self.shed = shed
+        self.timed_out = timed_out
+
+    def dump(self):
+        return {
+            "in_flight": self.in_flight,
+            "queued": self.queued,
+            "admitted": self.admitted,
+            "shed": self.shed,
+            "timed_out": self.timed_out
+        }
+
+
+class AdmissionTenant(object):
+    """
+    Admission state of a single gamespace
+    """
+
+    def __init__(self, gamespace_id, weight):
+        self.gamespace_id = gamespace_id
+        self.weight = weight
+
+        self.in_flight = 0
+        self.queue = collections.deque()
+
+        # virtual time the last admitted request of the tenant finishes at, see AdmissionControl
+        self.finish = 0.0
+        # time.monotonic() of the last request admitted or finished
+        self.active = time.monotonic()
+
+        # counters since the start of the service
+        self.admitted = 0
+        self.shed = 0
+        self.timed_out = 0
+        self.waited = 0.0
+        self.waited_max = 0.0
+
+    def idle(self):
+        return not self.in_flight and not self.queue
+
+    def wait_average(self):
+        if not self.admitted:
+            return 0.0
+        return self.waited / self.admitted
+
+    def dump(self):
+        return {
+            "gamespace": self.gamespace_id,
+            "weight": self.weight,
+            "in_flight": self.in_flight,
+            "queued": len(self.queue),
+            "admitted": self.admitted,
+            "shed": self.shed,
+            "timed_out": self.timed_out,
+            "wait_average": self.wait_average(),
+            "wait_max": self.waited_max
+        }
+
+
+class AdmissionSlot(object):
+    def __init__(self, control, tenant):
+        self.control = control
+        self.tenant = tenant
+
+    async def __aenter__(self):
+        await self.control.__acquire__(self.tenant)
+        return self
+
+    async def __aexit__(self, *exc_info):
+        del exc_info
+        self.control.__release__(self.tenant)
+
+
+class AdmissionControl(object):
+    """
+    Limits amount of requests being processed at the same time.
+
+    When every slot is busy, requests wait in a bounded queue for at most `queue_timeout` seconds.
+    Requests that do not fit into the queue, or do not get a slot in time, are rejected right away, so
+    when the database slows down the requests fail fast instead of piling up on the connection pool.
+
+    Slots are shared fairly between the gamespaces: while other gamespaces are waiting, a single gamespace
+    cannot take more than `max_share` of the slots (or of the queue), and freed slots are given to the waiting
+    gamespaces in order of weighted fair queuing (start-time fair queuing with a unit cost per request): every
+    gamespace has a virtual finish time that grows by 1/weight with every admitted request, and the waiting
+    gamespace with the smallest one goes next. A gamespace with weight 2 gets twice as many slots as a gamespace
+    with weight 1 when both wait. The limits are work-conserving: a gamespace alone can take every slot and the
+    whole queue, and when another one needs a place in a full queue, the newest waiter of the gamespace over its
+    share is rejected to make room.
+
+    Gamespaces idle for TENANT_IDLE_TIMEOUT are forgotten (along with their counters).
+
+    Usage:
+
+    admission = AdmissionControl(max_in_flight=32, max_queue=128, queue_timeout=1.0)
+
+    try:
+        async with admission.acquire(gamespace_id):
+            await do_the_work()
+    except AdmissionRejected as e:
+        reply_503(retry_after=e.retry_after)
+
+    """
+
+    # seconds a gamespace has to be idle to be forgotten, and how often to look for those
+    TENANT_IDLE_TIMEOUT = 600
+    PRUNE_INTERVAL = 60
+
+    def __init__(self, max_in_flight, max_queue, queue_timeout, retry_after=1, max_share=1.0, weights=None,
+                 on_wait=None):
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.retry_after = retry_after
+
+        # limits of a single gamespace
+        self.tenant_max_in_flight = max(1, int(max_in_flight * max_share))
+        self.tenant_max_queue = max(1, int(max_queue * max_share))
+
+        # str(gamespace_id) => weight, 1 if not listed
+        self.weights = weights or {}
+        # called as on_wait(gamespace_id, seconds) for every admitted request
+        self.on_wait = on_wait
+
+        self.in_flight = 0
+        self.queued = 0
+        self.virtual = 0.0
+
+        # str(gamespace_id) => AdmissionTenant
+        self.tenants = {}
+        # tenants with requests waiting
+        self.backlogged = set()
+        self.pruned = time.monotonic()
+
+        # counters since the start of the service
+        self.admitted = 0
+        self.shed = 0
+        self.timed_out = 0
+
+    def acquire(self, gamespace_id):
+        return AdmissionSlot(self, self.__tenant__(gamespace_id))
+
+    def stats(self):
+        return AdmissionStats(self.in_flight, self.queued, self.admitted, self.shed, self.timed_out)
+
+    def tenant_stats(self, gamespace_id):
+        """
+        Returns the AdmissionTenant of a gamespace, or None if it has not been seen lately
+        """
+        return self.tenants.get(str(gamespace_id))
+
+    def __tenant__(self, gamespace_id):
+        key = str(gamespace_id)
+        tenant = self.tenants.get(key)
+
+        if tenant is None:
+            self.__prune__()
+            tenant = AdmissionTenant(key, self.weights.get(key, 1))
+            self.tenants[key] = tenant
+
+        return tenant
+
+    def __prune__(self):
+        now = time.monotonic()
+
+        if now - self.pruned < AdmissionControl.PRUNE_INTERVAL:
+            return
+
+        self.pruned = now
+
+        for key, tenant in list(self.tenants.items()):
+            if tenant.idle() and now - tenant.active > AdmissionControl.TENANT_IDLE_TIMEOUT:
+                del self.tenants[key]
+
+    def __contended__(self, tenant):
+        """
+        Whether other gamespaces are waiting, so the tenant is held to its share
+        """
+        return len(self.backlogged) > 1 or (len(self.backlogged) == 1 and tenant not in self.backlogged)
+
+    async def __acquire__(self, tenant):
+        if self.in_flight < self.max_in_flight and not tenant.queue and \
+                (tenant.in_flight < self.tenant_max_in_flight or not self.__contended__(tenant)):
+            self.__admit__(tenant, 0.0)
+            return
+
+        if len(tenant.queue) >= self.tenant_max_queue and self.__contended__(tenant):
+            self.__shed__(tenant)
+
+        if self.queued >= self.max_queue and not self.__evict__(tenant):
+            self.__shed__(tenant)
+
+        waiter = asyncio.get_event_loop().create_future()
+        enqueued = time.monotonic()
+
+        if not tenant.queue:
+            # a gamespace that has been idle does not get credit for the time it was not waiting
+            tenant.finish = max(tenant.finish, self.virtual)
+            self.backlogged.add(tenant)
+
+        tenant.queue.append((waiter, enqueued))
+        self.queued += 1
+
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), self.queue_timeout)
+        except asyncio.TimeoutError:
+            if waiter.done():
+                # the slot was handed over (or the place in the queue was taken away) right at the deadline
+                waiter.result()
+                return
+
+            self.__dequeue__(tenant, waiter)
+            self.timed_out += 1
+            tenant.timed_out += 1
+            raise AdmissionRejected("Service is overloaded, timed out waiting in queue", self.retry_after)
+        except asyncio.CancelledError:
+            if waiter.done() and waiter.exception() is None:
+                # got the slot but nobody is going to use it
+                self.__release__(tenant)
+            else:
+                self.__dequeue__(tenant, waiter)
+            raise
+
+    def __shed__(self, tenant):
+        self.shed += 1
+        tenant.shed += 1
+        raise AdmissionRejected("Service is overloaded", self.retry_after)
+
+    def __evict__(self, tenant):
+        """
+        Makes room in the full queue for a tenant within its share, by rejecting the newest waiter of the tenant
+        with the longest queue over the share. Returns False if there is none.
+        """
+
+        if len(tenant.queue) >= self.tenant_max_queue:
+            return False
+
+        over = [
+            candidate for candidate in self.backlogged
+            if candidate is not tenant and len(candidate.queue) > self.tenant_max_queue
+        ]
+
+        if not over:
+            return False
+
+        victim = max(over, key=lambda candidate: len(candidate.queue))
+        waiter, enqueued = victim.queue[-1]
+
+        self.__dequeue__(victim, waiter)
+        self.shed += 1
+        victim.shed += 1
+        waiter.set_exception(AdmissionRejected("Service is overloaded", self.retry_after))
+        return True
+
+    def __admit__(self, tenant, waited):
+        self.in_flight += 1
+        self.admitted += 1
+
+        tenant.in_flight += 1
+        tenant.admitted += 1
+        tenant.active = time.monotonic()
+        tenant.waited += waited
+        tenant.waited_max = max(tenant.waited_max, waited)
+
+        start = max(tenant.finish, self.virtual)
+        tenant.finish = start + 1.0 / tenant.weight
+
+        if self.on_wait:
+            self.on_wait(tenant.gamespace_id, waited)
+
+    def __dequeue__(self, tenant, waiter):
+        for item in tenant.queue:
+            if item[0] is waiter:
+                tenant.queue.remove(item)
+                self.queued -= 1
+                break
+
+        if not tenant.queue:
+            self.backlogged.discard(tenant)
+
+    def __release__(self, tenant):
+        self.in_flight -= 1
+        tenant.in_flight -= 1
+        tenant.active = time.monotonic()
+
+        # hand the free slots over to the waiters right away, so they cannot be taken by a newcomer
+        while self.in_flight < self.max_in_flight and self.backlogged:
+            # the ones within their share go first, but a free slot is never left unused
+            eligible = [
+                candidate for candidate in self.backlogged
+                if candidate.in_flight < self.tenant_max_in_flight
+            ] or list(self.backlogged)
+
+            tenant = min(eligible, key=lambda candidate: candidate.finish)
+            waiter, enqueued = tenant.queue.popleft()
+            self.queued -= 1
+
+            if not tenant.queue:
+                self.backlogged.discard(tenant)
+
+            self.virtual = max(self.virtual, tenant.finish)
+            self.__admit__(tenant, time.monotonic() - enqueued)
+            waiter.set_result(True)
@@ -0,0 +1,158 @@
+from tornado.ioloop import PeriodicCallback
+
+import collections
+import hashlib
+import logging
+import hmac
+import time
+import re
+
+
+SOURCE_HTTP = "h"
+SOURCE_INTERNAL = "i"
+
+
+class CapturedRequest(object):
+    """
+    A single recorded promo code redemption.
+    Account ids and promo code keys are replaced with salted hashes, so the log keeps the shape of the traffic
+    (the same account or the same code used again, a lot of different invalid keys) but not the actual values.
+    """
+
+    def __init__(self, time_, source, gamespace_id, account, key, status, latency):
+        self.time = time_
+        self.source = source
+        self.gamespace_id = gamespace_id
+        self.account = account
+        self.key = key
+        self.status = status
+        self.latency = latency
+
+    @staticmethod
+    def parse(line):
+        time_, source, gamespace_id, account, key, status, latency = line.rstrip("\n").split("\t")
+        return CapturedRequest(float(time_), source, int(gamespace_id), int(account), key, int(status),
+                               float(latency))
+
+    def dump(self):
+        return "{0:.3f}\t{1}\t{2}\t{3}\t{4}\t{5}\t{6:.1f}\n".format(
+            self.time, self.source, self.gamespace_id, self.account, self.key, self.status, self.latency)
+
+    def is_valid_key(self):
+        return self.key.startswith("K")
+
+
+class TrafficRecorder(object):
+    """
+    Records promo code redemptions into a compact tab-separated log, one request per line:
+
+    time  source  gamespace  account  key  status  latency (ms)
+
+    Lines are buffered in memory and appended to the file every `flush_interval` seconds, so the requests never
+    wait for the disk. If the buffer grows over `max_buffer` lines (the disk is too slow), the new ones are dropped.
+    With several worker processes, every worker writes its own file (the worker id is appended to the path), the
+    replay tool merges them back. The workers must share the salt for the merged log to make sense.
+
+    With a `sample_rate` below 1, a request is recorded depending on the hash of its key, so every request
+    for a recorded key is recorded, in every process, and the repeated uses of a code are kept.
+    """
+
+    KEY_PATTERN = re.compile("^[A-Z0-9]{4}-[A-Z0-9]{4}-[A-Z0-9]{4}$")
+
+    def __init__(self, path, salt, sample_rate=1.0, flush_interval=1.0, max_buffer=100000):
+        self.path = path
+        self.salt = salt.encode()
+        self.sample_rate = sample_rate
+        self.flush_interval = flush_interval
+        self.max_buffer = max_buffer
+
+        self.buffer = collections.deque()
+        self.dropped = 0
+        self.flusher = None
+
+    def start(self):
+        self.flusher = PeriodicCallback(self.flush, self.flush_interval * 1000)
+        self.flusher.start()
+
+    def stop(self):
+        if self.flusher:
+            self.flusher.stop()
+            self.flusher = None
+
+        self.flush()
+
+    def __digest__(self, value):
+        return hmac.new(self.salt, str(value).encode(), hashlib.sha1).hexdigest()
+
+    def sanitize_account(self, account_id):
+        return int(self.__digest__(account_id)[:7], 16)
+
+    def sanitize_key(self, promo_key):
+        """
+        Keys that look like promo codes are replaced with their hashes, the rest only keep their length
+        """
+
+        promo_key = promo_key.upper()
+
+        if TrafficRecorder.KEY_PATTERN.match(promo_key):
+            return "K" + self.__digest__(promo_key)[:12]
+
+        return "X" + str(len(promo_key))
+
+    def sampled(self, promo_key):
+        if self.sample_rate >= 1.0:
+            return True
+
+        return int(self.__digest__(promo_key.upper())[:8], 16) < self.sample_rate * 0x100000000
+
+    def record(self, source, started, gamespace_id, account_id, promo_key, status):
+        """
+        Records a request that has started at `started` (time.time()) and has just finished with `status`
+        """
+
+        if not self.sampled(promo_key):
+            return
+
+        if len(self.buffer) >= self.max_buffer:
+            self.dropped += 1
+            return
+
+        request = CapturedRequest(
+            started, source, gamespace_id, self.sanitize_account(account_id), self.sanitize_key(promo_key),
+            status, (time.time() - started) * 1000)
+
+        self.buffer.append(request.dump())
+
+    def flush(self):
+        if not self.buffer:
+            return
+
+        lines = self.buffer
+        self.buffer = collections.deque()
+
+        try:
+            with open(self.path, "a") as f:
+                f.writelines(lines)
+        except OSError as e:
+            logging.error("Failed to write captured traffic to '{0}': {1}".format(self.path, str(e)))
+
+        if self.dropped:
+            logging.warning("Dropped {0} captured requests, the log is written too slow".format(self.dropped))
+            self.dropped = 0
+
+
+def read_captured(paths):
+    """
+    Reads the captured requests from several files (like the ones of every worker), in order of time
+    """
+
+    requests = []
+
+    for path in paths:
+        with open(path) as f:
+            for line in f:
+                if line.strip():
+                    requests.append(CapturedRequest.parse(line))
+
+    requests.sort(key=lambda r: r.time)
+    return requests
@@ -5,24 +5,103 @@ from anthill.common.access import scoped, AccessToken
 from anthill.common.handler import AuthenticatedHandler
 from anthill.common.validate import validate
 from anthill.common.internal import InternalError
+from anthill.common import to_int, clamp
 
 from . model.promo import PromoNotFound, PromoError, PromoExists
+from . model.content import ContentAdapter
+from . model.pools import PLAYER
+from . admission import AdmissionRejected
+from . capture import SOURCE_HTTP, SOURCE_INTERNAL
+
+import time
 
 
 class UsePromoHandler(AuthenticatedHandler):
+    # seconds to tell the client to retry in, when the request is rejected by the admission control
+    retry_after = None
+
+    def write_error(self, status_code, **kwargs):
+        # send_error clears every header before it gets here, so this is the only place to set it
+        if self.retry_after is not None:
+            self.set_header("Retry-After", str(self.retry_after))
+
+        super(UsePromoHandler, self).write_error(status_code, **kwargs)
+
     @scoped(scopes=["promo"])
     async def post(self, promo_key):
         promos = self.application.promos
+        admission = self.application.admission
+        recorder = self.application.recorder
         gamespace_id = self.token.get(AccessToken.GAMESPACE)
 
+        started = time.time()
+        status = 500
+
         try:
-            promo_usage = await promos.use_promo(gamespace_id, self.token.account, promo_key)
+            async with admission.acquire(gamespace_id):
+                promo_usage = await promos.use_promo(gamespace_id, self.token.account, promo_key)
+        except AdmissionRejected as e:
+            status = 503
+            self.application.monitor_rate("redeem", "shed")
+            self.retry_after = e.retry_after
+            raise HTTPError(503, e.message)
         except PromoError as e:
+            status = e.code
             raise HTTPError(e.code, e.message)
         except PromoNotFound as e:
+            status = 404
             raise HTTPError(404, str(e))
         else:
-            self.dumps(promo_usage)
+            status = 200
+            # the payloads go into the response as they are stored
+            self.set_header("Content-Type", "application/json")
+            self.write(promo_usage.dumps())
+        finally:
+            if recorder:
+                recorder.record(SOURCE_HTTP, started, gamespace_id, self.token.account, promo_key, status)
+
+
+class ClaimPoolCodeHandler(AuthenticatedHandler):
+    @scoped(scopes=["promo"])
+    async def post(self, pool_name):
+        promos = self.application.promos
+        gamespace_id = self.token.get(AccessToken.GAMESPACE)
+
+        try:
+            code_key = await promos.claim_pool_code(gamespace_id, self.token.account, pool_name)
+        except PromoError as e:
+            raise HTTPError(e.code, e.message)
+        except PromoNotFound:
+            raise HTTPError(404, "No such pool")
+        else:
+            self.dumps({
+                "key": code_key
+            })
+
+
+class PromoHistoryHandler(AuthenticatedHandler):
+    @scoped(scopes=["promo"])
+    async def get(self):
+        promos = self.application.promos
+        gamespace_id = self.token.get(AccessToken.GAMESPACE)
+
+        limit = clamp(to_int(self.get_argument("limit", "50")), 1, 100)
+        before = to_int(self.get_argument("before", None))
+
+        try:
+            usages = await promos.get_account_usages(gamespace_id, self.token.account, limit, before)
+
+            # the codes that keep their usages in a bitmap cannot be paginated, so they all go with the first page
+            bitmap_usages = [] if before else await promos.get_account_bitmap_usages(
+                gamespace_id, self.token.account)
+        except PromoError as e:
+            raise HTTPError(e.code, e.message)
+
+        self.dumps({
+            "usages": [usage.dump() for usage in usages],
+            "bitmap_usages": [usage.dump() for usage in bitmap_usages],
+            "next": usages[-1].usage_id if len(usages) == limit else None
+        })
 
 
 class InternalHandler(object):
@@ -33,12 +112,17 @@ class InternalHandler(object):
     async def generate_code(self, gamespace, amount, expires, contents, codes_count=1):
 
         promos = self.application.promos
+        stock = self.application.stock
 
         contents = await promos.wrap_contents(gamespace, contents)
 
-        keys = []
+        try:
+            keys = await stock.take(gamespace, codes_count, amount, expires, contents)
+        except PromoError as e:
+            raise InternalError(e.code, e.message)
 
-        for i in range(0, codes_count):
+        # whatever the stock could not cover is generated one by one
+        for i in range(len(keys), codes_count):
             while True:
                 promo_key = promos.random()
 
@@ -59,22 +143,54 @@ class InternalHandler(object):
     @validate(gamespace="int", account="int", key="str")
     async def use_code(self, gamespace, account, key):
         promos = self.application.promos
+        admission = self.application.admission
+        recorder = self.application.recorder
+
+        started = time.time()
+        status = 500
 
         try:
-            promo_usage = await promos.use_promo(gamespace, account, key)
+            async with admission.acquire(gamespace):
+                promo_usage = await promos.use_promo(gamespace, account, key)
+        except AdmissionRejected as e:
+            status = 503
+            self.application.monitor_rate("redeem", "shed")
+            raise InternalError(503, e.message)
         except PromoError as e:
+            status = e.code
             raise InternalError(e.code, e.message)
         except PromoNotFound as e:
+            status = 404
             raise InternalError(404, str(e))
         else:
-            return promo_usage
+            status = 200
+            return promo_usage.dump()
+        finally:
+            if recorder:
+                recorder.record(SOURCE_INTERNAL, started, gamespace, account, key, status)
+
+    @validate(gamespace="int", account="int", pool="str")
+    async def claim_pool_code(self, gamespace, account, pool):
+        promos = self.application.promos
+
+        try:
+            code_key = await promos.claim_pool_code(gamespace, account, pool)
+        except PromoError as e:
+            raise InternalError(e.code, e.message)
+        except PromoNotFound:
+            raise InternalError(404, "No such pool")
+        else:
+            return {
+                "key": code_key
+            }
 
     @validate(gamespace="int")
     async def list_contents(self, gamespace):
         contents = self.application.contents
 
         try:
-            items = await contents.list_contents(gamespace)
+            items = await contents.list_contents(
+                gamespace, columns=ContentAdapter.NAME_COLUMNS, workload=PLAYER)
         except PromoError as e:
             raise InternalError(e.code, e.message)
         except PromoNotFound as e:
@@ -107,6 +223,45 @@ class InternalHandler(object):
                 }
             }
 
+    @validate(gamespace="int", account="int", limit="int", before="int")
+    async def get_account_history(self, gamespace, account, limit=50, before=0):
+        promos = self.application.promos
+
+        limit = clamp(limit, 1, 1000)
+
+        try:
+            usages = await promos.get_account_usages(gamespace, account, limit, before)
+            bitmap_usages = [] if before else await promos.get_account_bitmap_usages(gamespace, account)
+        except PromoError as e:
+            raise InternalError(e.code, e.message)
+        else:
+            return {
+                "usages": [usage.dump() for usage in usages],
+                "bitmap_usages": [usage.dump() for usage in bitmap_usages],
+                "next": usages[-1].usage_id if len(usages) == limit else None
+            }
+
+    @validate(gamespace="int", after="int", limit="int")
+    async def list_redemptions(self, gamespace, after=0, limit=100):
+        """
+        Returns the redemptions that come after the redemption `after`, in order. To follow the redemptions,
+        call it again passing the "next" value as `after`.
+        """
+
+        events = self.application.events
+
+        limit = clamp(limit, 1, 1000)
+
+        try:
+            items = await events.list_events(gamespace, after, limit)
+        except PromoError as e:
+            raise InternalError(e.code, e.message)
+        else:
+            return {
+                "events": [item.dump() for item in items],
+                "next": items[-1].event_id if items else str(after)
+            }
+
     @validate(gamespace="int", code_id="int")
     async def list_code_users(self, gamespace, code_id):
         promos = self.application.promos
@@ -0,0 +1,157 @@
+import array
+import bisect
+import sys
+
+
+class BitmapChunk(object):
+    """
+    A compressed set of 16-bit values, the way roaring bitmaps store every 2^16 range of values:
+    as a sorted array of values while there are few of them, and as a plain 8 KB bitmap once there are more
+    than ARRAY_LIMIT values (at which point the bitmap gets smaller than the array).
+
+    Serialized as a single type byte followed by the little-endian array, or by the bitmap.
+    """
+
+    ARRAY_LIMIT = 4096
+    BITMAP_SIZE = 8192
+
+    TYPE_ARRAY = b"A"
+    TYPE_BITMAP = b"B"
+
+    def __init__(self, values=None, bits=None, cardinality=0):
+        # exactly one of them is set
+        if bits is None:
+            self.values = values if values is not None else array.array("H")
+            self.bits = None
+            self.cardinality = len(self.values)
+        else:
+            self.values = None
+            self.bits = bits
+            self.cardinality = cardinality
+
+    @staticmethod
+    def load(data):
+        data = bytes(data)
+        kind, payload = data[0:1], data[1:]
+
+        if kind == BitmapChunk.TYPE_BITMAP:
+            bits = bytearray(payload)
+            cardinality = sum(bin(byte).count("1") for byte in bits if byte)
+            return BitmapChunk(bits=bits, cardinality=cardinality)
+
+        values = array.array("H")
+        values.frombytes(payload)
+
+        if sys.byteorder == "big":
+            values.byteswap()
+
+        return BitmapChunk(values=values)
+
+    def dump(self):
+        if self.bits is not None:
+            return BitmapChunk.TYPE_BITMAP + bytes(self.bits)
+
+        values = array.array("H", self.values)
+
+        if sys.byteorder == "big":
+            values.byteswap()
+
+        return BitmapChunk.TYPE_ARRAY + values.tobytes()
+
+    def __contains__(self, value):
+        if self.bits is not None:
+            return bool(self.bits[value >> 3] & (1 << (value & 7)))
+
+        i = bisect.bisect_left(self.values, value)
+        return i < len(self.values) and self.values[i] == value
+
+    def __iter__(self):
+        if self.bits is None:
+            return iter(self.values)
+
+        return (
+            (i << 3) + bit
+            for i, byte in enumerate(self.bits) if byte
+            for bit in range(0, 8) if byte & (1 << bit)
+        )
+
+    def add(self, value):
+        """
+        Adds a value, returns False if it's already there
+        """
+
+        if self.bits is not None:
+            mask = 1 << (value & 7)
+
+            if self.bits[value >> 3] & mask:
+                return False
+
+            self.bits[value >> 3] |= mask
+            self.cardinality += 1
+            return True
+
+        i = bisect.bisect_left(self.values, value)
+
+        if i < len(self.values) and self.values[i] == value:
+            return False
+
+        self.values.insert(i, value)
+        self.cardinality += 1
+
+        if self.cardinality > BitmapChunk.ARRAY_LIMIT:
+            self.__to_bitmap__()
+
+        return True
+
+    def remove(self, value):
+        """
+        Removes a value, returns False if it was not there
+        """
+
+        if self.bits is not None:
+            mask = 1 << (value & 7)
+
+            if not self.bits[value >> 3] & mask:
+                return False
+
+            self.bits[value >> 3] &= ~mask & 0xFF
+            self.cardinality -= 1
+
+            if self.cardinality <= BitmapChunk.ARRAY_LIMIT // 2:
+                # with some slack, so adding and removing the same value does not convert it back and forth
+                self.__to_array__()
+
+            return True
+
+        i = bisect.bisect_left(self.values, value)
+
+        if i >= len(self.values) or self.values[i] != value:
+            return False
+
+        del self.values[i]
+        self.cardinality -= 1
+        return True
+
+    def __to_bitmap__(self):
+        bits = bytearray(BitmapChunk.BITMAP_SIZE)
+
+        for value in self.values:
+            bits[value >> 3] |= 1 << (value & 7)
+
+        self.bits = bits
+        self.values = None
+
+    def __to_array__(self):
+        self.values = array.array("H", iter(self))
+        self.bits = None
+
+
+def split_id(value):
+    """
+    Splits a 32-bit id into (chunk id, 16-bit value within the chunk)
+    """
+    return value >> 16, value & 0xFFFF
+
+
+def join_id(chunk_id, value):
+    return (chunk_id << 16) | value
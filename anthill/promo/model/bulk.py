@@ -0,0 +1,590 @@
+from anthill.common.database import DatabaseError
+from anthill.common.model import Model
+
+from tornado.ioloop import IOLoop
+from tornado.gen import sleep
+
+from . pools import ADMIN, BULK
+from . schema import ensure_index, setup_tables
+from . promo import PromoError, PromoNotFound
+
+import datetime
+import logging
+import ujson
+
+
+class BulkJobError(Exception):
+    pass
+
+
+class BulkJobNotFound(Exception):
+    pass
+
+
+class BulkFilter(object):
+    """
+    A set of promo codes a bulk job is applied to. Every condition is optional, but at least one is required.
+    """
+
+    # formats the dates are accepted in, the admin date field sends the first one
+    TIME_FORMATS = ["%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M:%S.%f", "%Y-%m-%dT%H:%M:%S", "%Y-%m-%d %H:%M", "%Y-%m-%d"]
+
+    def __init__(self, key_prefix=None, expires_from=None, expires_to=None, content_id=None):
+        self.key_prefix = key_prefix or None
+        self.expires_from = expires_from or None
+        self.expires_to = expires_to or None
+        self.content_id = str(content_id) if content_id else None
+
+    @staticmethod
+    def load(data):
+        return BulkFilter(
+            key_prefix=data.get("key_prefix"),
+            expires_from=data.get("expires_from"),
+            expires_to=data.get("expires_to"),
+            content_id=data.get("content_id"))
+
+    def dump(self):
+        return {
+            "key_prefix": self.key_prefix,
+            "expires_from": self.expires_from,
+            "expires_to": self.expires_to,
+            "content_id": self.content_id
+        }
+
+    def is_empty(self):
+        return not (self.key_prefix or self.expires_from or self.expires_to or self.content_id)
+
+    @staticmethod
+    def parse_time(value):
+        """
+        Parses a date (with or without time), returns it formatted as YYYY-MM-DD HH:MM:SS.
+        Raises BulkJobError if it is not a date.
+        """
+
+        for time_format in BulkFilter.TIME_FORMATS:
+            try:
+                parsed = datetime.datetime.strptime(str(value).strip(), time_format)
+            except ValueError:
+                continue
+
+            return parsed.strftime("%Y-%m-%d %H:%M:%S")
+
+        raise BulkJobError("Not a valid date: '{0}'".format(value))
+
+    def validate(self):
+        """
+        Checks the conditions, and brings the dates to the same format
+        """
+
+        if self.is_empty():
+            raise BulkJobError("At least one filter condition is required")
+
+        if self.expires_from:
+            self.expires_from = BulkFilter.parse_time(self.expires_from)
+
+        if self.expires_to:
+            self.expires_to = BulkFilter.parse_time(self.expires_to)
+
+    def conditions(self):
+        """
+        Returns a tuple (SQL conditions, arguments) to be appended to a WHERE clause with AND
+        """
+
+        # keys reserved in the stock (see KeyStockModel) are not codes yet
+        conditions = ["`code_stocked`=0"]
+        args = []
+
+        if self.key_prefix:
+            prefix = self.key_prefix.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+            conditions.append("`code_key` LIKE %s")
+            args.append(prefix + "%")
+
+        if self.expires_from:
+            conditions.append("`code_expires` >= %s")
+            args.append(self.expires_from)
+
+        if self.expires_to:
+            conditions.append("`code_expires` < %s")
+            args.append(self.expires_to)
+
+        if self.content_id:
+            conditions.append("JSON_CONTAINS_PATH(`code_contents`, 'one', %s)")
+            args.append("$.\"{0}\"".format(self.content_id))
+
+        return " AND ".join(conditions), args
+
+
+class BulkJobAdapter(object):
+    def __init__(self, data):
+        self.job_id = str(data.get("job_id"))
+        self.action = data.get("job_action")
+        self.filter = BulkFilter.load(data.get("job_filter") or {})
+        self.args = data.get("job_args") or {}
+        self.status = data.get("job_status")
+        self.total = data.get("job_total")
+        self.processed = data.get("job_processed")
+        self.last_id = data.get("job_last_id")
+        self.created = data.get("job_created")
+        self.updated = data.get("job_updated")
+        self.error = data.get("job_error")
+
+    def progress(self):
+        if not self.total:
+            return 100
+        return min(100, int(self.processed * 100 / self.total))
+
+
+class BulkJobsModel(Model):
+    """
+    Runs filter-based operations on a large amount of promo codes in background.
+
+    Codes are processed in small chunks ordered by code_id, every chunk is committed separately (together with
+    the job progress), so locks and undo logs stay small, and an interrupted job can be resumed from the last
+    processed code.
+
+    A running job updates `job_updated` with every chunk. A job that has not done so for STALE_TIMEOUT seconds
+    has lost the process that ran it (a crash, a kill), so the maintenance worker marks it interrupted and
+    resumes it. Every chunk checks that the job is still at the code it has been read at, so a job resumed by
+    mistake while the old process is still alive stops at the next chunk instead of running twice.
+    """
+
+    ACTION_EXPIRE = "expire"
+    ACTION_EXTEND = "extend"
+    ACTION_DELETE = "delete"
+
+    ACTIONS = [ACTION_EXPIRE, ACTION_EXTEND, ACTION_DELETE]
+
+    # generates new codes into a pool instead of processing the existing ones, see fill_pool
+    ACTION_FILL_POOL = "fill_pool"
+
+    # most codes a single pool filling job can generate
+    MAX_FILL = 1000000
+    # how many times a chunk of keys is generated anew when every key of it already exists,
+    # before the job gives up (the key space is too crowded)
+    FILL_ATTEMPTS = 10
+
+    STATUS_RUNNING = "running"
+    STATUS_COMPLETE = "complete"
+    STATUS_CANCELLED = "cancelled"
+    STATUS_INTERRUPTED = "interrupted"
+    STATUS_FAILED = "failed"
+
+    # statuses a job can be resumed from
+    RESUMABLE = [STATUS_INTERRUPTED, STATUS_FAILED, STATUS_CANCELLED]
+
+    # a running job that has not made progress for this long (in seconds) is considered abandoned
+    STALE_TIMEOUT = 600
+    # how often (in seconds) the maintenance worker looks for abandoned jobs
+    RECOVER_INTERVAL = 60
+
+    def __init__(self, shards, promos, chunk_size=500, chunk_delay=0.1):
+        self.shards = shards
+        self.promos = promos
+        self.chunk_size = chunk_size
+        self.chunk_delay = chunk_delay
+        self.stopping = False
+
+    def get_setup_db(self):
+        return self.shards.default(ADMIN)
+
+    async def setup_shard(self, application, db):
+        await setup_tables(db, application, self.get_setup_tables())
+        await self.__migrate__(db)
+
+    def get_setup_tables(self):
+        return ["promo_bulk_jobs"]
+
+    async def __migrate__(self, db):
+        await ensure_index(db, "promo_bulk_jobs", "job_status", "(`job_status`, `job_updated`)")
+
+    async def started(self, application):
+        await super(BulkJobsModel, self).started(application)
+        await self.__migrate__(self.get_setup_db())
+
+        if application.runs_maintenance():
+            IOLoop.current().spawn_callback(self.__recover_loop__)
+
+    async def stopped(self):
+        self.stopping = True
+        await super(BulkJobsModel, self).stopped()
+
+    async def count_codes(self, gamespace_id, code_filter):
+        conditions, args = code_filter.conditions()
+
+        try:
+            result = await self.shards.db(BULK, gamespace_id).get("""
+                SELECT COUNT(*) AS `count`
+                FROM `promo_code`
+                WHERE `gamespace_id`=%s AND {0};
+            """.format(conditions), gamespace_id, *args)
+        except DatabaseError as e:
+            raise BulkJobError("Failed to count promo codes: " + e.args[1])
+
+        return result["count"]
+
+    async def new_job(self, gamespace_id, action, code_filter, args=None):
+
+        if action not in BulkJobsModel.ACTIONS:
+            raise BulkJobError("Unknown action: " + str(action))
+
+        code_filter.validate()
+
+        args = args or {}
+
+        if action == BulkJobsModel.ACTION_EXTEND:
+            if not args.get("expires"):
+                raise BulkJobError("New expire date is required")
+
+            args["expires"] = BulkFilter.parse_time(args["expires"])
+
+        total = await self.count_codes(gamespace_id, code_filter)
+
+        try:
+            job_id = await self.shards.db(ADMIN, gamespace_id).insert("""
+                INSERT INTO `promo_bulk_jobs`
+                (`gamespace_id`, `job_action`, `job_filter`, `job_args`, `job_status`, `job_total`,
+                 `job_created`, `job_updated`)
+                VALUES (%s, %s, %s, %s, %s, %s, NOW(), NOW());
+            """, gamespace_id, action, ujson.dumps(code_filter.dump()), ujson.dumps(args),
+                BulkJobsModel.STATUS_RUNNING, total)
+        except DatabaseError as e:
+            raise BulkJobError("Failed to create a bulk job: " + e.args[1])
+
+        self.__spawn__(gamespace_id, job_id)
+        return job_id
+
+    async def fill_pool(self, gamespace_id, pool_id, keys_count, expires, contents):
+        """
+        Starts a job that generates `keys_count` new single-use codes into the pool, in chunks
+        """
+
+        if keys_count <= 0 or keys_count > BulkJobsModel.MAX_FILL:
+            raise BulkJobError("Amount of codes should be between 1 and {0}".format(BulkJobsModel.MAX_FILL))
+
+        if not isinstance(contents, dict):
+            raise BulkJobError("Contents is not a dict")
+
+        args = {
+            "pool_id": str(pool_id),
+            "expires": BulkFilter.parse_time(expires),
+            "contents": contents
+        }
+
+        try:
+            job_id = await self.shards.db(ADMIN, gamespace_id).insert("""
+                INSERT INTO `promo_bulk_jobs`
+                (`gamespace_id`, `job_action`, `job_filter`, `job_args`, `job_status`, `job_total`,
+                 `job_created`, `job_updated`)
+                VALUES (%s, %s, %s, %s, %s, %s, NOW(), NOW());
+            """, gamespace_id, BulkJobsModel.ACTION_FILL_POOL, ujson.dumps({}), ujson.dumps(args),
+                BulkJobsModel.STATUS_RUNNING, keys_count)
+        except DatabaseError as e:
+            raise BulkJobError("Failed to create a bulk job: " + e.args[1])
+
+        self.__spawn__(gamespace_id, job_id)
+        return job_id
+
+    async def get_job(self, gamespace_id, job_id):
+        try:
+            result = await self.shards.db(ADMIN, gamespace_id).get("""
+                SELECT *
+                FROM `promo_bulk_jobs`
+                WHERE `job_id`=%s AND `gamespace_id`=%s;
+            """, job_id, gamespace_id)
+        except DatabaseError as e:
+            raise BulkJobError("Failed to get bulk job: " + e.args[1])
+
+        if result is None:
+            raise BulkJobNotFound()
+
+        return BulkJobAdapter(result)
+
+    async def list_jobs(self, gamespace_id, limit=50):
+        try:
+            result = await self.shards.db(ADMIN, gamespace_id).query("""
+                SELECT *
+                FROM `promo_bulk_jobs`
+                WHERE `gamespace_id`=%s
+                ORDER BY `job_id` DESC
+                LIMIT %s;
+            """, gamespace_id, limit)
+        except DatabaseError as e:
+            raise BulkJobError("Failed to list bulk jobs: " + e.args[1])
+
+        return list(map(BulkJobAdapter, result))
+
+    async def cancel_job(self, gamespace_id, job_id):
+        await self.__set_status__(gamespace_id, job_id, BulkJobsModel.STATUS_CANCELLED,
+                                  only_if=BulkJobsModel.STATUS_RUNNING)
+
+    async def resume_job(self, gamespace_id, job_id):
+        job = await self.get_job(gamespace_id, job_id)
+
+        if job.status not in BulkJobsModel.RESUMABLE:
+            raise BulkJobError("Only interrupted, failed or cancelled jobs can be resumed")
+
+        # only one of the concurrent resumes gets it
+        if not await self.__set_status__(gamespace_id, job_id, BulkJobsModel.STATUS_RUNNING,
+                                         only_if=BulkJobsModel.RESUMABLE):
+            raise BulkJobError("The job has been resumed already")
+
+        self.__spawn__(gamespace_id, job_id)
+
+    async def __recover_loop__(self):
+        while not self.stopping:
+            for db in self.shards.all(BULK):
+                try:
+                    await self.recover_jobs(db)
+                except DatabaseError as e:
+                    logging.error("Failed to recover abandoned bulk jobs: " + e.args[1])
+
+            await sleep(BulkJobsModel.RECOVER_INTERVAL)
+
+    async def recover_jobs(self, db):
+        """
+        Marks the running jobs that have not made progress for STALE_TIMEOUT as interrupted, and resumes them
+        """
+
+        jobs = await db.query("""
+            SELECT `job_id`, `gamespace_id`
+            FROM `promo_bulk_jobs`
+            WHERE `job_status`=%s AND `job_updated` < NOW() - INTERVAL %s SECOND;
+        """, BulkJobsModel.STATUS_RUNNING, BulkJobsModel.STALE_TIMEOUT)
+
+        for job in jobs:
+            job_id, gamespace_id = str(job["job_id"]), job["gamespace_id"]
+
+            # the same conditions again, in case the job has just moved on, or has been recovered by someone else
+            interrupted = await db.execute("""
+                UPDATE `promo_bulk_jobs`
+                SET `job_status`=%s, `job_error`=%s, `job_updated`=NOW()
+                WHERE `job_id`=%s AND `job_status`=%s AND `job_updated` < NOW() - INTERVAL %s SECOND;
+            """, BulkJobsModel.STATUS_INTERRUPTED, "Abandoned by a stopped process", job_id,
+                BulkJobsModel.STATUS_RUNNING, BulkJobsModel.STALE_TIMEOUT)
+
+            if not interrupted:
+                continue
+
+            logging.warning("Bulk job {0} has been abandoned, resuming".format(job_id))
+
+            try:
+                await self.resume_job(gamespace_id, job_id)
+            except (BulkJobError, BulkJobNotFound) as e:
+                logging.error("Failed to resume bulk job {0}: {1}".format(job_id, str(e)))
+
+    def __spawn__(self, gamespace_id, job_id):
+        IOLoop.current().spawn_callback(self.__run__, gamespace_id, job_id)
+
+    async def __set_status__(self, gamespace_id, job_id, status, error="", only_if=None):
+        """
+        Changes the status of a job (only if it has one of the `only_if` statuses, if passed).
+        Returns False if the job has not been changed.
+        """
+
+        try:
+            if only_if:
+                if not isinstance(only_if, list):
+                    only_if = [only_if]
+
+                updated = await self.shards.db(BULK, gamespace_id).execute("""
+                    UPDATE `promo_bulk_jobs`
+                    SET `job_status`=%s, `job_error`=%s, `job_updated`=NOW()
+                    WHERE `job_id`=%s AND `gamespace_id`=%s AND `job_status` IN %s;
+                """, status, error[:255], job_id, gamespace_id, only_if)
+            else:
+                updated = await self.shards.db(BULK, gamespace_id).execute("""
+                    UPDATE `promo_bulk_jobs`
+                    SET `job_status`=%s, `job_error`=%s, `job_updated`=NOW()
+                    WHERE `job_id`=%s AND `gamespace_id`=%s;
+                """, status, error[:255], job_id, gamespace_id)
+        except DatabaseError as e:
+            raise BulkJobError("Failed to update bulk job: " + e.args[1])
+
+        return bool(updated)
+
+    async def __run__(self, gamespace_id, job_id):
+        logging.info("Bulk job {0} started".format(job_id))
+
+        try:
+            while True:
+                if self.stopping:
+                    await self.__set_status__(gamespace_id, job_id, BulkJobsModel.STATUS_INTERRUPTED,
+                                              only_if=BulkJobsModel.STATUS_RUNNING)
+                    return
+
+                job = await self.get_job(gamespace_id, job_id)
+
+                if job.status != BulkJobsModel.STATUS_RUNNING:
+                    logging.info("Bulk job {0} stopped: {1}".format(job_id, job.status))
+                    return
+
+                if job.action == BulkJobsModel.ACTION_FILL_POOL:
+                    processed = await self.__fill_chunk__(gamespace_id, job)
+                else:
+                    processed = await self.__process_chunk__(gamespace_id, job)
+
+                if processed is None:
+                    logging.info("Bulk job {0} has been changed by someone else, leaving it".format(job_id))
+                    return
+
+                if not processed:
+                    await self.__set_status__(gamespace_id, job_id, BulkJobsModel.STATUS_COMPLETE,
+                                              only_if=BulkJobsModel.STATUS_RUNNING)
+                    logging.info("Bulk job {0} complete".format(job_id))
+                    return
+
+                if self.chunk_delay:
+                    await sleep(self.chunk_delay)
+
+        except (BulkJobError, BulkJobNotFound, PromoError) as e:
+            await self.__failed__(gamespace_id, job_id, str(e))
+        except PromoNotFound:
+            await self.__failed__(gamespace_id, job_id, "The pool has been deleted")
+        except Exception as e:
+            logging.exception("Bulk job {0} crashed".format(job_id))
+            await self.__failed__(gamespace_id, job_id, "{0}: {1}".format(e.__class__.__name__, str(e)))
+
+    async def __failed__(self, gamespace_id, job_id, error):
+        logging.error("Bulk job {0} failed: {1}".format(job_id, error))
+
+        try:
+            await self.__set_status__(gamespace_id, job_id, BulkJobsModel.STATUS_FAILED, error=error,
+                                      only_if=BulkJobsModel.STATUS_RUNNING)
+        except BulkJobError:
+            pass
+
+    async def __process_chunk__(self, gamespace_id, job):
+        """
+        Processes the next chunk of codes of the job in a single transaction.
+        Returns amount of codes processed, zero means the job is complete,
+        None means the job has changed in the meantime (cancelled, or processed by another process).
+        """
+
+        conditions, args = job.filter.conditions()
+        db = self.shards.db(BULK, gamespace_id)
+
+        try:
+            # the candidates are found with a plain read first: a locking one would lock every row it goes
+            # through, and with a sparse filter that can be a lot more rows than the chunk
+            candidates = await db.query("""
+                SELECT `code_id`
+                FROM `promo_code`
+                WHERE `gamespace_id`=%s AND `code_id`>%s AND {0}
+                ORDER BY `code_id`
+                LIMIT %s;
+            """.format(conditions), gamespace_id, job.last_id, *args, self.chunk_size)
+
+            if not candidates:
+                return 0
+
+            candidate_ids = [code["code_id"] for code in candidates]
+
+            if job.action == BulkJobsModel.ACTION_DELETE:
+                # a heavily used code may have millions of usages, so those are deleted beforehand, in small
+                # transactions of their own; the chunk transaction below only deletes the ones added since
+                await self.promos.delete_promo_usages(gamespace_id, candidate_ids)
+
+            async with db.acquire(auto_commit=False) as conn:
+                try:
+                    # then only the candidates are locked, by their primary key, and checked again
+                    codes = await conn.query("""
+                        SELECT `code_id`
+                        FROM `promo_code`
+                        WHERE `gamespace_id`=%s AND `code_id` IN %s AND {0}
+                        FOR UPDATE;
+                    """.format(conditions), gamespace_id, candidate_ids, *args)
+
+                    ids = [code["code_id"] for code in codes]
+
+                    if ids:
+                        await self.__apply__(conn, gamespace_id, job, ids)
+
+                    # the last candidate is where the next chunk starts, even if it does not match anymore
+                    advanced = await conn.execute("""
+                        UPDATE `promo_bulk_jobs`
+                        SET `job_processed`=`job_processed`+%s, `job_last_id`=%s, `job_updated`=NOW()
+                        WHERE `job_id`=%s AND `gamespace_id`=%s AND `job_status`=%s AND `job_last_id`=%s;
+                    """, len(ids), candidate_ids[-1], job.job_id, gamespace_id, BulkJobsModel.STATUS_RUNNING,
+                        job.last_id)
+
+                    if not advanced:
+                        # cancelled in the meantime, or the chunk has been done by another process
+                        await conn.rollback()
+                        return None
+                except BaseException:
+                    await conn.rollback()
+                    raise
+                else:
+                    await conn.commit()
+        except DatabaseError as e:
+            raise BulkJobError("Failed to process a chunk: " + e.args[1])
+
+        return len(candidate_ids)
+
+    async def __fill_chunk__(self, gamespace_id, job):
+        """
+        Generates the next chunk of codes of a pool filling job, together with the job progress, in a single
+        transaction. Same return values as __process_chunk__.
+        """
+
+        remaining = job.total - job.processed
+
+        if remaining <= 0:
+            return 0
+
+        try:
+            async with self.shards.db(BULK, gamespace_id).acquire(auto_commit=False) as db:
+                try:
+                    for attempt in range(0, BulkJobsModel.FILL_ATTEMPTS):
+                        added = await self.promos.fill_pool_chunk(
+                            db, gamespace_id, job.args["pool_id"], min(self.chunk_size, remaining),
+                            job.args["expires"], job.args["contents"])
+
+                        if added:
+                            break
+                    else:
+                        raise BulkJobError("Every new key already exists {0} times in a row, there are too many "
+                                           "codes in the gamespace".format(BulkJobsModel.FILL_ATTEMPTS))
+
+                    advanced = await db.execute("""
+                        UPDATE `promo_bulk_jobs`
+                        SET `job_processed`=`job_processed`+%s, `job_updated`=NOW()
+                        WHERE `job_id`=%s AND `gamespace_id`=%s AND `job_status`=%s AND `job_processed`=%s;
+                    """, added, job.job_id, gamespace_id, BulkJobsModel.STATUS_RUNNING, job.processed)
+
+                    if not advanced:
+                        await db.rollback()
+                        return None
+                except BaseException:
+                    await db.rollback()
+                    raise
+                else:
+                    await db.commit()
+        except DatabaseError as e:
+            raise BulkJobError("Failed to fill the pool: " + e.args[1])
+
+        return added
+
+    # noinspection PyMethodMayBeStatic
+    async def __apply__(self, db, gamespace_id, job, ids):
+        if job.action == BulkJobsModel.ACTION_EXPIRE:
+            await db.execute("""
+                UPDATE `promo_code`
+                SET `code_expires`=NOW()
+                WHERE `gamespace_id`=%s AND `code_id` IN %s;
+            """, gamespace_id, ids)
+        elif job.action == BulkJobsModel.ACTION_EXTEND:
+            await db.execute("""
+                UPDATE `promo_code`
+                SET `code_expires`=%s
+                WHERE `gamespace_id`=%s AND `code_id` IN %s;
+            """, job.args["expires"], gamespace_id, ids)
+        elif job.action == BulkJobsModel.ACTION_DELETE:
+            # most of the usages are gone already (see __process_chunk__), the ones added since go in the same
+            # transaction, so a failure cannot leave them behind the deleted codes
+            for table_name in ["promo_code_users", "promo_code_usage_chunks", "promo_code"]:
+                await db.execute("""
+                    DELETE
+                    FROM `{0}`
+                    WHERE `gamespace_id`=%s AND `code_id` IN %s;
+                """.format(table_name), gamespace_id, ids)
@@ -1,6 +1,11 @@
 
 from anthill.common.database import DatabaseError, DuplicateError
 from anthill.common.model import Model
+
+from . pools import ADMIN
+from . schema import setup_tables
+
+import collections
 import ujson
 
 
@@ -13,26 +18,65 @@ class ContentNotFound(Exception):
 
 
 class ContentAdapter(object):
+    """
+    The payload is selected as JSON text (see ContentAdapter.select) and decoded on first access only,
+    so the listings that only show the names do not pay for it. `payload_json` is the text as stored.
+    """
+
+    __slots__ = ["content_id", "name", "payload_json", "decoded"]
+
+    # what every column is selected as
+    COLUMNS = collections.OrderedDict([
+        ("content_id", "`content_id`"),
+        ("content_name", "`content_name`"),
+        ("content_json", "CAST(`content_json` AS CHAR CHARACTER SET utf8mb4) AS `content_json`")
+    ])
+
+    # enough for the lists of contents to choose from
+    NAME_COLUMNS = ["content_name"]
+
     def __init__(self, data):
         self.content_id = str(data.get("content_id"))
         self.name = data.get("content_name")
-        self.payload = data.get("content_json")
+        self.payload_json = data.get("content_json")
+        self.decoded = None
+
+    @staticmethod
+    def select(columns=None):
+        """
+        Returns a SELECT list of the columns given (all of them if None), content_id is always there
+        """
+        if columns is None:
+            return ", ".join(ContentAdapter.COLUMNS.values())
+
+        return ", ".join(
+            expression for column, expression in ContentAdapter.COLUMNS.items()
+            if column == "content_id" or column in columns)
+
+    @property
+    def payload(self):
+        if self.decoded is None and self.payload_json is not None:
+            self.decoded = ujson.loads(self.payload_json)
+        return self.decoded
 
 
 class ContentModel(Model):
-    def __init__(self, db):
-        self.db = db
+    def __init__(self, shards):
+        self.shards = shards
 
     def get_setup_tables(self):
         return ["promo_contents"]
 
     def get_setup_db(self):
-        return self.db
+        return self.shards.default(ADMIN)
+
+    async def setup_shard(self, application, db):
+        await setup_tables(db, application, self.get_setup_tables())
 
     async def new_content(self, gamespace_id, content_name, content_data):
 
         try:
-            result = await self.db.insert("""
+            result = await self.shards.db(ADMIN, gamespace_id).insert("""
                 INSERT INTO `promo_contents`
                 (`gamespace_id`, `content_name`, `content_json`)
                 VALUES (%s, %s, %s);
@@ -46,12 +90,12 @@ class ContentModel(Model):
 
     async def find_content(self, gamespace_id, content_name):
         try:
-            result = await self.db.get("""
-                SELECT *
+            result = await self.shards.db(ADMIN, gamespace_id).get("""
+                SELECT {0}
                 FROM `promo_contents`
                 WHERE `content_name`=%s AND `gamespace_id`=%s
                 LIMIT 1;
-            """, content_name, gamespace_id)
+            """.format(ContentAdapter.select()), content_name, gamespace_id)
         except DatabaseError as e:
             raise ContentError("Failed to find content: " + e.args[1])
 
@@ -62,12 +106,12 @@ class ContentModel(Model):
 
     async def get_content(self, gamespace_id, content_id):
         try:
-            result = await self.db.get("""
-                SELECT *
+            result = await self.shards.db(ADMIN, gamespace_id).get("""
+                SELECT {0}
                 FROM `promo_contents`
                 WHERE `content_id`=%s AND `gamespace_id`=%s
                 LIMIT 1;
-            """, content_id, gamespace_id)
+            """.format(ContentAdapter.select()), content_id, gamespace_id)
         except DatabaseError as e:
             raise ContentError("Failed to get content: " + e.args[1])
 
@@ -78,7 +122,7 @@ class ContentModel(Model):
 
     async def delete_content(self, gamespace_id, content_id):
         try:
-            await self.db.execute("""
+            await self.shards.db(ADMIN, gamespace_id).execute("""
                 DELETE
                 FROM `promo_contents`
                 WHERE `content_id`=%s AND `gamespace_id`=%s
@@ -89,7 +133,7 @@ class ContentModel(Model):
 
     async def update_content(self, gamespace_id, content_id, content_name, content_data):
         try:
-            await self.db.execute("""
+            await self.shards.db(ADMIN, gamespace_id).execute("""
                 UPDATE `promo_contents`
                 SET `content_name`=%s, `content_json`=%s
                 WHERE `content_id`=%s AND `gamespace_id`=%s;
@@ -97,13 +141,17 @@ class ContentModel(Model):
         except DatabaseError as e:
             raise ContentError("Failed to update content: " + e.args[1])
 
-    async def list_contents(self, gamespace_id):
+    async def list_contents(self, gamespace_id, columns=None, workload=ADMIN):
+        """
+        Lists the contents of a gamespace, with only the columns given (see ContentAdapter.COLUMNS), or all of them
+        """
+
         try:
-            contents = await self.db.query("""
-                SELECT *
+            contents = await self.shards.db(workload, gamespace_id).query("""
+                SELECT {0}
                 FROM `promo_contents`
                 WHERE `gamespace_id`=%s;
-            """, gamespace_id)
+            """.format(ContentAdapter.select(columns)), gamespace_id)
         except DatabaseError as e:
             raise ContentError("Failed to list content: " + e.args[1])
 
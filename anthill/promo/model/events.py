@@ -0,0 +1,149 @@
+from anthill.common.database import DatabaseError
+from anthill.common.model import Model
+
+from tornado.ioloop import IOLoop
+from tornado.gen import sleep
+
+from . pools import PLAYER, ADMIN, BULK
+from . schema import ensure_column, ensure_index, setup_tables
+from . promo import PromoError
+
+import logging
+
+
+class RedemptionEventAdapter(object):
+    def __init__(self, data):
+        self.event_id = str(data.get("event_seq"))
+        self.code_id = str(data.get("code_id"))
+        self.key = data.get("code_key")
+        self.account_id = str(data.get("account_id"))
+        self.time = data.get("event_time")
+
+    def dump(self):
+        return {
+            "id": self.event_id,
+            "code_id": self.code_id,
+            "key": self.key,
+            "account": self.account_id,
+            "time": str(self.time)
+        }
+
+
+class RedemptionEventsModel(Model):
+    """
+    A transactional outbox of promo code redemptions.
+
+    An event is written in the same transaction the promo code is used in, so an event exists if and only if the
+    redemption has been committed. Consumers read the events of a gamespace in order of their ids, passing the id
+    of the last event they've got as a cursor, and keep the cursor on their side, so every consumer goes at its
+    own pace and never reads the same event twice.
+
+    An auto-increment id would not do for the cursor: a transaction with a smaller one may commit after one with
+    a bigger one, after the consumer has moved past it. So the id of an event is the next number of the
+    gamespace's sequence (`promo_redemption_sequences`), and the sequence row stays locked until the redemption
+    commits or rolls back. The next redemption of the gamespace waits for it, so the ids are committed strictly
+    in order and without gaps. The lock is taken by the last statement of the redemption, so it is held only
+    for the commit.
+
+    Events older than `retention` hours are deleted, consumers that fall behind more than that lose events.
+    """
+
+    # amount of old events deleted in one statement
+    PURGE_CHUNK = 1000
+
+    def __init__(self, shards, enabled=False, retention=168, purge_interval=600):
+        self.shards = shards
+        self.enabled = enabled
+        self.retention = retention
+        self.purge_interval = purge_interval
+        self.stopping = False
+
+    def get_setup_db(self):
+        return self.shards.default(ADMIN)
+
+    def get_setup_tables(self):
+        return ["promo_redemption_events", "promo_redemption_sequences"]
+
+    async def setup_shard(self, application, db):
+        await setup_tables(db, application, self.get_setup_tables())
+        await self.__migrate__(db)
+
+    # noinspection PyMethodMayBeStatic
+    async def __migrate__(self, db):
+        # the events written before are not listed, they have no place in the sequence
+        await ensure_column(db, "promo_redemption_events", "event_seq", "bigint(20) unsigned DEFAULT NULL")
+        await ensure_index(db, "promo_redemption_events", "event_seq", "(`gamespace_id`, `event_seq`)", unique=True)
+
+    async def started(self, application):
+        await super(RedemptionEventsModel, self).started(application)
+        await self.__migrate__(self.get_setup_db())
+
+        if self.enabled and self.retention and application.runs_maintenance():
+            IOLoop.current().spawn_callback(self.__purge_loop__)
+
+    async def stopped(self):
+        self.stopping = True
+        await super(RedemptionEventsModel, self).stopped()
+
+    async def record(self, db, gamespace_id, code_id, code_key, account_id):
+        """
+        Writes a redemption event using the connection of the redemption transaction.
+        Should be the last statement of the transaction, as the sequence of the gamespace is locked from here on.
+        """
+
+        if not self.enabled:
+            return
+
+        # LAST_INSERT_ID(expr) makes the new value the insert id of the statement
+        event_seq = await db.insert("""
+            INSERT INTO `promo_redemption_sequences`
+            (`gamespace_id`, `sequence_last`)
+            VALUES (%s, LAST_INSERT_ID(1))
+            ON DUPLICATE KEY UPDATE `sequence_last`=LAST_INSERT_ID(`sequence_last` + 1);
+        """, gamespace_id)
+
+        await db.insert("""
+            INSERT INTO `promo_redemption_events`
+            (`gamespace_id`, `event_seq`, `code_id`, `code_key`, `account_id`, `event_time`)
+            VALUES (%s, %s, %s, %s, %s, NOW());
+        """, gamespace_id, event_seq, code_id, code_key, account_id)
+
+    async def list_events(self, gamespace_id, after=0, limit=100):
+        """
+        Returns up to `limit` events that come after the event `after`, in order.
+        """
+
+        try:
+            events = await self.shards.db(PLAYER, gamespace_id).query("""
+                SELECT *
+                FROM `promo_redemption_events`
+                WHERE `gamespace_id`=%s AND `event_seq`>%s
+                ORDER BY `event_seq`
+                LIMIT %s;
+            """, gamespace_id, after, limit)
+        except DatabaseError as e:
+            raise PromoError(500, "Failed to list redemption events: " + e.args[1])
+
+        return list(map(RedemptionEventAdapter, events))
+
+    async def __purge_loop__(self):
+        while not self.stopping:
+            for db in self.shards.all(BULK):
+                try:
+                    await self.purge(db)
+                except DatabaseError as e:
+                    logging.error("Failed to purge old redemption events: " + e.args[1])
+
+            await sleep(self.purge_interval)
+
+    async def purge(self, db):
+        while not self.stopping:
+            deleted = await db.execute("""
+                DELETE
+                FROM `promo_redemption_events`
+                WHERE `event_time` < NOW() - INTERVAL %s HOUR
+                LIMIT %s;
+            """, self.retention, RedemptionEventsModel.PURGE_CHUNK)
+
+            if deleted < RedemptionEventsModel.PURGE_CHUNK:
+                return
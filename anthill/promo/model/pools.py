@@ -0,0 +1,104 @@
+from anthill.common import database
+
+from . slowlog import TimedDatabase
+
+import tormysql
+
+
+# Workloads every model method belongs to. Each one gets its own connection pool, so a heavy
+# admin or bulk action cannot take connections away from the player-facing redemptions.
+PLAYER = "player"
+ADMIN = "admin"
+BULK = "bulk"
+
+WORKLOADS = [PLAYER, ADMIN, BULK]
+
+
+class PoolDatabase(database.Database):
+    """
+    Same as database.Database, but with configurable limit of connections in the pool.
+    """
+
+    def __init__(self, max_connections, host=None, database=None, user=None, password=None,
+                 wait_connection_timeout=15, **kwargs):
+
+        # the parent sets the connections up, but creates the pool with a hardcoded size
+        super(PoolDatabase, self).__init__(host=host, database=database, user=user, password=password, **kwargs)
+
+        self.max_connections = max_connections
+
+        # so the pool is created again with the same connection settings, and the size given
+        # (it opens no connections until the first statement, so nothing is lost)
+        self.pool = PoolDatabase.__resize__(self.pool, max_connections, wait_connection_timeout)
+
+    @staticmethod
+    def __resize__(pool, max_connections, wait_connection_timeout):
+        # noinspection PyProtectedMember
+        return tormysql.ConnectionPool(
+            *pool._args,
+            max_connections=max_connections,
+            wait_connection_timeout=wait_connection_timeout,
+            idle_seconds=pool._idle_seconds,
+            **pool._kwargs
+        )
+
+
+class DatabasePools(object):
+    """
+    A set of named connection pools to the same database, one per workload.
+
+    Usage:
+
+    pools = DatabasePools(host, database, user, password, {
+        PLAYER: 64,
+        ADMIN: 8,
+        BULK: 4
+    })
+
+    await pools.db(PLAYER).get("SELECT ...")
+
+    If a SlowQueryLog is passed, every statement run through the pools is timed.
+    `lock_wait_timeouts` (workload => seconds) sets innodb_lock_wait_timeout for every connection of the pools given,
+    so a transaction stuck behind a lock gives up (and can be retried) sooner than the server default of 50 seconds.
+
+    """
+
+    def __init__(self, host, database, user, password, limits, slow_log=None, lock_wait_timeouts=None):
+        lock_wait_timeouts = lock_wait_timeouts or {}
+
+        self.databases = {
+            workload: PoolDatabase(
+                max_connections,
+                host=host,
+                database=database,
+                user=user,
+                password=password,
+                **DatabasePools.__session__(lock_wait_timeouts.get(workload)))
+            for workload, max_connections in limits.items()
+        }
+
+        self.pools = dict(self.databases)
+
+        for workload in WORKLOADS:
+            if workload not in self.pools:
+                raise KeyError("No pool limit defined for workload '{0}'".format(workload))
+
+        if slow_log is not None:
+            # slow statements are explained on the admin pool, so players' connections are not taken for it
+            self.pools = {
+                workload: TimedDatabase(db, slow_log, explain_db=self.databases[ADMIN])
+                for workload, db in self.pools.items()
+            }
+
+    @staticmethod
+    def __session__(lock_wait_timeout):
+        if lock_wait_timeout is None:
+            return {}
+
+        # run on every new connection of the pool, before it is used
+        return {
+            "init_command": "SET SESSION innodb_lock_wait_timeout={0}".format(int(lock_wait_timeout))
+        }
+
+    def db(self, workload):
+        return self.pools[workload]
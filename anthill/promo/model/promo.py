@@ -2,6 +2,18 @@
 from anthill.common.database import DatabaseError, DuplicateError
 from anthill.common.model import Model
 
+from . pools import PLAYER, ADMIN, BULK
+from . schema import ensure_column, ensure_index, setup_tables
+from . retry import retry_transaction, TransactionRetriesExceeded
+from . shards import ShardMoving
+from . bitmap import BitmapChunk, split_id, join_id
+from . content import ContentAdapter
+
+from tornado.ioloop import IOLoop
+from tornado.gen import sleep
+
+import collections
+import logging
 import ujson
 import re
 import random
@@ -24,26 +36,392 @@ class PromoExists(Exception):
     pass
 
 
+class PromoUsageAdapter(object):
+    def __init__(self, data):
+        # codes that keep their usages in a bitmap have no usage records
+        self.usage_id = str(data["record_id"]) if data.get("record_id") else None
+        self.code_id = str(data.get("code_id"))
+        self.key = data.get("code_key")
+
+    def dump(self):
+        return {
+            "id": self.usage_id,
+            "code_id": self.code_id,
+            "key": self.key
+        }
+
+
+class PromoRedemption(object):
+    """
+    What a redemption of a promo code gives: every content (see ContentAdapter) with its amount.
+    The payloads stay JSON text as stored, `dumps` puts them into the response as they are.
+    """
+
+    __slots__ = ["contents"]
+
+    def __init__(self, contents):
+        # list of (ContentAdapter, amount)
+        self.contents = contents
+
+    def dump(self):
+        return {
+            "result": [
+                {
+                    "payload": content.payload,
+                    "amount": amount
+                }
+                for content, amount in self.contents
+            ]
+        }
+
+    def dumps(self):
+        """
+        Same as ujson.dumps(self.dump()), without decoding and encoding the payloads again
+        """
+        return '{"result":[' + ",".join(
+            '{"payload":' + content.payload_json + ',"amount":' + ujson.dumps(amount) + '}'
+            for content, amount in self.contents) + ']}'
+
+
 class PromoAdapter(object):
+    """
+    The contents are selected as JSON text (see PromoAdapter.select) and decoded on first access only.
+    `contents_json` is the text as stored.
+    """
+
+    __slots__ = ["code_id", "key", "expires", "contents_json", "decoded", "amount", "bitmap"]
+
+    # what every column is selected as
+    COLUMNS = collections.OrderedDict([
+        ("code_id", "`code_id`"),
+        ("code_key", "`code_key`"),
+        ("code_expires", "`code_expires`"),
+        ("code_contents", "CAST(`code_contents` AS CHAR CHARACTER SET utf8mb4) AS `code_contents`"),
+        ("code_amount", "`code_amount`"),
+        ("code_bitmap", "`code_bitmap`")
+    ])
+
     def __init__(self, data):
         self.code_id = str(data.get("code_id"))
         self.key = data.get("code_key")
         self.expires = data.get("code_expires")
-        self.contents = data.get("code_contents")
+        self.contents_json = data.get("code_contents")
+        self.decoded = None
         self.amount = data.get("code_amount")
+        self.bitmap = bool(data.get("code_bitmap"))
+
+    @staticmethod
+    def select(columns=None):
+        """
+        Returns a SELECT list of the columns given (all of them if None), code_id is always there
+        """
+        if columns is None:
+            return ", ".join(PromoAdapter.COLUMNS.values())
+
+        return ", ".join(
+            expression for column, expression in PromoAdapter.COLUMNS.items()
+            if column == "code_id" or column in columns)
+
+    @property
+    def contents(self):
+        if self.decoded is None and self.contents_json is not None:
+            self.decoded = ujson.loads(self.contents_json)
+        return self.decoded
+
+
+class PromoPoolAdapter(object):
+    def __init__(self, data):
+        self.pool_id = str(data.get("pool_id"))
+        self.name = data.get("pool_name")
+        self.total = data.get("pool_total", 0)
+        self.claimed = data.get("pool_claimed", 0)
 
 
 class PromoModel(Model):
+    """
+    Promo code keys are stored either as strings (`code_key`), or, with the integer key storage, also as 64-bit
+    integers (`code_key_int`): the key symbols are read as a base-36 number, 36^12 fits into a BIGINT. The integer
+    unique index is several times smaller than the string one, so much more of it fits in the buffer pool.
+
+    Switching an existing database to the integer key storage:
+
+    1. Restart every instance with --promo_key_storage=integer. The column and its index are added, and the existing
+       keys are converted in background; until that is complete, keys not found by the integer are also looked up
+       by the string.
+    2. Once "Integer promo code keys backfilled" is logged, the string index is not used anymore and can be dropped:
+       ALTER TABLE `promo_code` DROP INDEX `gamespace_id`;
+
+    The keys are converted by the maintenance worker. The other workers find out it is complete from the
+    `promo_migrations` table on the default shard, which is also where the restarts find it.
+
+    Keys that do not match XXXX-XXXX-XXXX cannot be stored as integers, so with the integer key storage they are
+    not accepted for new codes, and are not found.
+    """
+
     PROMO_PATTERN = re.compile("[A-Z0-9]{4}-[A-Z0-9]{4}-[A-Z0-9]{4}")
+    PROMO_KEY_PATTERN = re.compile("^[A-Z0-9]{4}-[A-Z0-9]{4}-[A-Z0-9]{4}$")
+
+    KEY_STORAGE_STRING = "string"
+    KEY_STORAGE_INTEGER = "integer"
+
+    KEY_BASE = 36
+    KEY_SYMBOLS = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+    KEY_LENGTH = 12
 
-    def __init__(self, db):
-        self.db = db
+    # range of code ids converted to integer keys in one statement
+    KEY_BACKFILL_BATCH = 1000
+    # how often (in seconds) the workers other than the maintenance one check if the keys are converted
+    KEY_BACKFILL_CHECK_INTERVAL = 30
+    MIGRATION_INTEGER_KEYS = "integer_keys"
+
+    # amount of usage records read, or bitmap chunks written, in one statement while converting the usages
+    BITMAP_CONVERT_BATCH = 10000
+    BITMAP_WRITE_BATCH = 100
+    # amount of bitmap chunks checked in one statement while removing accounts
+    BITMAP_REMOVE_BATCH = 1000
+
+    # amount of usage records deleted in one statement, so huge codes don't produce huge transactions
+    USAGES_DELETE_CHUNK = 1000
+
+    # amount of most contended promo codes to keep track of
+    CONTENTION_TRACK_LIMIT = 100
+
+    def __init__(self, shards, events, retry_budget=2.0, retry_delay=0.01, key_storage=KEY_STORAGE_STRING):
+        self.shards = shards
+        self.events = events
+        self.retry_budget = retry_budget
+        self.retry_delay = retry_delay
+
+        if key_storage not in [PromoModel.KEY_STORAGE_STRING, PromoModel.KEY_STORAGE_INTEGER]:
+            raise PromoError(500, "Unknown promo key storage: " + str(key_storage))
+
+        self.key_storage = key_storage
+        # until the existing codes get their integer keys, lookups have to fall back to the string keys
+        self.keys_backfilled = key_storage != PromoModel.KEY_STORAGE_INTEGER
+
+        # (gamespace_id, promo_key) => total amount of retries the redemptions needed
+        self.contention = collections.Counter()
 
     def get_setup_db(self):
-        return self.db
+        return self.shards.default(ADMIN)
 
     def get_setup_tables(self):
-        return ["promo_code", "promo_code_users"]
+        return ["promo_code", "promo_code_users", "promo_code_pools", "promo_code_pool_keys",
+                "promo_code_usage_chunks", "promo_migrations"]
+
+    async def started(self, application):
+        await super(PromoModel, self).started(application)
+        await self.__migrate__(self.get_setup_db())
+
+        if not self.integer_keys():
+            # the codes created from now on have no integer keys, so they have to be converted again next time
+            await self.__set_migration__(PromoModel.MIGRATION_INTEGER_KEYS, False)
+            return
+
+        self.keys_backfilled = await self.__get_migration__(PromoModel.MIGRATION_INTEGER_KEYS)
+
+        if self.keys_backfilled:
+            return
+
+        if application.runs_maintenance():
+            IOLoop.current().spawn_callback(self.backfill_integer_keys)
+        else:
+            IOLoop.current().spawn_callback(self.__wait_integer_keys__)
+
+    async def setup_shard(self, application, db):
+        await setup_tables(db, application, self.get_setup_tables())
+        await self.__migrate__(db)
+
+    async def __migrate__(self, db):
+        await ensure_index(db, "promo_code_users", "code_id", "(`gamespace_id`, `code_id`, `account_id`)")
+        await ensure_index(db, "promo_code_users", "account_id", "(`gamespace_id`, `account_id`)")
+        await ensure_column(db, "promo_code", "code_bitmap", "tinyint(1) NOT NULL DEFAULT '0'")
+        await ensure_column(db, "promo_code", "code_stocked", "tinyint(1) NOT NULL DEFAULT '0'")
+
+        if self.integer_keys():
+            await ensure_column(db, "promo_code", "code_key_int", "bigint(20) unsigned DEFAULT NULL")
+            await ensure_index(db, "promo_code", "code_key_int", "(`gamespace_id`, `code_key_int`)", unique=True)
+
+    def integer_keys(self):
+        return self.key_storage == PromoModel.KEY_STORAGE_INTEGER
+
+    @staticmethod
+    def encode_key(promo_key):
+        """
+        Converts a XXXX-XXXX-XXXX key into a 64-bit integer, returns None if the key cannot be converted.
+        Keys are case-insensitive, the same way the string keys are compared by MySQL.
+        """
+
+        promo_key = promo_key.upper()
+
+        if not PromoModel.PROMO_KEY_PATTERN.match(promo_key):
+            return None
+
+        return int(promo_key.replace("-", ""), PromoModel.KEY_BASE)
+
+    @staticmethod
+    def decode_key(value):
+        """
+        Converts an integer key (see encode_key) back into a XXXX-XXXX-XXXX one
+        """
+
+        symbols = []
+
+        for i in range(0, PromoModel.KEY_LENGTH):
+            value, symbol = divmod(value, PromoModel.KEY_BASE)
+            symbols.append(PromoModel.KEY_SYMBOLS[symbol])
+
+        symbols = "".join(reversed(symbols))
+        return symbols[0:4] + "-" + symbols[4:8] + "-" + symbols[8:12]
+
+    def key_columns(self, promo_key):
+        """
+        Returns a tuple (columns, values) the promo code key is stored in
+        """
+
+        if not self.integer_keys():
+            return ["code_key"], [promo_key]
+
+        encoded = PromoModel.encode_key(promo_key)
+
+        if encoded is None:
+            raise PromoError(400, "Promo code is not valid (should be XXXX-XXXX-XXXX)")
+
+        return ["code_key", "code_key_int"], [promo_key, encoded]
+
+    def __keys_condition__(self, keys):
+        """
+        Returns (SQL condition, arguments) to look up the promo codes with any of the keys given
+        (the keys are expected to be valid ones, as random() makes them)
+        """
+
+        if not self.integer_keys():
+            return "`code_key` IN %s", [keys]
+
+        encoded = [PromoModel.encode_key(key) for key in keys]
+
+        if self.keys_backfilled:
+            return "`code_key_int` IN %s", [encoded]
+
+        return "(`code_key_int` IN %s OR `code_key` IN %s)", [encoded, keys]
+
+    def __key_lookups__(self, promo_key):
+        """
+        Returns a list of (SQL condition, argument) to look up a promo code by key with, in order
+        """
+
+        if not self.integer_keys():
+            return [("`code_key`=%s", promo_key)]
+
+        encoded = PromoModel.encode_key(promo_key)
+
+        if encoded is None:
+            return []
+
+        if self.keys_backfilled:
+            return [("`code_key_int`=%s", encoded)]
+
+        return [("`code_key_int`=%s", encoded), ("`code_key`=%s", promo_key)]
+
+    async def __get_migration__(self, name):
+        try:
+            completed = await self.shards.default(ADMIN).get("""
+                SELECT `migration_completed`
+                FROM `promo_migrations`
+                WHERE `migration_name`=%s;
+            """, name)
+        except DatabaseError as e:
+            logging.error("Failed to check migration '{0}': {1}".format(name, e.args[1]))
+            return False
+
+        return completed is not None
+
+    async def __set_migration__(self, name, completed):
+        db = self.shards.default(ADMIN)
+
+        try:
+            if completed:
+                await db.execute("""
+                    INSERT INTO `promo_migrations`
+                    (`migration_name`, `migration_completed`)
+                    VALUES (%s, NOW())
+                    ON DUPLICATE KEY UPDATE `migration_completed`=NOW();
+                """, name)
+            else:
+                await db.execute("""
+                    DELETE
+                    FROM `promo_migrations`
+                    WHERE `migration_name`=%s;
+                """, name)
+        except DatabaseError as e:
+            logging.error("Failed to update migration '{0}': {1}".format(name, e.args[1]))
+            return False
+
+        return True
+
+    async def __wait_integer_keys__(self):
+        while not self.keys_backfilled:
+            await sleep(PromoModel.KEY_BACKFILL_CHECK_INTERVAL)
+            self.keys_backfilled = await self.__get_migration__(PromoModel.MIGRATION_INTEGER_KEYS)
+
+    async def backfill_integer_keys(self):
+        """
+        Converts the keys of the codes created before the integer key storage was enabled.
+        Goes over the codes in ranges of code_id, so every statement locks a small amount of rows only. Then looks
+        for the codes still not converted (created meanwhile by the instances not restarted yet), until none is left.
+        """
+
+        for db in self.shards.all(BULK):
+            try:
+                last = await db.get("""
+                    SELECT MAX(`code_id`) AS `last_id`
+                    FROM `promo_code`;
+                """)
+
+                last_id = last["last_id"] or 0
+                code_id = 0
+
+                while code_id < last_id:
+                    await db.execute("""
+                        UPDATE `promo_code`
+                        SET `code_key_int`=CAST(CONV(REPLACE(`code_key`, '-', ''), 36, 10) AS UNSIGNED)
+                        WHERE `code_id`>%s AND `code_id`<=%s AND `code_key_int` IS NULL
+                            AND `code_key` REGEXP '^[A-Z0-9]{4}-[A-Z0-9]{4}-[A-Z0-9]{4}$';
+                    """, code_id, code_id + PromoModel.KEY_BACKFILL_BATCH)
+
+                    code_id += PromoModel.KEY_BACKFILL_BATCH
+
+                while True:
+                    left = await db.query("""
+                        SELECT `code_id`
+                        FROM `promo_code`
+                        WHERE `code_key_int` IS NULL
+                            AND `code_key` REGEXP '^[A-Z0-9]{4}-[A-Z0-9]{4}-[A-Z0-9]{4}$'
+                        LIMIT %s;
+                    """, PromoModel.KEY_BACKFILL_BATCH)
+
+                    if not left:
+                        break
+
+                    converted = await db.execute("""
+                        UPDATE `promo_code`
+                        SET `code_key_int`=CAST(CONV(REPLACE(`code_key`, '-', ''), 36, 10) AS UNSIGNED)
+                        WHERE `code_id` IN %s AND `code_key_int` IS NULL;
+                    """, [row["code_id"] for row in left])
+
+                    if not converted:
+                        logging.error("Failed to backfill integer promo code keys: codes {0} cannot be converted"
+                                      .format(", ".join(str(row["code_id"]) for row in left[:10])))
+                        return
+            except DatabaseError as e:
+                logging.error("Failed to backfill integer promo code keys: " + e.args[1])
+                return
+
+        if not await self.__set_migration__(PromoModel.MIGRATION_INTEGER_KEYS, True):
+            return
+
+        self.keys_backfilled = True
+        logging.warning("Integer promo code keys backfilled")
 
     def random_code(self, n):
         return ''.join(random.choice("ABCDEFGHJKLMNPQRSTUVWXYZ0123456789") for _ in range(n))
@@ -55,32 +433,130 @@ class PromoModel(Model):
         if not re.match(PromoModel.PROMO_PATTERN, code):
             raise PromoError(400, "Promo code is not valid (should be XXXX-XXXX-XXXX)")
 
+        if self.integer_keys() and PromoModel.encode_key(code) is None:
+            raise PromoError(400, "Promo code is not valid (should be XXXX-XXXX-XXXX)")
+
     def has_delete_account_event(self):
         return True
 
     async def accounts_deleted(self, gamespace, accounts, gamespace_only):
         try:
             if gamespace_only:
-                await self.db.execute(
+                db = self.shards.db(BULK, gamespace)
+
+                await db.execute(
                     """
                         DELETE FROM `promo_code_users`
                         WHERE `gamespace_id`=%s AND `account_id` IN %s;
                     """, gamespace, accounts)
+
+                await self.__bitmap_remove__(db, gamespace, accounts)
             else:
-                await self.db.execute(
-                    """
-                        DELETE FROM `promo_code_users`
-                        WHERE `account_id` IN %s;
-                    """, accounts)
+                for db in self.shards.all(BULK):
+                    await db.execute(
+                        """
+                            DELETE FROM `promo_code_users`
+                            WHERE `account_id` IN %s;
+                        """, accounts)
+
+                    await self.__bitmap_remove__(db, None, accounts)
         except DatabaseError as e:
             raise PromoError(500, "Failed to delete promo code usages: " + e.args[1])
 
+    async def __bitmap_remove__(self, db, gamespace_id, accounts):
+        """
+        Removes the accounts from the usage bitmaps of every code (of the gamespace, if given).
+
+        Almost every account falls into the first few chunks, which every code has, so the chunks are read
+        without locking, in batches, and only the ones that actually have some of the accounts are locked and
+        rewritten, in a short transaction per batch.
+        """
+
+        values = {}
+
+        for account_id in accounts:
+            chunk_id, value = split_id(int(account_id))
+            values.setdefault(chunk_id, []).append(value)
+
+        last_record_id = 0
+
+        while True:
+            if gamespace_id is None:
+                chunks = await db.query("""
+                    SELECT `chunk_record_id`, `chunk_id`, `chunk_data`
+                    FROM `promo_code_usage_chunks`
+                    WHERE `chunk_id` IN %s AND `chunk_record_id`>%s
+                    ORDER BY `chunk_record_id`
+                    LIMIT %s;
+                """, list(values.keys()), last_record_id, PromoModel.BITMAP_REMOVE_BATCH)
+            else:
+                chunks = await db.query("""
+                    SELECT `chunk_record_id`, `chunk_id`, `chunk_data`
+                    FROM `promo_code_usage_chunks`
+                    WHERE `gamespace_id`=%s AND `chunk_id` IN %s AND `chunk_record_id`>%s
+                    ORDER BY `chunk_record_id`
+                    LIMIT %s;
+                """, gamespace_id, list(values.keys()), last_record_id, PromoModel.BITMAP_REMOVE_BATCH)
+
+            if not chunks:
+                return
+
+            last_record_id = chunks[-1]["chunk_record_id"]
+
+            affected = []
+
+            for row in chunks:
+                chunk = BitmapChunk.load(row["chunk_data"])
+
+                if any(value in chunk for value in values[row["chunk_id"]]):
+                    affected.append(row["chunk_record_id"])
+
+            if affected:
+                await self.__bitmap_remove_chunks__(db, affected, values)
+
+    # noinspection PyMethodMayBeStatic
+    async def __bitmap_remove_chunks__(self, db, record_ids, values):
+        async with db.acquire(auto_commit=False) as conn:
+            try:
+                chunks = await conn.query("""
+                    SELECT `chunk_record_id`, `chunk_id`, `chunk_data`
+                    FROM `promo_code_usage_chunks`
+                    WHERE `chunk_record_id` IN %s
+                    ORDER BY `chunk_record_id`
+                    FOR UPDATE;
+                """, record_ids)
+
+                for row in chunks:
+                    chunk = BitmapChunk.load(row["chunk_data"])
+                    removed = [value for value in values[row["chunk_id"]] if chunk.remove(value)]
+
+                    if not removed:
+                        continue
+
+                    if chunk.cardinality:
+                        await conn.execute("""
+                            UPDATE `promo_code_usage_chunks`
+                            SET `chunk_cardinality`=%s, `chunk_data`=%s
+                            WHERE `chunk_record_id`=%s;
+                        """, chunk.cardinality, chunk.dump(), row["chunk_record_id"])
+                    else:
+                        await conn.execute("""
+                            DELETE
+                            FROM `promo_code_usage_chunks`
+                            WHERE `chunk_record_id`=%s;
+                        """, row["chunk_record_id"])
+            except BaseException:
+                await conn.rollback()
+                raise
+            else:
+                await conn.commit()
+
     async def wrap_contents(self, gamespace_id, contents):
         keys = list(contents.keys())
 
         try:
-            wrapped = await self.db.query("""
-                SELECT * FROM `promo_contents`
+            wrapped = await self.shards.db(PLAYER, gamespace_id).query("""
+                SELECT `content_id`, `content_name` FROM `promo_contents`
                 WHERE `gamespace_id`=%s AND  `content_name` IN %s;
             """, gamespace_id, keys)
         except DatabaseError as e:
@@ -93,24 +569,28 @@ class PromoModel(Model):
 
         return result
 
-    async def new_promo(self, gamespace_id, promo_key, promo_use_amount, promo_expires, promo_contents):
+    async def new_promo(self, gamespace_id, promo_key, promo_use_amount, promo_expires, promo_contents,
+                        workload=PLAYER, bitmap=False):
 
         if not isinstance(promo_contents, dict):
             raise PromoError(400, "Contents is not a dict")
 
         try:
-            await self.find_promo(gamespace_id, promo_key)
+            await self.find_promo(gamespace_id, promo_key, workload=workload, columns=[])
         except PromoNotFound:
             pass
         else:
             raise PromoError(409, "Promo code '{0}' already exists.".format(promo_key))
 
+        key_columns, key_values = self.key_columns(promo_key)
+
         try:
-            result = await self.db.insert("""
+            result = await self.shards.db(workload, gamespace_id).insert("""
                 INSERT INTO `promo_code`
-                (`gamespace_id`, `code_key`, `code_amount`, `code_expires`, `code_contents`)
-                VALUES (%s, %s, %s, %s, %s);
-            """, gamespace_id, promo_key, promo_use_amount, promo_expires, ujson.dumps(promo_contents))
+                (`gamespace_id`, {0}, `code_amount`, `code_expires`, `code_contents`, `code_bitmap`)
+                VALUES (%s, {1}, %s, %s, %s, %s);
+            """.format(", ".join("`" + column + "`" for column in key_columns), ", ".join(["%s"] * len(key_columns))),
+                gamespace_id, *key_values, promo_use_amount, promo_expires, ujson.dumps(promo_contents), int(bitmap))
         except DuplicateError:
             raise PromoExists()
         except DatabaseError as e:
@@ -118,28 +598,34 @@ class PromoModel(Model):
 
         return result
 
-    async def find_promo(self, gamespace_id, promo_key):
+    async def find_promo(self, gamespace_id, promo_key, workload=PLAYER, columns=None):
+        """
+        Finds a promo code by its key, with only the columns given (see PromoAdapter.COLUMNS), or all of them
+        """
+
         try:
-            result = await self.db.get("""
-                SELECT *
-                FROM `promo_code`
-                WHERE `code_key`=%s AND `gamespace_id`=%s;
-            """, promo_key, gamespace_id)
+            for condition, key in self.__key_lookups__(promo_key):
+                # the keys reserved in the stock are not codes yet
+                result = await self.shards.db(workload, gamespace_id).get("""
+                    SELECT {0}
+                    FROM `promo_code`
+                    WHERE {1} AND `gamespace_id`=%s AND `code_stocked`=0;
+                """.format(PromoAdapter.select(columns), condition), key, gamespace_id)
+
+                if result is not None:
+                    return PromoAdapter(result)
         except DatabaseError as e:
             raise PromoError(500, "Failed to find promo code: " + e.args[1])
 
-        if result is None:
-            raise PromoNotFound()
-
-        return PromoAdapter(result)
+        raise PromoNotFound()
 
     async def get_promo(self, gamespace_id, promo_id):
         try:
-            result = await self.db.get("""
-                SELECT *
+            result = await self.shards.db(ADMIN, gamespace_id).get("""
+                SELECT {0}
                 FROM `promo_code`
                 WHERE `code_id`=%s AND `gamespace_id`=%s;
-            """, promo_id, gamespace_id)
+            """.format(PromoAdapter.select()), promo_id, gamespace_id)
         except DatabaseError as e:
             raise PromoError(500, "Failed to get promo code: " + e.args[1])
 
@@ -150,111 +636,715 @@ class PromoModel(Model):
 
     async def delete_promo(self, gamespace_id, promo_id):
         try:
-            await self.db.execute("""
+            await self.shards.db(ADMIN, gamespace_id).execute("""
                 DELETE
                 FROM `promo_code`
                 WHERE `code_id`=%s AND `gamespace_id`=%s;
             """, promo_id, gamespace_id)
-
-            await self.db.execute("""
-                DELETE
-                FROM `promo_code_users`
-                WHERE `code_id`=%s AND `gamespace_id`=%s;
-            """, promo_id, gamespace_id)
         except DatabaseError as e:
             raise PromoError(500, "Failed to delete content: " + e.args[1])
 
+        # the code is gone so nobody can use it anymore, the usages can be cleaned up at any pace
+        await self.delete_promo_usages(gamespace_id, [promo_id], workload=ADMIN)
+
+    async def delete_promo_usages(self, gamespace_id, promo_ids, chunk_size=USAGES_DELETE_CHUNK, workload=BULK):
+        """
+        Deletes usages of the promo codes in chunks, every chunk is committed separately.
+        """
+
+        try:
+            db = self.shards.db(workload, gamespace_id)
+
+            for table_name in ["promo_code_users", "promo_code_usage_chunks"]:
+                while True:
+                    deleted = await db.execute("""
+                        DELETE
+                        FROM `{0}`
+                        WHERE `gamespace_id`=%s AND `code_id` IN %s
+                        LIMIT %s;
+                    """.format(table_name), gamespace_id, promo_ids, chunk_size)
+
+                    if deleted < chunk_size:
+                        break
+        except DatabaseError as e:
+            raise PromoError(500, "Failed to delete promo code usages: " + e.args[1])
+
     async def update_promo(self, gamespace_id, promo_id, promo_key, promo_use_amount, promo_expires, promo_contents):
 
         if not isinstance(promo_contents, dict):
             raise PromoError(400, "Contents is not a dict")
 
+        key_columns, key_values = self.key_columns(promo_key)
+
         try:
-            await self.db.execute("""
+            await self.shards.db(ADMIN, gamespace_id).execute("""
                 UPDATE `promo_code`
-                SET `code_key`=%s, `code_amount`=%s, `code_expires`=%s, `code_contents`=%s
+                SET {0}, `code_amount`=%s, `code_expires`=%s, `code_contents`=%s
                 WHERE `code_id`=%s AND `gamespace_id`=%s;
-            """, promo_key, promo_use_amount, promo_expires, ujson.dumps(promo_contents), promo_id, gamespace_id)
+            """.format(", ".join("`" + column + "`=%s" for column in key_columns)),
+                *key_values, promo_use_amount, promo_expires, ujson.dumps(promo_contents), promo_id, gamespace_id)
         except DatabaseError as e:
             raise PromoError(500, "Failed to update content: " + e.args[1])
 
-    async def get_promo_usages(self, gamespace_id, promo_id):
-        usages = await self.db.query("""
-            SELECT `account_id`
+    async def get_promo_usages(self, gamespace_id, promo_id, limit=None):
+        """
+        Returns accounts that have used the promo code (up to `limit`, if given), both from the usage records
+        and from the usage bitmap.
+        """
+
+        db = self.shards.db(BULK, gamespace_id)
+
+        if limit:
+            usages = await db.query("""
+                SELECT `account_id`
+                FROM `promo_code_users`
+                WHERE `code_id`=%s AND `gamespace_id`=%s
+                LIMIT %s;
+            """, promo_id, gamespace_id, limit)
+        else:
+            usages = await db.query("""
+                SELECT `account_id`
+                FROM `promo_code_users`
+                WHERE `code_id`=%s AND `gamespace_id`=%s;
+            """, promo_id, gamespace_id)
+
+        result = [str(usage["account_id"]) for usage in usages]
+
+        if limit and len(result) >= limit:
+            return result
+
+        chunks = await db.query("""
+            SELECT `chunk_id`, `chunk_data`
+            FROM `promo_code_usage_chunks`
+            WHERE `gamespace_id`=%s AND `code_id`=%s
+            ORDER BY `chunk_id`;
+        """, gamespace_id, promo_id)
+
+        for row in chunks:
+            for value in BitmapChunk.load(row["chunk_data"]):
+                if limit and len(result) >= limit:
+                    return result
+
+                result.append(str(join_id(row["chunk_id"], value)))
+
+        return result
+
+    async def count_promo_usages(self, gamespace_id, promo_id):
+        """
+        Returns amount of accounts that have used the promo code
+        """
+
+        try:
+            db = self.shards.db(ADMIN, gamespace_id)
+
+            promo = await db.get("""
+                SELECT `code_bitmap`
+                FROM `promo_code`
+                WHERE `code_id`=%s AND `gamespace_id`=%s;
+            """, promo_id, gamespace_id)
+
+            if promo is None:
+                raise PromoNotFound()
+
+            if promo["code_bitmap"]:
+                # the bitmap is the source of truth, even if the records are not cleaned up yet
+                result = await db.get("""
+                    SELECT COALESCE(SUM(`chunk_cardinality`), 0) AS `count`
+                    FROM `promo_code_usage_chunks`
+                    WHERE `gamespace_id`=%s AND `code_id`=%s;
+                """, gamespace_id, promo_id)
+            else:
+                result = await db.get("""
+                    SELECT COUNT(*) AS `count`
+                    FROM `promo_code_users`
+                    WHERE `gamespace_id`=%s AND `code_id`=%s;
+                """, gamespace_id, promo_id)
+        except DatabaseError as e:
+            raise PromoError(500, "Failed to count promo code usages: " + e.args[1])
+
+        return int(result["count"])
+
+    async def convert_promo_usages(self, gamespace_id, promo_id):
+        """
+        Moves the usage records of the promo code into the usage bitmap, and keeps the new usages there.
+
+        The records are read before anything is locked. Then the promo code is locked (a redemption locks it
+        before it adds a record, so no more records can appear), the few records added since are read, the bitmap
+        is written and the code is switched over to it. The records are deleted afterwards, in chunks.
+        """
+
+        try:
+            db = self.shards.db(BULK, gamespace_id)
+
+            promo = await db.get("""
+                SELECT `code_bitmap`
+                FROM `promo_code`
+                WHERE `code_id`=%s AND `gamespace_id`=%s;
+            """, promo_id, gamespace_id)
+
+            if promo is None:
+                raise PromoNotFound()
+
+            if promo["code_bitmap"]:
+                return
+
+            chunks = {}
+            last_record_id = await self.__read_usages__(db, gamespace_id, promo_id, chunks)
+
+            async with db.acquire(auto_commit=False) as conn:
+                try:
+                    converted = await self.__convert_usages__(conn, gamespace_id, promo_id, chunks, last_record_id)
+                except BaseException:
+                    await conn.rollback()
+                    raise
+                else:
+                    await conn.commit()
+
+            if not converted:
+                return
+
+            while True:
+                deleted = await db.execute("""
+                    DELETE
+                    FROM `promo_code_users`
+                    WHERE `gamespace_id`=%s AND `code_id`=%s
+                    LIMIT %s;
+                """, gamespace_id, promo_id, PromoModel.USAGES_DELETE_CHUNK)
+
+                if deleted < PromoModel.USAGES_DELETE_CHUNK:
+                    break
+        except DatabaseError as e:
+            raise PromoError(500, "Failed to convert promo code usages: " + e.args[1])
+
+    # noinspection PyMethodMayBeStatic
+    async def __read_usages__(self, db, gamespace_id, promo_id, chunks):
+        """
+        Adds the accounts that have used the promo code to the chunks (chunk id => BitmapChunk),
+        returns the last usage record id read. The records are added one at a time under the code lock,
+        so every record up to that id has been read, whatever gets added while reading.
+        """
+
+        last = await db.get("""
+            SELECT MAX(`record_id`) AS `last_record_id`
             FROM `promo_code_users`
+            WHERE `gamespace_id`=%s AND `code_id`=%s;
+        """, gamespace_id, promo_id)
+
+        last_record_id = last["last_record_id"] or 0
+        last_account = -1
+
+        while True:
+            usages = await db.query("""
+                SELECT `account_id`
+                FROM `promo_code_users`
+                WHERE `gamespace_id`=%s AND `code_id`=%s AND `account_id`>%s AND `record_id`<=%s
+                ORDER BY `account_id`
+                LIMIT %s;
+            """, gamespace_id, promo_id, last_account, last_record_id, PromoModel.BITMAP_CONVERT_BATCH)
+
+            if not usages:
+                return last_record_id
+
+            for usage in usages:
+                chunk_id, value = split_id(int(usage["account_id"]))
+
+                if chunk_id not in chunks:
+                    chunks[chunk_id] = BitmapChunk()
+
+                chunks[chunk_id].add(value)
+
+            last_account = usages[-1]["account_id"]
+
+    # noinspection PyMethodMayBeStatic
+    async def __convert_usages__(self, db, gamespace_id, promo_id, chunks, last_record_id):
+        promo = await db.get("""
+            SELECT `code_bitmap`
+            FROM `promo_code`
+            WHERE `code_id`=%s AND `gamespace_id`=%s
+            FOR UPDATE;
+        """, promo_id, gamespace_id)
+
+        if promo is None:
+            raise PromoNotFound()
+
+        if promo["code_bitmap"]:
+            return False
+
+        # the records are added under the lock above, so the ones added since the read have greater ids
+        # (the primary key is walked from there, instead of every record of the code)
+        added = await db.query("""
+            SELECT `account_id`
+            FROM `promo_code_users` FORCE INDEX (PRIMARY)
+            WHERE `record_id`>%s AND `gamespace_id`=%s AND `code_id`=%s;
+        """, last_record_id, gamespace_id, promo_id)
+
+        for usage in added:
+            chunk_id, value = split_id(int(usage["account_id"]))
+
+            if chunk_id not in chunks:
+                chunks[chunk_id] = BitmapChunk()
+
+            chunks[chunk_id].add(value)
+
+        chunk_ids = sorted(chunks.keys())
+
+        for i in range(0, len(chunk_ids), PromoModel.BITMAP_WRITE_BATCH):
+            batch = chunk_ids[i:i + PromoModel.BITMAP_WRITE_BATCH]
+            values = []
+
+            for chunk_id in batch:
+                values.extend([gamespace_id, promo_id, chunk_id, chunks[chunk_id].cardinality, chunks[chunk_id].dump()])
+
+            await db.execute("""
+                INSERT INTO `promo_code_usage_chunks`
+                (`gamespace_id`, `code_id`, `chunk_id`, `chunk_cardinality`, `chunk_data`)
+                VALUES {0};
+            """.format(", ".join(["(%s, %s, %s, %s, %s)"] * len(batch))), *values)
+
+        await db.execute("""
+            UPDATE `promo_code`
+            SET `code_bitmap`=1
             WHERE `code_id`=%s AND `gamespace_id`=%s;
         """, promo_id, gamespace_id)
 
-        return [str(usage["account_id"]) for usage in usages]
+        return True
+
+    async def get_account_usages(self, gamespace_id, account_id, limit=50, before=None):
+        """
+        Returns promo codes used by the account, most recent first.
+        Codes that keep their usages in a bitmap have no usage records, so they're not listed
+        (see get_account_bitmap_usages). Pagination is done by the usage id (pass the last id as `before` to get the next page), so the
+        `account_id` index is used for every page no matter how deep it is.
+        """
+
+        try:
+            if before:
+                usages = await self.shards.db(PLAYER, gamespace_id).query("""
+                    SELECT u.`record_id`, u.`code_id`, c.`code_key`
+                    FROM `promo_code_users` AS u
+                    LEFT JOIN `promo_code` AS c ON c.`code_id`=u.`code_id`
+                    WHERE u.`gamespace_id`=%s AND u.`account_id`=%s AND u.`record_id`<%s
+                        AND NOT COALESCE(c.`code_bitmap`, 0)
+                    ORDER BY u.`record_id` DESC
+                    LIMIT %s;
+                """, gamespace_id, account_id, before, limit)
+            else:
+                usages = await self.shards.db(PLAYER, gamespace_id).query("""
+                    SELECT u.`record_id`, u.`code_id`, c.`code_key`
+                    FROM `promo_code_users` AS u
+                    LEFT JOIN `promo_code` AS c ON c.`code_id`=u.`code_id`
+                    WHERE u.`gamespace_id`=%s AND u.`account_id`=%s
+                        AND NOT COALESCE(c.`code_bitmap`, 0)
+                    ORDER BY u.`record_id` DESC
+                    LIMIT %s;
+                """, gamespace_id, account_id, limit)
+        except DatabaseError as e:
+            raise PromoError(500, "Failed to get account usages: " + e.args[1])
+
+        return list(map(PromoUsageAdapter, usages))
+
+    async def get_account_bitmap_usages(self, gamespace_id, account_id, limit=100):
+        """
+        Returns promo codes used by the account that keep their usages in a bitmap (up to `limit`).
+        There are no usage records to order them by, so they come in no particular order and with no usage id.
+        """
+
+        chunk_id, value = split_id(int(account_id))
+
+        try:
+            chunks = await self.shards.db(PLAYER, gamespace_id).query("""
+                SELECT h.`code_id`, c.`code_key`, h.`chunk_data`
+                FROM `promo_code_usage_chunks` AS h
+                INNER JOIN `promo_code` AS c ON c.`code_id`=h.`code_id`
+                WHERE h.`gamespace_id`=%s AND h.`chunk_id`=%s AND c.`code_bitmap`=1;
+            """, gamespace_id, chunk_id)
+        except DatabaseError as e:
+            raise PromoError(500, "Failed to get account usages: " + e.args[1])
+
+        result = []
+
+        for row in chunks:
+            if len(result) >= limit:
+                break
+
+            if value in BitmapChunk.load(row["chunk_data"]):
+                result.append(PromoUsageAdapter(row))
+
+        return result
+
+    def __contended__(self, gamespace_id, promo_key, retries):
+        self.contention[(gamespace_id, promo_key)] += retries
+
+        if len(self.contention) > PromoModel.CONTENTION_TRACK_LIMIT * 2:
+            self.contention = collections.Counter(dict(
+                self.contention.most_common(PromoModel.CONTENTION_TRACK_LIMIT)))
+
+    def most_contended(self, limit=20):
+        """
+        Returns a list of ((gamespace_id, promo_key), retries) of the codes that needed the most retries to redeem
+        """
+        return self.contention.most_common(limit)
 
     async def use_promo(self, gamespace_id, account_id, promo_key):
-        async with self.db.acquire(auto_commit=False) as db:
+        try:
+            result, retries = await retry_transaction(
+                lambda: self.__use_promo__(gamespace_id, account_id, promo_key),
+                self.retry_budget, self.retry_delay)
+        except TransactionRetriesExceeded as e:
+            self.__contended__(gamespace_id, promo_key, e.retries)
+            logging.warning("Gave up using promo code '{0}' after {1} retries".format(promo_key, e.retries))
+            raise PromoError(503, "Promo code is too busy, please try again")
+        except ShardMoving as e:
+            raise PromoError(503, e.args[1])
+        except DatabaseError as e:
+            raise PromoError(500, "Failed to use promo code: " + e.args[1])
+
+        if retries:
+            self.__contended__(gamespace_id, promo_key, retries)
+            logging.info("Promo code '{0}' used after {1} retries".format(promo_key, retries))
+
+        return result
+
+    async def __use_promo__(self, gamespace_id, account_id, promo_key):
+        async with self.shards.db(PLAYER, gamespace_id).acquire(auto_commit=False) as db:
             try:
-                promo = await db.get(
-                    """
-                        SELECT `code_id`, `code_contents`, `code_amount`
-                        FROM `promo_code`
-                        WHERE `code_key`=%s AND `gamespace_id`=%s AND `code_amount` > 0 AND `code_expires` > NOW()
-                        FOR UPDATE;
-                    """, promo_key, gamespace_id)
+                result = await self.__redeem__(db, gamespace_id, account_id, promo_key)
+            except BaseException:
+                # any exception (a cancelled request too) must not leave the transaction open on a pooled connection
+                await db.rollback()
+                raise
+            else:
+                await db.commit()
 
-                if not promo:
-                    raise PromoNotFound()
+            return result
 
-                promo_id = promo["code_id"]
-                promo_contents = promo["code_contents"]
-                promo_amount = promo["code_amount"]
+    async def __redeem__(self, db, gamespace_id, account_id, promo_key):
+        promo = None
 
-                ids = list(promo_contents.keys())
+        for condition, key in self.__key_lookups__(promo_key):
+            promo = await db.get(
+                """
+                    SELECT `code_id`, `code_key`, `code_contents`, `code_amount`, `code_bitmap`
+                    FROM `promo_code`
+                    WHERE {0} AND `gamespace_id`=%s AND `code_stocked`=0 AND `code_amount` > 0
+                        AND `code_expires` > NOW()
+                    FOR UPDATE;
+                """.format(condition), key, gamespace_id)
 
-                if not ids:
-                    raise PromoError(400, "Promo code has no contents.")
+            if promo:
+                break
 
-                used = await db.get(
-                    """
-                        SELECT *
-                        FROM `promo_code_users`
-                        WHERE `code_id`=%s AND `gamespace_id`=%s AND `account_id`=%s;
-                    """, promo_id, gamespace_id, account_id)
+        if not promo:
+            raise PromoNotFound()
 
-                if used:
-                    raise PromoError(409, "Code already used by this user")
+        promo_id = promo["code_id"]
+        promo_contents = promo["code_contents"]
+        promo_amount = promo["code_amount"]
 
-                await db.insert(
-                    """
-                        INSERT INTO `promo_code_users`
-                        (`gamespace_id`, `code_id`, `account_id`)
-                        VALUES (%s, %s, %s);
-                    """, gamespace_id, promo_id, account_id)
+        ids = list(promo_contents.keys())
 
-                promo_amount -= 1
+        if not ids:
+            raise PromoError(400, "Promo code has no contents.")
 
-                await db.execute(
-                    """
-                        UPDATE `promo_code`
-                        SET `code_amount` = %s
-                        WHERE `code_id`=%s AND `gamespace_id`=%s;
-                    """, promo_amount, promo_id, gamespace_id)
+        if promo["code_bitmap"]:
+            if not await self.__bitmap_add__(db, gamespace_id, promo_id, account_id):
+                raise PromoError(409, "Code already used by this user")
+        else:
+            used = await db.get(
+                """
+                    SELECT *
+                    FROM `promo_code_users`
+                    WHERE `code_id`=%s AND `gamespace_id`=%s AND `account_id`=%s;
+                """, promo_id, gamespace_id, account_id)
 
-                contents_result = []
+            if used:
+                raise PromoError(409, "Code already used by this user")
 
-                contents = await db.query(
-                    """
-                        SELECT `content_json`, `content_id`
-                        FROM `promo_contents`
-                        WHERE `content_id` IN %s
-                    """, ids)
-
-                for cnt in contents:
-                    result = {
-                        "payload": cnt["content_json"],
-                        "amount": promo_contents[str(cnt["content_id"])]
-                    }
-                    contents_result.append(result)
-
-                return {
-                    "result": contents_result
-                }
+            await db.insert(
+                """
+                    INSERT INTO `promo_code_users`
+                    (`gamespace_id`, `code_id`, `account_id`)
+                    VALUES (%s, %s, %s);
+                """, gamespace_id, promo_id, account_id)
 
-            finally:
-                await db.commit()
+        promo_amount -= 1
+
+        await db.execute(
+            """
+                UPDATE `promo_code`
+                SET `code_amount` = %s
+                WHERE `code_id`=%s AND `gamespace_id`=%s;
+            """, promo_amount, promo_id, gamespace_id)
+
+        contents = await db.query(
+            """
+                SELECT {0}
+                FROM `promo_contents`
+                WHERE `content_id` IN %s
+            """.format(ContentAdapter.select(["content_json"])), ids)
+
+        contents = [ContentAdapter(cnt) for cnt in contents]
+
+        # the last statement of the transaction, so the sequence of the gamespace is locked only for the commit
+        await self.events.record(db, gamespace_id, promo_id, promo["code_key"], account_id)
+
+        return PromoRedemption([(content, promo_contents[content.content_id]) for content in contents])
+
+    # noinspection PyMethodMayBeStatic
+    async def __bitmap_add__(self, db, gamespace_id, promo_id, account_id):
+        """
+        Adds the account to the usage bitmap of the promo code, returns False if it's there already
+        """
+
+        chunk_id, value = split_id(int(account_id))
+
+        existing = await db.get(
+            """
+                SELECT `chunk_data`
+                FROM `promo_code_usage_chunks`
+                WHERE `gamespace_id`=%s AND `code_id`=%s AND `chunk_id`=%s
+                FOR UPDATE;
+            """, gamespace_id, promo_id, chunk_id)
+
+        chunk = BitmapChunk.load(existing["chunk_data"]) if existing else BitmapChunk()
+
+        if not chunk.add(value):
+            return False
+
+        await db.execute(
+            """
+                INSERT INTO `promo_code_usage_chunks`
+                (`gamespace_id`, `code_id`, `chunk_id`, `chunk_cardinality`, `chunk_data`)
+                VALUES (%s, %s, %s, %s, %s)
+                ON DUPLICATE KEY UPDATE `chunk_cardinality`=VALUES(`chunk_cardinality`),
+                    `chunk_data`=VALUES(`chunk_data`);
+            """, gamespace_id, promo_id, chunk_id, chunk.cardinality, chunk.dump())
+
+        return True
+
+    async def new_pool(self, gamespace_id, pool_name):
+        try:
+            result = await self.shards.db(ADMIN, gamespace_id).insert("""
+                INSERT INTO `promo_code_pools`
+                (`gamespace_id`, `pool_name`)
+                VALUES (%s, %s);
+            """, gamespace_id, pool_name)
+        except DuplicateError:
+            raise PromoError(409, "Pool '{0}' already exists.".format(pool_name))
+        except DatabaseError as e:
+            raise PromoError(500, "Failed to add new pool: " + e.args[1])
+
+        return result
+
+    async def get_pool(self, gamespace_id, pool_id):
+        try:
+            result = await self.shards.db(ADMIN, gamespace_id).get("""
+                SELECT p.`pool_id`, p.`pool_name`,
+                    (SELECT COUNT(*) FROM `promo_code_pool_keys` AS k
+                     WHERE k.`pool_id`=p.`pool_id`) AS `pool_total`,
+                    (SELECT COUNT(*) FROM `promo_code_pool_keys` AS k
+                     WHERE k.`pool_id`=p.`pool_id` AND k.`account_id` IS NOT NULL) AS `pool_claimed`
+                FROM `promo_code_pools` AS p
+                WHERE p.`pool_id`=%s AND p.`gamespace_id`=%s;
+            """, pool_id, gamespace_id)
+        except DatabaseError as e:
+            raise PromoError(500, "Failed to get pool: " + e.args[1])
+
+        if result is None:
+            raise PromoNotFound()
+
+        return PromoPoolAdapter(result)
+
+    async def list_pools(self, gamespace_id):
+        try:
+            result = await self.shards.db(ADMIN, gamespace_id).query("""
+                SELECT `pool_id`, `pool_name`
+                FROM `promo_code_pools`
+                WHERE `gamespace_id`=%s;
+            """, gamespace_id)
+        except DatabaseError as e:
+            raise PromoError(500, "Failed to list pools: " + e.args[1])
+
+        return list(map(PromoPoolAdapter, result))
+
+    async def fill_pool_chunk(self, db, gamespace_id, pool_id, keys_count, promo_expires, promo_contents):
+        """
+        Generates up to `keys_count` new single-use promo codes and puts them into the pool, using the transaction
+        of `db`, so a code is never left outside of the pool. Used by the pool filling bulk job (see BulkJobsModel).
+        Returns amount of codes added, keys that happen to exist already are skipped.
+        """
+
+        pool = await db.get("""
+            SELECT `pool_id`
+            FROM `promo_code_pools`
+            WHERE `pool_id`=%s AND `gamespace_id`=%s
+            LOCK IN SHARE MODE;
+        """, pool_id, gamespace_id)
+
+        if pool is None:
+            raise PromoNotFound()
+
+        keys = list(set(self.random() for i in range(0, keys_count)))
+
+        keys_condition, keys_args = self.__keys_condition__(keys)
+
+        # also locks the gaps the new keys go to, so a code with the same key cannot be added in the meantime
+        existing = await db.query("""
+            SELECT `code_key`
+            FROM `promo_code`
+            WHERE `gamespace_id`=%s AND {0}
+            FOR UPDATE;
+        """.format(keys_condition), gamespace_id, *keys_args)
+
+        existing = set(row["code_key"].upper() for row in existing)
+        keys = [key for key in keys if key not in existing]
+
+        if not keys:
+            return 0
+
+        key_columns, _ = self.key_columns(keys[0])
+        contents = ujson.dumps(promo_contents)
+        row = "(%s, {0}, 1, %s, %s)".format(", ".join(["%s"] * len(key_columns)))
+        values = []
+
+        for key in keys:
+            _, key_values = self.key_columns(key)
+            values.extend([gamespace_id, *key_values, promo_expires, contents])
+
+        await db.execute("""
+            INSERT INTO `promo_code`
+            (`gamespace_id`, {0}, `code_amount`, `code_expires`, `code_contents`)
+            VALUES {1};
+        """.format(", ".join("`" + column + "`" for column in key_columns), ", ".join([row] * len(keys))), *values)
+
+        if self.integer_keys():
+            # the new codes all have integer keys, so there's no need for the string index
+            codes = await db.query("""
+                SELECT `code_id`, `code_key_int`
+                FROM `promo_code`
+                WHERE `gamespace_id`=%s AND `code_key_int` IN %s;
+            """, gamespace_id, [PromoModel.encode_key(key) for key in keys])
+
+            codes = [(code["code_id"], PromoModel.decode_key(code["code_key_int"])) for code in codes]
+        else:
+            codes = await db.query("""
+                SELECT `code_id`, `code_key`
+                FROM `promo_code`
+                WHERE `gamespace_id`=%s AND `code_key` IN %s;
+            """, gamespace_id, keys)
+
+            codes = [(code["code_id"], code["code_key"]) for code in codes]
+
+        await db.execute("""
+            INSERT INTO `promo_code_pool_keys`
+            (`gamespace_id`, `pool_id`, `code_id`, `code_key`)
+            VALUES {0};
+        """.format(", ".join(["(%s, %s, %s, %s)"] * len(codes))),
+            *[value for code_id, code_key in codes for value in (gamespace_id, pool_id, code_id, code_key)])
+
+        return len(codes)
+
+    async def claim_pool_code(self, gamespace_id, account_id, pool_name):
+        """
+        Assigns the next free code from the pool to the account, and returns its key.
+        An account may claim one code per pool, claiming again returns the same key.
+
+        Free codes are locked with SKIP LOCKED (requires MySQL 8.0), so concurrent claims never wait for
+        each other, each just takes a different code.
+        """
+
+        try:
+            async with self.shards.db(PLAYER, gamespace_id).acquire(auto_commit=False) as db:
+                try:
+                    code_key = await self.__claim__(db, gamespace_id, account_id, pool_name)
+                except DuplicateError:
+                    # the same account has claimed a code concurrently
+                    await db.rollback()
+                except BaseException:
+                    await db.rollback()
+                    raise
+                else:
+                    await db.commit()
+                    return code_key
+
+            claimed = await self.shards.db(PLAYER, gamespace_id).get("""
+                SELECT k.`code_key`
+                FROM `promo_code_pool_keys` AS k, `promo_code_pools` AS p
+                WHERE p.`pool_name`=%s AND p.`gamespace_id`=%s AND k.`pool_id`=p.`pool_id` AND k.`account_id`=%s;
+            """, pool_name, gamespace_id, account_id)
+        except DatabaseError as e:
+            raise PromoError(500, "Failed to claim a code: " + e.args[1])
+
+        if not claimed:
+            raise PromoError(409, "Failed to claim a code, please try again")
+
+        return claimed["code_key"]
+
+    # noinspection PyMethodMayBeStatic
+    async def __claim__(self, db, gamespace_id, account_id, pool_name):
+        pool = await db.get("""
+            SELECT `pool_id`
+            FROM `promo_code_pools`
+            WHERE `pool_name`=%s AND `gamespace_id`=%s;
+        """, pool_name, gamespace_id)
+
+        if not pool:
+            raise PromoNotFound()
+
+        pool_id = pool["pool_id"]
+
+        claimed = await db.get("""
+            SELECT `code_key`
+            FROM `promo_code_pool_keys`
+            WHERE `pool_id`=%s AND `account_id`=%s;
+        """, pool_id, account_id)
+
+        if claimed:
+            return claimed["code_key"]
+
+        free = await db.get("""
+            SELECT `key_id`, `code_key`
+            FROM `promo_code_pool_keys`
+            WHERE `pool_id`=%s AND `account_id` IS NULL
+            ORDER BY `key_id`
+            LIMIT 1
+            FOR UPDATE SKIP LOCKED;
+        """, pool_id)
+
+        if not free:
+            raise PromoError(410, "No codes left in the pool")
+
+        await db.execute("""
+            UPDATE `promo_code_pool_keys`
+            SET `account_id`=%s, `key_claimed`=NOW()
+            WHERE `key_id`=%s;
+        """, account_id, free["key_id"])
+
+        return free["code_key"]
+
+    async def delete_pool(self, gamespace_id, pool_id):
+        """
+        Deletes the pool. Codes already generated for the pool are left as they are.
+        """
+
+        try:
+            db = self.shards.db(ADMIN, gamespace_id)
+
+            await db.execute("""
+                DELETE
+                FROM `promo_code_pools`
+                WHERE `pool_id`=%s AND `gamespace_id`=%s;
+            """, pool_id, gamespace_id)
+
+            while True:
+                deleted = await db.execute("""
+                    DELETE
+                    FROM `promo_code_pool_keys`
+                    WHERE `pool_id`=%s AND `gamespace_id`=%s
+                    LIMIT %s;
+                """, pool_id, gamespace_id, PromoModel.USAGES_DELETE_CHUNK)
+
+                if deleted < PromoModel.USAGES_DELETE_CHUNK:
+                    break
+        except DatabaseError as e:
+            raise PromoError(500, "Failed to delete pool: " + e.args[1])
@@ -0,0 +1,58 @@
+from anthill.common.database import DatabaseError
+
+from tornado.gen import sleep
+
+import random
+import time
+
+
+# InnoDB errors after which the whole transaction may be safely tried again
+ER_LOCK_WAIT_TIMEOUT = 1205
+ER_LOCK_DEADLOCK = 1213
+
+RETRYABLE_ERRORS = {ER_LOCK_WAIT_TIMEOUT, ER_LOCK_DEADLOCK}
+
+
+class TransactionRetriesExceeded(Exception):
+    def __init__(self, retries, error):
+        self.retries = retries
+        self.error = error
+
+    def __str__(self):
+        return "Transaction failed after {0} retries: {1}".format(self.retries, str(self.error))
+
+
+def is_retryable(error):
+    return isinstance(error, DatabaseError) and bool(error.args) and error.args[0] in RETRYABLE_ERRORS
+
+
+async def retry_transaction(transaction, budget, base_delay=0.01, max_delay=0.5):
+    """
+    Runs a transaction again after a deadlock or a lock wait timeout, with jittered exponential backoff,
+    as long as the time budget allows. The transaction is expected to roll itself back on errors.
+
+    :param transaction: a coroutine function (without arguments) that runs the whole transaction
+    :param budget: total time in seconds the retries are allowed to take
+    :returns: a tuple (result of the transaction, amount of retries it took)
+    :raises TransactionRetriesExceeded: when the budget is exhausted
+    """
+
+    deadline = time.monotonic() + budget
+    retries = 0
+
+    while True:
+        try:
+            result = await transaction()
+        except DatabaseError as e:
+            if not is_retryable(e):
+                raise
+
+            delay = random.uniform(0, min(max_delay, base_delay * (2 ** retries)))
+
+            if time.monotonic() + delay > deadline:
+                raise TransactionRetriesExceeded(retries, e)
+
+            retries += 1
+            await sleep(delay)
+        else:
+            return result, retries
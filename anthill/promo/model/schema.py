@@ -0,0 +1,88 @@
+from anthill.common.database import DatabaseError
+
+import logging
+
+
+async def ensure_column(db, table_name, column_name, definition):
+    """
+    Adds a column to an already existing table, if it's not there yet.
+
+    Usage:
+
+    await ensure_column(db, "promo_code", "code_key_int", "bigint(20) unsigned DEFAULT NULL")
+
+    """
+
+    existing = await db.get(
+        """
+            SHOW COLUMNS FROM `{0}` WHERE `Field`=%s;
+        """.format(table_name), column_name)
+
+    if existing:
+        return
+
+    try:
+        await db.execute(
+            """
+                ALTER TABLE `{0}` ADD COLUMN `{1}` {2};
+            """.format(table_name, column_name, definition))
+    except DatabaseError as e:
+        logging.error("Failed to add column '{0}' to table '{1}': {2}".format(column_name, table_name, e.args[1]))
+    else:
+        logging.warning("Added column '{0}' to table '{1}'".format(column_name, table_name))
+
+
+async def ensure_index(db, table_name, index_name, definition, unique=False):
+    """
+    Adds an index to an already existing table, if it's not there yet.
+    Tables created from sql/*.sql already have every index, so this is only required to migrate older tables.
+
+    Usage:
+
+    await ensure_index(db, "promo_code_users", "code_id", "(`gamespace_id`, `code_id`, `account_id`)")
+
+    """
+
+    existing = await db.get(
+        """
+            SHOW INDEX FROM `{0}` WHERE `Key_name`=%s;
+        """.format(table_name), index_name)
+
+    if existing:
+        return
+
+    try:
+        await db.execute(
+            """
+                ALTER TABLE `{0}` ADD {1} `{2}` {3};
+            """.format(table_name, "UNIQUE INDEX" if unique else "INDEX", index_name, definition))
+    except DatabaseError as e:
+        logging.error("Failed to add index '{0}' to table '{1}': {2}".format(index_name, table_name, e.args[1]))
+    else:
+        logging.warning("Added index '{0}' to table '{1}'".format(index_name, table_name))
+
+
+async def setup_tables(db, application, tables):
+    """
+    Creates the tables from sql/*.sql on a database, if they're not there yet.
+    Does the same as Model.started, but for a database other than the model's setup database (like a shard).
+    """
+
+    for table_name in tables:
+        existing = await db.get(
+            """
+                SHOW TABLES LIKE %s;
+            """, table_name)
+
+        if existing:
+            continue
+
+        with (open(application.module_path("sql/{0}.sql".format(table_name)))) as f:
+            sql = f.read()
+
+        try:
+            await db.execute(sql)
+        except DatabaseError as e:
+            logging.error("Failed to create table '{0}': {1}".format(table_name, e.args[1]))
+        else:
+            logging.warning("Created table '{0}'".format(table_name))
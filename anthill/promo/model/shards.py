@@ -0,0 +1,676 @@
+from anthill.common.database import DatabaseError, DuplicateError
+from anthill.common.model import Model
+
+from tornado.ioloop import IOLoop
+from tornado.gen import sleep
+
+from . pools import DatabasePools, ADMIN, BULK
+
+import logging
+import ujson
+import uuid
+import os
+
+
+DEFAULT_SHARD = "default"
+
+
+class ShardError(Exception):
+    pass
+
+
+class ShardMoving(DatabaseError):
+    """
+    Raised when a gamespace is not accessible because it is being moved between shards.
+    Derived from DatabaseError, so the models treat it like any other database failure.
+    """
+
+    def __init__(self, gamespace_id):
+        super(ShardMoving, self).__init__(
+            503, "Gamespace {0} is being moved to another shard, please try again later".format(gamespace_id))
+
+
+class ShardMap(Model):
+    """
+    Routes every gamespace to a database (a shard), so the largest gamespaces can be moved to their own.
+
+    The default shard is configured with db_* options, and the rest are described in a JSON file
+    (see db_shards_config option):
+
+    {
+        "big-title": {
+            "host": "10.0.0.5",
+            "database": "prod_promo",
+            "user": "promo",
+            "password": "..."
+        }
+    }
+
+    Which gamespace lives on which shard is stored in the `promo_shard_map` table on the default shard. Gamespaces
+    that are not there live on the default shard. Both the file and the table are re-read periodically, so
+    changes are picked up without a restart.
+
+    Moved rows keep their ids, so shards should not generate overlapping ids: configure each shard's MySQL with
+    its own auto_increment_offset (and the same auto_increment_increment). A move that runs into a collision
+    is stopped and rolled back to the source shard.
+    """
+
+    # a move that has not made progress for that long (in seconds) has lost its process
+    STALE_TIMEOUT = 300
+    # how often (in seconds) the maintenance worker looks for abandoned moves
+    RECOVER_INTERVAL = 60
+
+    def __init__(self, default_config, limits, config_path=None, reload_interval=10, slow_log=None,
+                 move_batch_size=500, lock_wait_timeouts=None):
+        self.limits = limits
+        self.slow_log = slow_log
+        self.lock_wait_timeouts = lock_wait_timeouts
+        self.config_path = config_path or None
+        self.config_mtime = None
+        self.reload_interval = reload_interval
+        self.move_batch_size = move_batch_size
+
+        self.shards = {
+            DEFAULT_SHARD: DatabasePools(limits=limits, slow_log=slow_log, lock_wait_timeouts=lock_wait_timeouts,
+                                         **default_config)
+        }
+
+        # str(gamespace_id) => shard name
+        self.gamespaces = {}
+        # str(gamespace_id) of the gamespaces that cannot be accessed right now
+        self.moving = set()
+
+        self.application = None
+        self.stopping = False
+
+    def get_setup_db(self):
+        return self.default(ADMIN)
+
+    def get_setup_tables(self):
+        return ["promo_shard_map", "promo_shard_moves"]
+
+    async def started(self, application):
+        await super(ShardMap, self).started(application)
+        self.application = application
+        await self.reload()
+        IOLoop.current().spawn_callback(self.__reload_loop__)
+
+        if application.runs_maintenance():
+            IOLoop.current().spawn_callback(self.__recover_loop__)
+
+    async def stopped(self):
+        self.stopping = True
+        await super(ShardMap, self).stopped()
+
+    def db(self, workload, gamespace_id):
+        key = str(gamespace_id)
+
+        if key in self.moving:
+            raise ShardMoving(gamespace_id)
+
+        return self.shards[self.gamespaces.get(key, DEFAULT_SHARD)].db(workload)
+
+    def default(self, workload):
+        return self.shards[DEFAULT_SHARD].db(workload)
+
+    def all(self, workload):
+        return [pools.db(workload) for pools in self.shards.values()]
+
+    def shard(self, shard_name):
+        """
+        Returns the pools of a shard by its name, with no regard to which gamespaces live there
+        """
+        try:
+            return self.shards[shard_name]
+        except KeyError:
+            raise ShardError("No such shard: " + str(shard_name))
+
+    def shard_of(self, gamespace_id):
+        return self.gamespaces.get(str(gamespace_id), DEFAULT_SHARD)
+
+    def list_shards(self):
+        return sorted(self.shards.keys())
+
+    async def __reload_loop__(self):
+        while not self.stopping:
+            await sleep(self.reload_interval)
+
+            # noinspection PyBroadException
+            try:
+                await self.reload()
+            except Exception:
+                logging.exception("Failed to reload the shard map")
+
+    def __load_config__(self):
+        """
+        Reads the shards config file (if it has changed), and returns names of the shards added
+        """
+
+        if not self.config_path:
+            return []
+
+        try:
+            mtime = os.path.getmtime(self.config_path)
+        except OSError as e:
+            logging.error("Failed to read shards config '{0}': {1}".format(self.config_path, str(e)))
+            return []
+
+        if mtime == self.config_mtime:
+            return []
+
+        try:
+            with open(self.config_path) as f:
+                config = ujson.load(f)
+        except (OSError, ValueError) as e:
+            logging.error("Failed to read shards config '{0}': {1}".format(self.config_path, str(e)))
+            return []
+
+        self.config_mtime = mtime
+        added = []
+
+        # connection settings of the shards already known are not changed, that requires a restart
+        for shard_name, shard_config in config.items():
+            if shard_name in self.shards:
+                continue
+
+            self.shards[shard_name] = DatabasePools(
+                host=shard_config.get("host"),
+                database=shard_config.get("database"),
+                user=shard_config.get("user"),
+                password=shard_config.get("password"),
+                limits=self.limits,
+                slow_log=self.slow_log,
+                lock_wait_timeouts=self.lock_wait_timeouts)
+
+            added.append(shard_name)
+            logging.info("Added shard '{0}'".format(shard_name))
+
+        return added
+
+    async def reload(self):
+        added = self.__load_config__()
+
+        for shard_name in added:
+            await self.__setup_shard__(shard_name)
+
+        try:
+            rows = await self.default(ADMIN).query("""
+                SELECT `gamespace_id`, `shard_name`, `shard_moving`
+                FROM `promo_shard_map`;
+            """)
+        except DatabaseError as e:
+            raise ShardError("Failed to load shard map: " + e.args[1])
+
+        gamespaces = {}
+        moving = set()
+
+        for row in rows:
+            key = str(row["gamespace_id"])
+            shard_name = row["shard_name"]
+
+            if shard_name not in self.shards:
+                # better to fail the requests than to serve them from a wrong database
+                logging.error("Gamespace {0} is mapped to unknown shard '{1}'".format(key, shard_name))
+                moving.add(key)
+                continue
+
+            gamespaces[key] = shard_name
+
+            if row["shard_moving"]:
+                moving.add(key)
+
+        self.gamespaces = gamespaces
+        self.moving = moving
+
+    async def __setup_shard__(self, shard_name):
+        if self.application is None:
+            return
+
+        db = self.shards[shard_name].db(ADMIN)
+
+        for model in self.application.get_models():
+            if model is not self and hasattr(model, "setup_shard"):
+                await model.setup_shard(self.application, db)
+
+    async def assign(self, gamespace_id, shard_name, moving=False):
+        if shard_name not in self.shards:
+            raise ShardError("No such shard: " + str(shard_name))
+
+        try:
+            await self.default(ADMIN).execute("""
+                INSERT INTO `promo_shard_map`
+                (`gamespace_id`, `shard_name`, `shard_moving`)
+                VALUES (%s, %s, %s)
+                ON DUPLICATE KEY UPDATE `shard_name`=VALUES(`shard_name`), `shard_moving`=VALUES(`shard_moving`);
+            """, gamespace_id, shard_name, 1 if moving else 0)
+        except DatabaseError as e:
+            raise ShardError("Failed to update shard map: " + e.args[1])
+
+        key = str(gamespace_id)
+        self.gamespaces[key] = shard_name
+
+        if moving:
+            self.moving.add(key)
+        else:
+            self.moving.discard(key)
+
+    async def move(self, gamespace_id, target):
+        source = self.shard_of(gamespace_id)
+
+        if source == target:
+            raise ShardError("The gamespace is on this shard already")
+
+        # make sure both exist
+        self.shard(source)
+        self.shard(target)
+
+        move = GamespaceMove(self, gamespace_id, source, target, self.move_batch_size,
+                             settle_delay=self.reload_interval * 2)
+
+        try:
+            async with self.default(ADMIN).acquire(auto_commit=False) as db:
+                try:
+                    current = await db.get("""
+                        SELECT `move_status`
+                        FROM `promo_shard_moves`
+                        WHERE `gamespace_id`=%s
+                        FOR UPDATE;
+                    """, gamespace_id)
+
+                    if current and current["move_status"] == GamespaceMove.STATUS_RUNNING:
+                        raise ShardError("This gamespace is being moved already")
+
+                    await db.execute("""
+                        INSERT INTO `promo_shard_moves`
+                        (`gamespace_id`, `move_source`, `move_target`, `move_token`, `move_status`, `move_stage`,
+                            `move_copied`, `move_error`, `move_updated`)
+                        VALUES (%s, %s, %s, %s, %s, %s, %s, '', NOW())
+                        ON DUPLICATE KEY UPDATE `move_source`=VALUES(`move_source`),
+                            `move_target`=VALUES(`move_target`), `move_token`=VALUES(`move_token`),
+                            `move_status`=VALUES(`move_status`), `move_stage`=VALUES(`move_stage`),
+                            `move_copied`=VALUES(`move_copied`), `move_error`='', `move_updated`=NOW();
+                    """, gamespace_id, source, target, move.token, move.status, move.stage, ujson.dumps(move.copied))
+                except BaseException:
+                    await db.rollback()
+                    raise
+                else:
+                    await db.commit()
+        except DatabaseError as e:
+            raise ShardError("Failed to start the move: " + e.args[1])
+
+        IOLoop.current().spawn_callback(move.run)
+        return move
+
+    async def get_move(self, gamespace_id):
+        """
+        Returns the last move of a gamespace, no matter which process runs it (or None)
+        """
+
+        try:
+            move = await self.default(ADMIN).get("""
+                SELECT *
+                FROM `promo_shard_moves`
+                WHERE `gamespace_id`=%s;
+            """, gamespace_id)
+        except DatabaseError as e:
+            raise ShardError("Failed to get the move: " + e.args[1])
+
+        return GamespaceMoveAdapter(move) if move else None
+
+    async def __recover_loop__(self):
+        while not self.stopping:
+            try:
+                await self.recover_moves()
+            except ShardError as e:
+                logging.error("Failed to recover abandoned shard moves: " + e.args[0])
+
+            await sleep(ShardMap.RECOVER_INTERVAL)
+
+    async def recover_moves(self):
+        """
+        Finishes the moves that have not made progress for STALE_TIMEOUT, and lets the gamespaces that are still
+        marked as moving with no move running be accessed again
+        """
+
+        db = self.default(ADMIN)
+
+        try:
+            moves = await db.query("""
+                SELECT *
+                FROM `promo_shard_moves`
+                WHERE `move_status`=%s AND `move_updated` < NOW() - INTERVAL %s SECOND;
+            """, GamespaceMove.STATUS_RUNNING, ShardMap.STALE_TIMEOUT)
+
+            for data in moves:
+                move = GamespaceMove(self, data["gamespace_id"], data["move_source"], data["move_target"],
+                                     self.move_batch_size, settle_delay=0)
+                move.copied.update(data.get("move_copied") or {})
+
+                # the same conditions again, in case the move has just moved on, or has been recovered by someone else
+                claimed = await db.execute("""
+                    UPDATE `promo_shard_moves`
+                    SET `move_token`=%s, `move_stage`=%s, `move_updated`=NOW()
+                    WHERE `gamespace_id`=%s AND `move_token`=%s AND `move_status`=%s
+                        AND `move_updated` < NOW() - INTERVAL %s SECOND;
+                """, move.token, "recovering", data["gamespace_id"], data["move_token"],
+                    GamespaceMove.STATUS_RUNNING, ShardMap.STALE_TIMEOUT)
+
+                if not claimed:
+                    continue
+
+                logging.warning("Moving gamespace {0} has been abandoned, recovering".format(data["gamespace_id"]))
+                IOLoop.current().spawn_callback(move.recover)
+
+            # a move sets shard_moving only once it is running, and clears it before it stops
+            released = await db.execute("""
+                UPDATE `promo_shard_map` AS m
+                LEFT JOIN `promo_shard_moves` AS v
+                    ON v.`gamespace_id`=m.`gamespace_id` AND v.`move_status`=%s
+                SET m.`shard_moving`=0
+                WHERE m.`shard_moving`=1 AND v.`gamespace_id` IS NULL;
+            """, GamespaceMove.STATUS_RUNNING)
+        except DatabaseError as e:
+            raise ShardError(e.args[1])
+
+        if released:
+            logging.warning("Released {0} gamespace(s) left marked as moving".format(released))
+            await self.reload()
+
+
+class ShardMoveLost(ShardError):
+    """
+    Raised when a move has been taken over by another process, so this one should stop at once
+    """
+    pass
+
+
+class GamespaceMoveAdapter(object):
+    def __init__(self, data):
+        self.gamespace_id = str(data.get("gamespace_id"))
+        self.source = data.get("move_source")
+        self.target = data.get("move_target")
+        self.status = data.get("move_status")
+        self.stage = data.get("move_stage")
+        self.copied = data.get("move_copied") or {}
+        self.updated = data.get("move_updated")
+        self.error = data.get("move_error")
+
+
+class GamespaceMove(object):
+    """
+    Moves all rows of a gamespace from one shard to another.
+
+    1. The gamespace is marked as moving, so every request to it fails fast (with 503) while the data is copied.
+    2. Rows of the gamespace left on the target shard by an earlier move are deleted.
+    3. The rows are copied to the target shard in batches, keeping their ids.
+    4. The gamespace is switched over to the target shard.
+    5. The rows are deleted from the source shard in batches.
+
+    Should anything go wrong before the switch, the rows copied so far are deleted from the target shard and
+    the gamespace is returned to the source one.
+
+    The state of the move is stored in the `promo_shard_moves` table with every batch, so it can be seen from
+    any process. Only the process holding the move's token may change it. A move that has not been updated for
+    ShardMap.STALE_TIMEOUT has lost its process, so the maintenance worker takes it over (with a new token) and
+    finishes it: cleans up the source shard if the gamespace has been switched, or returns it to the source one.
+    """
+
+    # tables in order of copying, with their primary keys
+    TABLES = [
+        ("promo_contents", "content_id"),
+        ("promo_code", "code_id"),
+        ("promo_code_users", "record_id"),
+        ("promo_code_usage_chunks", "chunk_record_id"),
+        ("promo_code_pools", "pool_id"),
+        ("promo_code_pool_keys", "key_id"),
+        ("promo_bulk_jobs", "job_id"),
+        ("promo_code_stock", "stock_id"),
+        ("promo_code_stock_refills", "gamespace_id"),
+        ("promo_redemption_events", "event_id"),
+        ("promo_redemption_sequences", "gamespace_id")
+    ]
+
+    STATUS_RUNNING = "running"
+    STATUS_COMPLETE = "complete"
+    STATUS_FAILED = "failed"
+
+    def __init__(self, shards, gamespace_id, source, target, batch_size, settle_delay):
+        self.shards = shards
+        self.gamespace_id = gamespace_id
+        self.source = source
+        self.target = target
+        self.batch_size = batch_size
+        self.settle_delay = settle_delay
+        self.token = uuid.uuid4().hex
+
+        self.status = GamespaceMove.STATUS_RUNNING
+        self.stage = "starting"
+        self.copied = {table_name: 0 for table_name, pk in GamespaceMove.TABLES}
+        self.error = None
+
+    async def run(self):
+        logging.info("Moving gamespace {0} from shard '{1}' to '{2}'".format(
+            self.gamespace_id, self.source, self.target))
+
+        switched = False
+
+        try:
+            source_db = self.shards.shard(self.source).db(BULK)
+            target_db = self.shards.shard(self.target).db(BULK)
+
+            await self.shards.assign(self.gamespace_id, self.source, moving=True)
+
+            # let the other processes pick up the change and the requests in progress finish
+            await self.__save__("waiting for other processes")
+            await sleep(self.settle_delay)
+
+            for table_name, pk in GamespaceMove.TABLES:
+                await self.__save__("deleting leftovers of " + table_name)
+                await self.__purge__(target_db, table_name)
+
+            for table_name, pk in GamespaceMove.TABLES:
+                await self.__save__("copying " + table_name)
+                await self.__copy__(source_db, target_db, table_name, pk)
+
+            await self.__save__("switching")
+            await self.shards.assign(self.gamespace_id, self.target, moving=False)
+            switched = True
+
+            for table_name, pk in GamespaceMove.TABLES:
+                await self.__save__("cleaning up " + table_name)
+                await self.__purge__(source_db, table_name)
+
+        except ShardMoveLost as e:
+            logging.error("Stopped moving gamespace {0}: {1}".format(self.gamespace_id, str(e)))
+            return
+        except (DatabaseError, ShardError) as e:
+            logging.error("Failed to move gamespace {0}: {1}".format(self.gamespace_id, str(e)))
+
+            if not switched:
+                try:
+                    await self.__return__()
+                except ShardMoveLost:
+                    return
+
+            await self.__finish__(GamespaceMove.STATUS_FAILED, str(e))
+            return
+
+        await self.__finish__(GamespaceMove.STATUS_COMPLETE)
+        logging.info("Gamespace {0} moved to shard '{1}'".format(self.gamespace_id, self.target))
+
+    async def recover(self):
+        """
+        Finishes a move abandoned by its process
+        """
+
+        try:
+            mapped = await self.shards.default(ADMIN).get("""
+                SELECT `shard_name`
+                FROM `promo_shard_map`
+                WHERE `gamespace_id`=%s;
+            """, self.gamespace_id)
+
+            # the switch is a single update, so the gamespace is either on the target already, or not at all
+            if mapped and mapped["shard_name"] == self.target:
+                source_db = self.shards.shard(self.source).db(BULK)
+
+                for table_name, pk in GamespaceMove.TABLES:
+                    await self.__save__("cleaning up " + table_name)
+                    await self.__purge__(source_db, table_name)
+            else:
+                await self.__return__()
+                await self.__finish__(GamespaceMove.STATUS_FAILED, "Interrupted")
+                return
+
+        except ShardMoveLost:
+            return
+        except (DatabaseError, ShardError) as e:
+            logging.error("Failed to recover the move of gamespace {0}: {1}".format(self.gamespace_id, str(e)))
+            await self.__finish__(GamespaceMove.STATUS_FAILED, str(e))
+            return
+
+        await self.__finish__(GamespaceMove.STATUS_COMPLETE)
+        logging.info("Gamespace {0} moved to shard '{1}'".format(self.gamespace_id, self.target))
+
+    async def __return__(self):
+        """
+        Deletes the rows copied so far from the target shard, and returns the gamespace to the source one
+        """
+
+        try:
+            target_db = self.shards.shard(self.target).db(BULK)
+
+            for table_name, pk in GamespaceMove.TABLES:
+                await self.__save__("deleting the copy of " + table_name)
+                await self.__purge__(target_db, table_name)
+        except ShardMoveLost:
+            raise
+        except (DatabaseError, ShardError) as e:
+            # whatever is left is deleted by the next move before it copies anything
+            logging.error("Failed to delete the copy of gamespace {0} from shard '{1}': {2}".format(
+                self.gamespace_id, self.target, str(e)))
+
+        try:
+            await self.shards.assign(self.gamespace_id, self.source, moving=False)
+        except ShardError:
+            logging.exception("Failed to return gamespace {0} back to shard '{1}'".format(
+                self.gamespace_id, self.source))
+
+    async def __save__(self, stage):
+        """
+        Stores the state of the move, raises ShardMoveLost if the move belongs to another process now
+        """
+
+        if self.shards.stopping:
+            raise ShardError("The process is stopping")
+
+        self.stage = stage
+        db = self.shards.default(ADMIN)
+
+        try:
+            updated = await db.execute("""
+                UPDATE `promo_shard_moves`
+                SET `move_stage`=%s, `move_copied`=%s, `move_updated`=NOW()
+                WHERE `gamespace_id`=%s AND `move_token`=%s AND `move_status`=%s;
+            """, self.stage, ujson.dumps(self.copied), self.gamespace_id, self.token,
+                GamespaceMove.STATUS_RUNNING)
+
+            if updated:
+                return
+
+            # nothing is updated when nothing has changed within the same second, too
+            current = await db.get("""
+                SELECT `move_token`, `move_status`
+                FROM `promo_shard_moves`
+                WHERE `gamespace_id`=%s;
+            """, self.gamespace_id)
+        except DatabaseError as e:
+            raise ShardError("Failed to save the move: " + e.args[1])
+
+        if not current or current["move_token"] != self.token or \
+                current["move_status"] != GamespaceMove.STATUS_RUNNING:
+            raise ShardMoveLost("The move has been taken over by another process")
+
+    async def __finish__(self, status, error=""):
+        self.status = status
+        self.stage = status
+        self.error = error
+
+        try:
+            await self.shards.default(ADMIN).execute("""
+                UPDATE `promo_shard_moves`
+                SET `move_status`=%s, `move_stage`=%s, `move_copied`=%s, `move_error`=%s, `move_updated`=NOW()
+                WHERE `gamespace_id`=%s AND `move_token`=%s;
+            """, status, self.stage, ujson.dumps(self.copied), error[:255], self.gamespace_id, self.token)
+        except DatabaseError as e:
+            # left running, so it is recovered later
+            logging.error("Failed to save the move of gamespace {0}: {1}".format(self.gamespace_id, e.args[1]))
+
+    async def __copy__(self, source_db, target_db, table_name, pk):
+        last_id = 0
+        self.copied[table_name] = 0
+
+        while True:
+            rows = await source_db.query("""
+                SELECT *
+                FROM `{0}`
+                WHERE `gamespace_id`=%s AND `{1}`>%s
+                ORDER BY `{1}`
+                LIMIT %s;
+            """.format(table_name, pk), self.gamespace_id, last_id, self.batch_size)
+
+            if not rows:
+                return
+
+            ids = [row[pk] for row in rows]
+
+            # the leftovers of this gamespace have been deleted, so these belong to another one
+            existing = await target_db.query("""
+                SELECT `{1}`
+                FROM `{0}`
+                WHERE `{1}` IN %s;
+            """.format(table_name, pk), ids)
+
+            if existing:
+                raise ShardError("Row {0} of '{1}' already exists on shard '{2}' for another gamespace".format(
+                    existing[0][pk], table_name, self.target))
+
+            columns = list(rows[0].keys())
+            values = []
+
+            for row in rows:
+                values.extend(
+                    ujson.dumps(row[column]) if isinstance(row[column], (dict, list)) else row[column]
+                    for column in columns)
+
+            placeholders = "(" + ", ".join(["%s"] * len(columns)) + ")"
+
+            try:
+                await target_db.execute("""
+                    INSERT INTO `{0}` ({1})
+                    VALUES {2};
+                """.format(
+                    table_name,
+                    ", ".join("`" + column + "`" for column in columns),
+                    ", ".join([placeholders] * len(rows))), *values)
+            except DuplicateError as e:
+                raise ShardError("Failed to copy '{0}': {1}".format(table_name, e.args[1]))
+
+            self.copied[table_name] += len(rows)
+            last_id = ids[-1]
+
+            await self.__save__(self.stage)
+
+    async def __purge__(self, db, table_name):
+        while True:
+            deleted = await db.execute("""
+                DELETE
+                FROM `{0}`
+                WHERE `gamespace_id`=%s
+                LIMIT %s;
+            """.format(table_name), self.gamespace_id, self.batch_size)
+
+            if deleted < self.batch_size:
+                return
+
+            await self.__save__(self.stage)
@@ -0,0 +1,229 @@
+from anthill.common.database import DatabaseError
+from anthill.common.model import Model
+
+from tornado.ioloop import IOLoop
+
+import collections
+import datetime
+import logging
+import random
+import time
+import sys
+import re
+
+
+class SlowQuery(object):
+    def __init__(self, method, gamespace_id, query, args, duration, plan, error):
+        self.time = datetime.datetime.now()
+        self.method = method
+        self.gamespace_id = gamespace_id
+        self.query = query
+        self.args = args
+        self.duration = duration
+        self.plan = plan
+        self.error = error
+
+    def plan_summary(self):
+        if not self.plan:
+            return ""
+
+        return "; ".join(
+            "{0}: type={1}, key={2}, rows={3}, extra={4}".format(
+                row.get("table"), row.get("type"), row.get("key"), row.get("rows"), row.get("Extra") or "")
+            for row in self.plan)
+
+
+class SlowQueryLog(object):
+    """
+    Times every statement the models run, and keeps the most recent ones that took longer than the threshold,
+    along with the model method that ran them and (for a sample of them) the EXPLAIN output.
+
+    EXPLAIN is not run on the connection of the statement, as that one may be in the middle of a transaction,
+    and not on the request path either: the sampled statements are queued and explained in background,
+    one at a time, on a connection of their own.
+    """
+
+    # how many of the statement parameters to describe
+    MAX_ARGS = 16
+    WHITESPACE = re.compile(r"\s+")
+    # the values MySQL quotes in its error messages ("Duplicate entry '...' for key ...")
+    QUOTED = re.compile(r"'[^']*'")
+    # how many sampled statements may wait for EXPLAIN, the oldest ones are dropped (and left with no plan)
+    EXPLAIN_QUEUE_SIZE = 16
+
+    def __init__(self, threshold, explain_rate=0.1, size=100):
+        self.threshold = threshold
+        self.explain_rate = explain_rate
+        self.queries = collections.deque(maxlen=size)
+        self.explain_queue = collections.deque(maxlen=SlowQueryLog.EXPLAIN_QUEUE_SIZE)
+        self.explaining = False
+
+    def recent(self, gamespace_id):
+        """
+        Returns the most recent slow statements run for the gamespace, newest first
+        """
+        gamespace_id = str(gamespace_id)
+        return [query for query in reversed(self.queries) if str(query.gamespace_id) == gamespace_id]
+
+    @staticmethod
+    def describe_args(args):
+        """
+        Describes the statement parameters without their values (those are promo keys, account ids and such),
+        only the types, and the lengths of the strings and lists
+        """
+
+        def describe(arg):
+            if arg is None:
+                return "NULL"
+            if isinstance(arg, (str, bytes)):
+                return "{0}({1})".format(type(arg).__name__, len(arg))
+            if isinstance(arg, (list, tuple, set, frozenset)):
+                return "list({0})".format(len(arg))
+            return type(arg).__name__
+
+        described = [describe(arg) for arg in args[:SlowQueryLog.MAX_ARGS]]
+
+        if len(args) > SlowQueryLog.MAX_ARGS:
+            described.append("...")
+
+        return ", ".join(described)
+
+    async def run(self, target, method, query, args, explain_db=None):
+        started = time.monotonic()
+
+        try:
+            result = await getattr(target, method)(query, *args)
+        except DatabaseError as e:
+            duration = time.monotonic() - started
+            if duration >= self.threshold:
+                self.__record__(query, args, duration, None, SlowQueryLog.QUOTED.sub("'?'", str(e)))
+            raise
+
+        duration = time.monotonic() - started
+
+        if duration >= self.threshold:
+            slow_query = self.__record__(query, args, duration, None, None)
+
+            if explain_db is not None and random.random() < self.explain_rate:
+                self.explain_queue.append((slow_query, explain_db, query, args))
+
+                if not self.explaining:
+                    self.explaining = True
+                    IOLoop.current().spawn_callback(self.__explain__)
+
+        return result
+
+    def __record__(self, query, args, duration, plan, error):
+        method, gamespace_id = SlowQueryLog.__caller__()
+        query = SlowQueryLog.WHITESPACE.sub(" ", query).strip()
+        args = SlowQueryLog.describe_args(args)
+
+        slow_query = SlowQuery(method, gamespace_id, query, args, duration, plan, error)
+        self.queries.append(slow_query)
+
+        logging.warning("Slow query ({0:.1f} ms) in {1} (gamespace {2}): {3} ({4})".format(
+            duration * 1000, method, gamespace_id, query, args))
+
+        return slow_query
+
+    async def __explain__(self):
+        try:
+            while self.explain_queue:
+                slow_query, explain_db, query, args = self.explain_queue.popleft()
+
+                try:
+                    slow_query.plan = await explain_db.query("EXPLAIN " + query, *args)
+                except DatabaseError as e:
+                    slow_query.error = "Failed to explain: " + SlowQueryLog.QUOTED.sub("'?'", str(e))
+        finally:
+            self.explaining = False
+
+    @staticmethod
+    def __caller__():
+        """
+        Finds the model method the statement was run from, by walking up the chain of awaiting coroutines.
+        Only done for slow statements, so the fast ones don't pay for it.
+        """
+
+        frame = sys._getframe(2)
+
+        while frame is not None:
+            owner = frame.f_locals.get("self")
+
+            if isinstance(owner, Model):
+                gamespace_id = frame.f_locals.get("gamespace_id", frame.f_locals.get("gamespace"))
+                return owner.__class__.__name__ + "." + frame.f_code.co_name, gamespace_id
+
+            frame = frame.f_back
+
+        return "unknown", None
+
+
+class TimedConnection(object):
+    def __init__(self, connection, slow_log, explain_db=None):
+        self.connection = connection
+        self.slow_log = slow_log
+        self.explain_db = explain_db
+
+    async def __aenter__(self):
+        await self.connection.__aenter__()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.connection.__aexit__(*exc_info)
+
+    async def init(self):
+        await self.connection.init()
+        return self
+
+    def close(self):
+        self.connection.close()
+
+    def commit(self):
+        return self.connection.commit()
+
+    def rollback(self):
+        return self.connection.rollback()
+
+    async def autocommit(self, value):
+        await self.connection.autocommit(value)
+
+    async def execute(self, query, *args):
+        return await self.slow_log.run(self.connection, "execute", query, args, self.explain_db)
+
+    async def get(self, query, *args):
+        return await self.slow_log.run(self.connection, "get", query, args, self.explain_db)
+
+    async def insert(self, query, *args):
+        return await self.slow_log.run(self.connection, "insert", query, args, self.explain_db)
+
+    async def query(self, query, *args):
+        return await self.slow_log.run(self.connection, "query", query, args, self.explain_db)
+
+
+class TimedDatabase(object):
+    """
+    Wraps a database.Database, so every statement goes through the SlowQueryLog.
+    Time measured for the statements run outside of 'acquire' includes waiting for a free connection.
+    Sampled slow statements are explained on `explain_db` (a database not wrapped into TimedDatabase).
+    """
+
+    def __init__(self, db, slow_log, explain_db=None):
+        self.db = db
+        self.slow_log = slow_log
+        self.explain_db = explain_db
+
+    def acquire(self, auto_commit=True):
+        return TimedConnection(self.db.acquire(auto_commit=auto_commit), self.slow_log, self.explain_db)
+
+    async def execute(self, query, *args):
+        return await self.slow_log.run(self.db, "execute", query, args, self.explain_db)
+
+    async def get(self, query, *args):
+        return await self.slow_log.run(self.db, "get", query, args, self.explain_db)
+
+    async def insert(self, query, *args):
+        return await self.slow_log.run(self.db, "insert", query, args, self.explain_db)
+
+    async def query(self, query, *args):
+        return await self.slow_log.run(self.db, "query", query, args, self.explain_db)
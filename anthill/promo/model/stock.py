@@ -0,0 +1,284 @@
+from anthill.common.database import DatabaseError, DuplicateError
+from anthill.common.model import Model
+
+from tornado.ioloop import IOLoop
+from tornado.gen import sleep
+
+from . pools import PLAYER, ADMIN, BULK
+from . schema import setup_tables
+from . promo import PromoError
+
+import logging
+import ujson
+import time
+
+
+class KeyStockModel(Model):
+    """
+    Keeps a stock of reserved promo code keys for every gamespace that generates codes, so generating a code
+    takes a single UPDATE instead of random key generation, collision retries and an INSERT per key.
+
+    A reserved key is a regular `promo_code` row that cannot be used (zero amount, no contents), marked with
+    `code_stocked` (so the bulk jobs and the key lookups leave it alone) and listed in `promo_code_stock`. Taking keys from the stock
+    binds the actual amount, expire date and contents to them. Keys are taken with SKIP LOCKED (requires
+    MySQL 8.0), so concurrent calls never wait for each other.
+
+    The level of a stock is always counted in the database. Every batch of a refill locks the gamespace's row
+    in `promo_code_stock_refills` first, so the processes refilling the same stock at once wait for each other
+    and count what the others have added, instead of overshooting the size.
+    """
+
+    # amount of keys reserved in a single transaction while refilling
+    REFILL_BATCH = 100
+    # how often (in seconds) a process checks the level of a stock it takes keys from, unless the stock runs short
+    CHECK_INTERVAL = 1.0
+
+    def __init__(self, shards, promos, size=0, threshold=200, interval=30):
+        self.shards = shards
+        self.promos = promos
+        self.size = size
+        self.threshold = threshold
+        self.interval = interval
+
+        # str(gamespace_id) => when this process has checked the level of the stock last time
+        self.checked = {}
+        self.refilling = set()
+        self.stopping = False
+
+    def get_setup_db(self):
+        return self.shards.default(ADMIN)
+
+    def get_setup_tables(self):
+        return ["promo_code_stock", "promo_code_stock_refills"]
+
+    async def setup_shard(self, application, db):
+        await setup_tables(db, application, self.get_setup_tables())
+        await self.__migrate__(db)
+
+    def enabled(self):
+        return self.size > 0
+
+    async def started(self, application):
+        await super(KeyStockModel, self).started(application)
+        await self.__migrate__(self.get_setup_db())
+
+        if not self.enabled() or not application.runs_maintenance():
+            # the other workers still refill the gamespaces they take the keys from
+            return
+
+        IOLoop.current().spawn_callback(self.__refill_loop__)
+
+    async def stopped(self):
+        self.stopping = True
+        await super(KeyStockModel, self).stopped()
+
+    async def __migrate__(self, db):
+        # the keys stocked before `code_stocked` has been added
+        try:
+            await db.execute("""
+                UPDATE `promo_code` AS c
+                INNER JOIN `promo_code_stock` AS s
+                    ON s.`code_id`=c.`code_id` AND s.`gamespace_id`=c.`gamespace_id`
+                SET c.`code_stocked`=1
+                WHERE c.`code_stocked`=0;
+            """)
+        except DatabaseError as e:
+            logging.error("Failed to mark the stocked keys: " + e.args[1])
+
+    async def take(self, gamespace_id, count, amount, expires, contents):
+        """
+        Binds the amount, expire date and contents to up to `count` keys from the stock, and returns the keys.
+        May return less keys than requested (or none at all) if the stock is short, the rest has to be generated
+        the usual way.
+        """
+
+        if not self.enabled():
+            return []
+
+        try:
+            async with self.shards.db(PLAYER, gamespace_id).acquire(auto_commit=False) as db:
+                try:
+                    # a key whose code is gone is not taken, the refill cleans it up
+                    stocked = await db.query("""
+                        SELECT s.`stock_id`, s.`code_id`, s.`code_key`
+                        FROM `promo_code_stock` AS s
+                        INNER JOIN `promo_code` AS c
+                            ON c.`code_id`=s.`code_id` AND c.`gamespace_id`=s.`gamespace_id` AND c.`code_stocked`=1
+                        WHERE s.`gamespace_id`=%s
+                        ORDER BY s.`stock_id`
+                        LIMIT %s
+                        FOR UPDATE SKIP LOCKED;
+                    """, gamespace_id, count)
+
+                    if stocked:
+                        taken = await db.execute("""
+                            UPDATE `promo_code`
+                            SET `code_amount`=%s, `code_expires`=%s, `code_contents`=%s, `code_stocked`=0
+                            WHERE `gamespace_id`=%s AND `code_id` IN %s AND `code_stocked`=1;
+                        """, amount, expires, ujson.dumps(contents), gamespace_id,
+                            [row["code_id"] for row in stocked])
+
+                        if taken != len(stocked):
+                            # never hand out a key that does not exist, let the caller generate them all instead
+                            await db.rollback()
+                            logging.error("Key stock of gamespace {0} is out of sync: {1} keys of {2}".format(
+                                gamespace_id, taken, len(stocked)))
+                            self.__check__(gamespace_id, short=True)
+                            return []
+
+                        await db.execute("""
+                            DELETE
+                            FROM `promo_code_stock`
+                            WHERE `stock_id` IN %s;
+                        """, [row["stock_id"] for row in stocked])
+                except BaseException:
+                    await db.rollback()
+                    raise
+                else:
+                    await db.commit()
+        except DatabaseError as e:
+            raise PromoError(500, "Failed to take keys from the stock: " + e.args[1])
+
+        self.__check__(gamespace_id, short=len(stocked) < count)
+        return [row["code_key"] for row in stocked]
+
+    def __check__(self, gamespace_id, short):
+        """
+        Refills the stock in background if it is below the threshold.
+        The level is counted at most once per CHECK_INTERVAL, unless the stock has run short.
+        """
+
+        key = str(gamespace_id)
+        now = time.monotonic()
+
+        if not short and now - self.checked.get(key, 0) < KeyStockModel.CHECK_INTERVAL:
+            return
+
+        self.checked[key] = now
+
+        if key not in self.refilling:
+            IOLoop.current().spawn_callback(self.refill, gamespace_id, self.threshold)
+
+    async def __refill_loop__(self):
+        while not self.stopping:
+            for db in self.shards.all(BULK):
+                try:
+                    rows = await db.query("""
+                        SELECT `gamespace_id`
+                        FROM `promo_code_stock_refills`
+                        UNION
+                        SELECT DISTINCT `gamespace_id`
+                        FROM `promo_code_stock`;
+                    """)
+                except DatabaseError as e:
+                    logging.error("Failed to list stocked gamespaces: " + e.args[1])
+                    continue
+
+                for row in rows:
+                    if self.stopping:
+                        return
+
+                    await self.refill(row["gamespace_id"])
+
+            await sleep(self.interval)
+
+    async def refill(self, gamespace_id, threshold=None):
+        """
+        Tops the stock of a gamespace up to `size` (if passed, only when it is below `threshold`)
+        """
+
+        key = str(gamespace_id)
+
+        if key in self.refilling:
+            return
+
+        self.refilling.add(key)
+
+        try:
+            db = self.shards.db(BULK, gamespace_id)
+
+            # the keys whose codes have been deleted
+            await db.execute("""
+                DELETE s
+                FROM `promo_code_stock` AS s
+                LEFT JOIN `promo_code` AS c
+                    ON c.`code_id`=s.`code_id` AND c.`gamespace_id`=s.`gamespace_id` AND c.`code_stocked`=1
+                WHERE s.`gamespace_id`=%s AND c.`code_id` IS NULL;
+            """, gamespace_id)
+
+            while not self.stopping:
+                reserved = await self.__reserve__(db, gamespace_id, threshold)
+
+                if not reserved:
+                    break
+
+                # once started, the stock is filled up completely
+                threshold = None
+
+        except DatabaseError as e:
+            logging.error("Failed to refill key stock for gamespace {0}: {1}".format(gamespace_id, e.args[1]))
+        finally:
+            self.refilling.discard(key)
+
+    async def __reserve__(self, db, gamespace_id, threshold):
+        """
+        Reserves up to REFILL_BATCH new keys in a single transaction, returns amount of keys reserved
+        (none once the stock is full, or not below `threshold`)
+        """
+
+        async with db.acquire(auto_commit=False) as conn:
+            try:
+                # goes first, so the level below is counted after the other refills of this stock are committed
+                await conn.execute("""
+                    INSERT INTO `promo_code_stock_refills`
+                    (`gamespace_id`, `refill_time`)
+                    VALUES (%s, NOW())
+                    ON DUPLICATE KEY UPDATE `refill_time`=NOW();
+                """, gamespace_id)
+
+                level = await conn.get("""
+                    SELECT COUNT(*) AS `count`
+                    FROM `promo_code_stock`
+                    WHERE `gamespace_id`=%s;
+                """, gamespace_id)
+
+                level = level["count"]
+
+                if threshold is not None and level >= threshold:
+                    count = 0
+                else:
+                    count = min(KeyStockModel.REFILL_BATCH, self.size - level)
+
+                reserved = []
+
+                for i in range(0, count):
+                    code_key = self.promos.random()
+                    key_columns, key_values = self.promos.key_columns(code_key)
+
+                    try:
+                        code_id = await conn.insert("""
+                            INSERT INTO `promo_code`
+                            (`gamespace_id`, {0}, `code_amount`, `code_expires`, `code_contents`, `code_stocked`)
+                            VALUES (%s, {1}, 0, NOW(), '{{}}', 1);
+                        """.format(", ".join("`" + column + "`" for column in key_columns),
+                                   ", ".join(["%s"] * len(key_columns))), gamespace_id, *key_values)
+                    except DuplicateError:
+                        # collided with an existing key, only this statement is rolled back
+                        continue
+
+                    reserved.append((gamespace_id, code_id, code_key))
+
+                if reserved:
+                    await conn.execute("""
+                        INSERT INTO `promo_code_stock`
+                        (`gamespace_id`, `code_id`, `code_key`)
+                        VALUES {0};
+                    """.format(", ".join(["(%s, %s, %s)"] * len(reserved))),
+                        *[value for row in reserved for value in row])
+            except BaseException:
+                await conn.rollback()
+                raise
+            else:
+                await conn.commit()
+
+        return len(reserved)
@@ -39,3 +39,204 @@ define("db_name",
        default="dev_promo",
        type=str,
        help="MySQL database name")
+
+# Database connection pools (per workload)
+
+define("db_player_max_connections",
+       default=64,
+       type=int,
+       help="Maximum connections for player-facing requests (promo code redemption, internal code generation)")
+
+define("db_admin_max_connections",
+       default=8,
+       type=int,
+       help="Maximum connections for admin interface requests")
+
+define("db_bulk_max_connections",
+       default=4,
+       type=int,
+       help="Maximum connections for bulk work (bulk code generation, account purges, usage listings)")
+
+# Bulk jobs
+
+define("bulk_chunk_size",
+       default=500,
+       type=int,
+       help="Amount of promo codes a bulk job processes in a single transaction")
+
+define("bulk_chunk_delay",
+       default=0.1,
+       type=float,
+       help="Delay (in seconds) between chunks of a bulk job, to let the live traffic through")
+
+# Admission control for promo code redemption
+
+define("redeem_max_in_flight",
+       default=32,
+       type=int,
+       help="Maximum number of promo code redemptions processed at the same time")
+
+define("redeem_max_queue",
+       default=256,
+       type=int,
+       help="Maximum number of promo code redemptions waiting for a free slot, the rest is rejected with 503")
+
+define("redeem_queue_timeout",
+       default=2.0,
+       type=float,
+       help="Maximum time (in seconds) a redemption may wait for a free slot before it is rejected with 503")
+
+define("redeem_retry_after",
+       default=1,
+       type=int,
+       help="Value of Retry-After header (in seconds) for rejected redemptions")
+
+define("redeem_gamespace_max_share",
+       default=0.5,
+       type=float,
+       help="Maximum share (0..1] of the redemption slots and queue a single gamespace can take while other "
+            "gamespaces are waiting (a gamespace alone can take them all)")
+
+define("redeem_gamespace_weights",
+       default="",
+       type=str,
+       help="Weights of the gamespaces when sharing the redemption slots, as gamespace:weight,... (1 by default)")
+
+define("redeem_retry_budget",
+       default=2.0,
+       type=float,
+       help="Maximum time (in seconds) a redemption may spend retrying after deadlocks and lock wait timeouts, "
+            "counted from the start of the redemption")
+
+define("redeem_lock_wait_timeout",
+       default=1,
+       type=int,
+       help="innodb_lock_wait_timeout (in whole seconds) of the player-facing connections. Keep it below "
+            "redeem_retry_budget, otherwise a redemption stuck behind a lock fails without a retry")
+
+define("redeem_retry_delay",
+       default=0.01,
+       type=float,
+       help="Initial delay (in seconds) before retrying a redemption, doubled (with jitter) for every next retry")
+
+# Shards
+
+define("db_shards_config",
+       default="",
+       type=str,
+       help="Path to a JSON file with additional database shards (see ShardMap), empty for the default one only")
+
+define("db_shards_reload_interval",
+       default=10,
+       type=int,
+       help="How often (in seconds) the shards config and the gamespace-to-shard map are reloaded")
+
+define("shard_move_batch_size",
+       default=500,
+       type=int,
+       help="Amount of rows copied in one batch while moving a gamespace between shards")
+
+# Slow query log
+
+define("slow_query_log",
+       default=False,
+       type=bool,
+       help="Time every database statement and keep the slow ones (see slow_query_threshold) for the admin")
+
+define("slow_query_threshold",
+       default=100.0,
+       type=float,
+       help="Statements taking longer than this (in milliseconds) are considered slow")
+
+define("slow_query_explain_rate",
+       default=0.1,
+       type=float,
+       help="Fraction (0..1) of the slow statements to capture EXPLAIN output for")
+
+define("slow_query_log_size",
+       default=100,
+       type=int,
+       help="Amount of the most recent slow statements to keep")
+
+# Key stock
+
+define("key_stock_size",
+       default=0,
+       type=int,
+       help="Amount of reserved promo code keys to keep for every gamespace that generates codes (as placeholder "
+            "promo_code rows), 0 to disable")
+
+define("key_stock_refill_threshold",
+       default=200,
+       type=int,
+       help="Refill the key stock of a gamespace when it gets below this amount")
+
+define("key_stock_refill_interval",
+       default=30,
+       type=int,
+       help="How often (in seconds) every key stock is checked and topped up")
+
+# Promo code keys
+
+define("promo_key_storage",
+       default="string",
+       type=str,
+       help="How promo code keys are stored: string, or integer (a much smaller index, see PromoModel)")
+
+# Redemption events
+
+define("redemption_events",
+       default=False,
+       type=bool,
+       help="Write an event for every promo code redemption, for other services to follow (list_redemptions). "
+            "The redemptions of a gamespace wait for each other to commit while it's on")
+
+define("redemption_events_retention",
+       default=168,
+       type=int,
+       help="How long (in hours) redemption events are kept")
+
+# Worker processes
+
+define("workers",
+       default=1,
+       type=int,
+       help="Amount of worker processes to serve the requests with (0 for one per CPU core)")
+
+define("worker_restart_delay",
+       default=1.0,
+       type=float,
+       help="How long (in seconds) to wait before restarting a worker process that has exited unexpectedly")
+
+define("drain_timeout",
+       default=30.0,
+       type=float,
+       help="How long (in seconds) to wait for the requests in progress to finish on shutdown")
+
+# Traffic capture
+
+define("capture_log",
+       default="",
+       type=str,
+       help="Record promo code redemptions (sanitized) into this file, to be replayed with anthill.promo.replay")
+
+define("capture_salt",
+       default="",
+       type=str,
+       help="Secret the captured account ids and keys are hashed with, keep the same for every process "
+            "(a random one is generated for every start if not set)")
+
+define("capture_sample_rate",
+       default=1.0,
+       type=float,
+       help="Share of the promo code keys to record the redemptions of (0..1)")
+
+define("replay_logs",
+       default="",
+       type=str,
+       help="Comma-separated list of captured logs to replay (anthill.promo.replay)")
+
+define("replay_speed",
+       default=1.0,
+       type=float,
+       help="How much faster than recorded to replay the captured traffic")
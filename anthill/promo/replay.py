@@ -0,0 +1,207 @@
+"""
+Replays the promo code redemptions captured with --capture_log against a local database, at the recorded pace
+(or faster, with --replay_speed), and compares the latency and the results with the recording.
+
+The codes the recorded keys stood for do not exist locally (and the keys are not in the log anyway), so before
+the replay a local code is created for every recorded key that has been used successfully, with as many uses as
+there were. The rest of the keys stay unknown, so they fail the same way they did. The redemptions go through the
+same admission control and PromoModel.use_promo as the actual requests do; the HTTP layer is not replayed.
+
+Usage:
+
+python -m anthill.promo.replay --db_name=dev_promo --replay_logs=capture.log.0,capture.log.1 --replay_speed=10
+
+"""
+
+from anthill.common.options import options
+from anthill.common import server
+
+from tornado.ioloop import IOLoop
+from tornado.gen import sleep
+
+from . server import PromoServer
+from . capture import read_captured
+from . admission import AdmissionRejected
+from . model.promo import PromoError, PromoNotFound, PromoExists
+from . model.content import ContentError, ContentNotFound
+
+import collections
+import datetime
+import asyncio
+import random
+import string
+import time
+
+
+class ReplayResults(object):
+    def __init__(self):
+        self.statuses = collections.Counter()
+        self.latencies = []
+
+    def add(self, status, latency):
+        self.statuses[status] += 1
+        self.latencies.append(latency)
+
+    def count(self):
+        return len(self.latencies)
+
+    def share(self, status):
+        if not self.latencies:
+            return 0
+        return self.statuses[status] * 100.0 / len(self.latencies)
+
+    def percentile(self, p):
+        if not self.latencies:
+            return 0
+
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100.0))]
+
+
+class TrafficReplay(object):
+    # statuses that mean the code existed at the moment of the request
+    EXISTING_STATUSES = [200, 409, 503]
+
+    CONTENT_NAME = "replay"
+
+    def __init__(self, application, requests, speed=1.0):
+        self.application = application
+        self.requests = requests
+        self.speed = speed
+
+        # (gamespace_id, recorded key) => local key
+        self.keys = {}
+
+        self.recorded = ReplayResults()
+        self.replayed = ReplayResults()
+
+    async def prepare(self):
+        contents = self.application.contents
+        promos = self.application.promos
+
+        uses = collections.Counter()
+
+        for request in self.requests:
+            self.recorded.add(request.status, request.latency)
+
+            if request.is_valid_key() and request.status in TrafficReplay.EXISTING_STATUSES:
+                uses[(request.gamespace_id, request.key)] += 1
+
+        expires = datetime.datetime.now() + datetime.timedelta(days=1)
+        gamespace_contents = {}
+
+        for (gamespace_id, key), amount in uses.items():
+            if gamespace_id not in gamespace_contents:
+                try:
+                    content = await contents.find_content(gamespace_id, TrafficReplay.CONTENT_NAME)
+                except ContentNotFound:
+                    content_id = await contents.new_content(gamespace_id, TrafficReplay.CONTENT_NAME, {})
+                else:
+                    content_id = content.content_id
+
+                gamespace_contents[gamespace_id] = {str(content_id): 1}
+
+            while True:
+                local_key = promos.random()
+
+                try:
+                    await promos.new_promo(gamespace_id, local_key, amount, expires, gamespace_contents[gamespace_id])
+                except PromoExists:
+                    continue
+
+                break
+
+            self.keys[(gamespace_id, key)] = local_key
+
+        for request in self.requests:
+            if (request.gamespace_id, request.key) in self.keys:
+                continue
+
+            if request.is_valid_key():
+                # a code that did not exist, and does not exist locally either
+                local_key = promos.random()
+            else:
+                local_key = "".join(random.choice(string.ascii_lowercase) for _ in range(int(request.key[1:])))
+
+            self.keys[(request.gamespace_id, request.key)] = local_key
+
+    async def run(self):
+        if not self.requests:
+            return
+
+        first = self.requests[0].time
+        started = time.monotonic()
+        tasks = []
+
+        for request in self.requests:
+            delay = (request.time - first) / self.speed - (time.monotonic() - started)
+
+            if delay > 0:
+                await sleep(delay)
+
+            tasks.append(asyncio.ensure_future(self.__replay__(request)))
+
+        await asyncio.gather(*tasks)
+
+    async def __replay__(self, request):
+        promos = self.application.promos
+        admission = self.application.admission
+
+        key = self.keys[(request.gamespace_id, request.key)]
+        started = time.monotonic()
+
+        try:
+            async with admission.acquire(request.gamespace_id):
+                await promos.use_promo(request.gamespace_id, request.account, key)
+        except AdmissionRejected:
+            status = 503
+        except PromoError as e:
+            status = e.code
+        except PromoNotFound:
+            status = 404
+        else:
+            status = 200
+
+        self.replayed.add(status, (time.monotonic() - started) * 1000)
+
+    def report(self):
+        lines = [
+            "{0:<20}{1:>12}{2:>12}".format("", "recorded", "replayed"),
+            "{0:<20}{1:>12}{2:>12}".format("requests", self.recorded.count(), self.replayed.count())
+        ]
+
+        for status in sorted(set(self.recorded.statuses) | set(self.replayed.statuses)):
+            lines.append("{0:<20}{1:>11.1f}%{2:>11.1f}%".format(
+                "status " + str(status), self.recorded.share(status), self.replayed.share(status)))
+
+        for p in [50, 90, 99, 100]:
+            lines.append("{0:<20}{1:>12.1f}{2:>12.1f}".format(
+                "latency p{0} (ms)".format(p), self.recorded.percentile(p), self.replayed.percentile(p)))
+
+        return "\n".join(lines)
+
+
+async def replay(application, requests, speed):
+    for model in [application.shards, application.contents, application.events, application.promos]:
+        await model.started(application)
+
+    traffic = TrafficReplay(application, requests, speed)
+
+    try:
+        await traffic.prepare()
+    except (PromoError, ContentError) as e:
+        print("Failed to prepare the codes: " + str(e))
+        return
+
+    print("Replaying {0} requests at {1}x speed".format(len(requests), speed))
+    await traffic.run()
+    print(traffic.report())
+
+
+if __name__ == "__main__":
+    stt = server.init()
+
+    captured = read_captured([path for path in options.replay_logs.split(",") if path])
+    app = PromoServer()
+
+    IOLoop.current().run_sync(lambda: replay(app, captured, options.replay_speed))
@@ -1,35 +1,213 @@
 
 from anthill.common.options import options
-from anthill.common import server, database, access
+from anthill.common import server, access
 
 from . import handlers as h
 # noinspection PyUnresolvedReferences
 from . import options as _opts
 from . import admin
+from . admission import AdmissionControl
+from . workers import WorkerSupervisor, bind_sockets
+from . capture import TrafficRecorder
 
 from . model.content import ContentModel
 from . model.promo import PromoModel
+from . model.bulk import BulkJobsModel
+from . model.stock import KeyStockModel
+from . model.events import RedemptionEventsModel
+from . model.pools import PLAYER, ADMIN, BULK
+from . model.shards import ShardMap
+from . model.slowlog import SlowQueryLog
+
+from tornado.gen import sleep
+
+import tornado.httpserver
+import tornado.httputil
+import logging
+import time
+import uuid
+import os
+
+
+class InFlightDelegate(tornado.httputil.HTTPMessageDelegate):
+    """
+    Counts a request as in progress from its headers until it is finished by its handler (see
+    PromoServer.log_request), or its connection is closed, whichever comes first. Connections kept alive between
+    the requests are not counted.
+    """
+
+    def __init__(self, in_flight, request_conn, delegate):
+        self.in_flight = in_flight
+        self.request_conn = request_conn
+        self.delegate = delegate
+
+    def headers_received(self, start_line, headers):
+        self.in_flight.add(self.request_conn)
+        return self.delegate.headers_received(start_line, headers)
+
+    def data_received(self, chunk):
+        return self.delegate.data_received(chunk)
+
+    def finish(self):
+        self.delegate.finish()
+
+    def on_connection_close(self):
+        self.in_flight.discard(self.request_conn)
+        self.delegate.on_connection_close()
 
 
 class PromoServer(server.Server):
-    def __init__(self):
+    def __init__(self, worker_id=None, sockets=None):
         super(PromoServer, self).__init__()
 
-        self.db = database.Database(
-            host=options.db_host,
-            database=options.db_name,
-            user=options.db_username,
-            password=options.db_password)
+        # set when running as one of the worker processes (see WorkerSupervisor)
+        self.worker_id = worker_id
+        self.sockets = sockets
+
+        # connections of the requests being processed, to let them finish on shutdown
+        self.in_flight = set()
+
+        if options.capture_log:
+            if not options.capture_salt:
+                raise server.ServerError("--capture_salt is required to capture traffic")
+
+            self.recorder = TrafficRecorder(
+                path=options.capture_log if worker_id is None else "{0}.{1}".format(options.capture_log, worker_id),
+                salt=options.capture_salt,
+                sample_rate=options.capture_sample_rate)
+        else:
+            self.recorder = None
+
+        if options.slow_query_log:
+            self.slow_log = SlowQueryLog(
+                threshold=options.slow_query_threshold / 1000.0,
+                explain_rate=options.slow_query_explain_rate,
+                size=options.slow_query_log_size)
+        else:
+            self.slow_log = None
+
+        self.shards = ShardMap(
+            default_config={
+                "host": options.db_host,
+                "database": options.db_name,
+                "user": options.db_username,
+                "password": options.db_password
+            },
+            limits={
+                PLAYER: options.db_player_max_connections,
+                ADMIN: options.db_admin_max_connections,
+                BULK: options.db_bulk_max_connections
+            },
+            config_path=options.db_shards_config,
+            reload_interval=options.db_shards_reload_interval,
+            slow_log=self.slow_log,
+            move_batch_size=options.shard_move_batch_size,
+            lock_wait_timeouts={
+                PLAYER: options.redeem_lock_wait_timeout
+            })
+
+        self.contents = ContentModel(self.shards)
+        self.events = RedemptionEventsModel(
+            self.shards,
+            enabled=options.redemption_events,
+            retention=options.redemption_events_retention)
+        self.promos = PromoModel(
+            self.shards, self.events,
+            retry_budget=options.redeem_retry_budget,
+            retry_delay=options.redeem_retry_delay,
+            key_storage=options.promo_key_storage)
+        self.bulk = BulkJobsModel(
+            self.shards, self.promos,
+            chunk_size=options.bulk_chunk_size,
+            chunk_delay=options.bulk_chunk_delay)
+        self.stock = KeyStockModel(
+            self.shards, self.promos,
+            size=options.key_stock_size,
+            threshold=options.key_stock_refill_threshold,
+            interval=options.key_stock_refill_interval)
+
+        self.admission = AdmissionControl(
+            max_in_flight=options.redeem_max_in_flight,
+            max_queue=options.redeem_max_queue,
+            queue_timeout=options.redeem_queue_timeout,
+            retry_after=options.redeem_retry_after,
+            max_share=options.redeem_gamespace_max_share,
+            weights=PromoServer.__parse_weights__(options.redeem_gamespace_weights),
+            on_wait=self.__redeem_waited__)
+
+    @staticmethod
+    def __parse_weights__(weights):
+        """
+        Parses "gamespace:weight,gamespace:weight" into a dict
+        """
+
+        result = {}
+
+        for item in weights.split(","):
+            if not item.strip():
+                continue
 
-        self.contents = ContentModel(self.db)
-        self.promos = PromoModel(self.db)
+            gamespace_id, weight = item.split(":")
+            result[gamespace_id.strip()] = float(weight)
+
+        return result
+
+    def __redeem_waited__(self, gamespace_id, waited):
+        self.monitor_action("redeem.wait", {"time": waited * 1000}, gamespace=gamespace_id)
+
+    def runs_maintenance(self):
+        """
+        Background maintenance (the one that does not depend on the requests a process serves)
+        is done by a single worker only.
+        """
+        return not self.worker_id
+
+    def start_request(self, server_conn, request_conn):
+        delegate = super(PromoServer, self).start_request(server_conn, request_conn)
+        return InFlightDelegate(self.in_flight, request_conn, delegate)
+
+    def log_request(self, request_handler):
+        self.in_flight.discard(request_handler.request.connection)
+        super(PromoServer, self).log_request(request_handler)
+
+    def listen_server(self):
+        if self.sockets is None:
+            super(PromoServer, self).listen_server()
+            return
+
+        self.http_server = tornado.httpserver.HTTPServer(self, xheaders=True)
+        self.http_server.add_sockets(self.sockets)
+
+    async def started(self):
+        await super(PromoServer, self).started()
+
+        if self.recorder:
+            self.recorder.start()
+
+    async def process_shutdown(self):
+        # the server is not accepting new connections anymore, let the requests in progress finish first
+        deadline = time.monotonic() + options.drain_timeout
+
+        while self.in_flight and time.monotonic() < deadline:
+            await sleep(0.1)
+
+        if self.in_flight:
+            logging.warning("Shutting down with {0} requests still in progress".format(len(self.in_flight)))
+
+        if self.recorder:
+            self.recorder.stop()
+
+        await super(PromoServer, self).process_shutdown()
 
     def get_models(self):
-        return [self.contents, self.promos]
+        # the shard map goes first, the rest of the models depend on it
+        return [self.shards, self.contents, self.events, self.promos, self.bulk, self.stock]
 
     def get_handlers(self):
         return [
             (r"/use/(.*)", h.UsePromoHandler),
+            (r"/pool/(.*)", h.ClaimPoolCodeHandler),
+            (r"/history", h.PromoHistoryHandler),
         ]
 
     def get_internal_handler(self):
@@ -44,7 +222,15 @@ class PromoServer(server.Server):
             "promos": admin.PromosController,
             "new_promo": admin.NewPromoController,
             "new_promos": admin.NewPromosController,
-            "promo": admin.PromoController
+            "promo": admin.PromoController,
+            "pools": admin.PoolsController,
+            "new_pool": admin.NewPoolController,
+            "pool": admin.PoolController,
+            "bulk_jobs": admin.BulkJobsController,
+            "bulk_job": admin.BulkJobController,
+            "status": admin.StatusController,
+            "shards": admin.ShardsController,
+            "slow_queries": admin.SlowQueriesController
         }
 
     def get_metadata(self):
@@ -55,7 +241,25 @@ class PromoServer(server.Server):
         }
 
 
+def start_worker(worker_id, sockets):
+    PromoServer(worker_id=worker_id, sockets=sockets).run()
+
+
 if __name__ == "__main__":
     stt = server.init()
     access.AccessToken.init([access.public()])
-    server.start(PromoServer)
+
+    if options.capture_log and not options.capture_salt:
+        # generated before the workers are forked, so they all share it
+        logging.warning("No --capture_salt set, captured accounts and keys cannot be matched across restarts")
+        options.capture_salt = uuid.uuid4().hex
+
+    if options.workers == 1:
+        server.start(PromoServer)
+    else:
+        supervisor = WorkerSupervisor(
+            count=options.workers or os.cpu_count(),
+            restart_delay=options.worker_restart_delay,
+            drain_timeout=options.drain_timeout)
+
+        supervisor.run(bind_sockets(options.listen), start_worker)
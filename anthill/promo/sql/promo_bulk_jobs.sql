@@ -0,0 +1,16 @@
+CREATE TABLE `promo_bulk_jobs` (
+  `job_id` int(11) unsigned NOT NULL AUTO_INCREMENT,
+  `gamespace_id` int(11) NOT NULL,
+  `job_action` varchar(32) NOT NULL DEFAULT '',
+  `job_filter` json NOT NULL,
+  `job_args` json NOT NULL,
+  `job_status` varchar(32) NOT NULL DEFAULT 'running',
+  `job_total` int(11) NOT NULL DEFAULT '0',
+  `job_processed` int(11) NOT NULL DEFAULT '0',
+  `job_last_id` int(11) unsigned NOT NULL DEFAULT '0',
+  `job_created` datetime NOT NULL,
+  `job_updated` datetime NOT NULL,
+  `job_error` varchar(255) NOT NULL DEFAULT '',
+  PRIMARY KEY (`job_id`),
+  KEY `gamespace_id` (`gamespace_id`,`job_id`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
\ No newline at end of file
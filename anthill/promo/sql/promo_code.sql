@@ -5,6 +5,8 @@ CREATE TABLE `promo_code` (
   `code_amount` int(11) NOT NULL DEFAULT '1',
   `code_expires` datetime NOT NULL,
   `code_contents` json NOT NULL,
+  `code_bitmap` tinyint(1) NOT NULL DEFAULT '0',
+  `code_stocked` tinyint(1) NOT NULL DEFAULT '0',
   PRIMARY KEY (`code_id`),
   UNIQUE KEY `gamespace_id` (`gamespace_id`,`code_key`)
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8;
@@ -0,0 +1,11 @@
+CREATE TABLE `promo_code_pool_keys` (
+  `key_id` int(11) unsigned NOT NULL AUTO_INCREMENT,
+  `gamespace_id` int(11) NOT NULL,
+  `pool_id` int(11) unsigned NOT NULL,
+  `code_id` int(11) unsigned NOT NULL,
+  `code_key` varchar(255) NOT NULL DEFAULT '',
+  `account_id` int(11) DEFAULT NULL,
+  `key_claimed` datetime DEFAULT NULL,
+  PRIMARY KEY (`key_id`),
+  UNIQUE KEY `account_id` (`pool_id`,`account_id`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
\ No newline at end of file
@@ -0,0 +1,7 @@
+CREATE TABLE `promo_code_pools` (
+  `pool_id` int(11) unsigned NOT NULL AUTO_INCREMENT,
+  `gamespace_id` int(11) NOT NULL,
+  `pool_name` varchar(64) NOT NULL DEFAULT '',
+  PRIMARY KEY (`pool_id`),
+  UNIQUE KEY `gamespace_id` (`gamespace_id`,`pool_name`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
\ No newline at end of file
@@ -0,0 +1,8 @@
+CREATE TABLE `promo_code_stock` (
+  `stock_id` int(11) unsigned NOT NULL AUTO_INCREMENT,
+  `gamespace_id` int(11) NOT NULL,
+  `code_id` int(11) unsigned NOT NULL,
+  `code_key` varchar(255) NOT NULL DEFAULT '',
+  PRIMARY KEY (`stock_id`),
+  KEY `gamespace_id` (`gamespace_id`,`stock_id`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
\ No newline at end of file
@@ -0,0 +1,5 @@
+CREATE TABLE `promo_code_stock_refills` (
+  `gamespace_id` int(11) NOT NULL,
+  `refill_time` datetime NOT NULL,
+  PRIMARY KEY (`gamespace_id`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
\ No newline at end of file
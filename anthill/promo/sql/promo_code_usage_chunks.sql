@@ -0,0 +1,11 @@
+CREATE TABLE `promo_code_usage_chunks` (
+  `chunk_record_id` int(11) unsigned NOT NULL AUTO_INCREMENT,
+  `gamespace_id` int(11) NOT NULL,
+  `code_id` int(11) unsigned NOT NULL,
+  `chunk_id` int(11) unsigned NOT NULL,
+  `chunk_cardinality` int(11) unsigned NOT NULL DEFAULT '0',
+  `chunk_data` blob NOT NULL,
+  PRIMARY KEY (`chunk_record_id`),
+  UNIQUE KEY `code_chunk` (`gamespace_id`,`code_id`,`chunk_id`),
+  KEY `chunk_id` (`chunk_id`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
\ No newline at end of file
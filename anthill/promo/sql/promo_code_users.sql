@@ -3,5 +3,7 @@ CREATE TABLE `promo_code_users` (
   `gamespace_id` int(11) DEFAULT NULL,
   `code_id` int(11) NOT NULL,
   `account_id` int(11) NOT NULL,
-  PRIMARY KEY (`record_id`)
+  PRIMARY KEY (`record_id`),
+  KEY `code_id` (`gamespace_id`,`code_id`,`account_id`),
+  KEY `account_id` (`gamespace_id`,`account_id`)
 ) ENGINE=InnoDB AUTO_INCREMENT=1 DEFAULT CHARSET=utf8;
\ No newline at end of file
@@ -0,0 +1,5 @@
+CREATE TABLE `promo_migrations` (
+  `migration_name` varchar(64) NOT NULL,
+  `migration_completed` datetime NOT NULL,
+  PRIMARY KEY (`migration_name`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
\ No newline at end of file
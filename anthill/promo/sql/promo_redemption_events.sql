@@ -0,0 +1,12 @@
+CREATE TABLE `promo_redemption_events` (
+  `event_id` bigint(20) unsigned NOT NULL AUTO_INCREMENT,
+  `gamespace_id` int(11) NOT NULL,
+  `event_seq` bigint(20) unsigned DEFAULT NULL,
+  `code_id` int(11) unsigned NOT NULL,
+  `code_key` varchar(255) NOT NULL DEFAULT '',
+  `account_id` int(11) NOT NULL,
+  `event_time` datetime NOT NULL,
+  PRIMARY KEY (`event_id`),
+  UNIQUE KEY `event_seq` (`gamespace_id`,`event_seq`),
+  KEY `event_time` (`event_time`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
\ No newline at end of file
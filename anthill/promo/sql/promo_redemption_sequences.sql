@@ -0,0 +1,5 @@
+CREATE TABLE `promo_redemption_sequences` (
+  `gamespace_id` int(11) NOT NULL,
+  `sequence_last` bigint(20) unsigned NOT NULL,
+  PRIMARY KEY (`gamespace_id`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
\ No newline at end of file
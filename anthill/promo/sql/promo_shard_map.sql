@@ -0,0 +1,6 @@
+CREATE TABLE `promo_shard_map` (
+  `gamespace_id` int(11) NOT NULL,
+  `shard_name` varchar(64) NOT NULL DEFAULT '',
+  `shard_moving` tinyint(1) NOT NULL DEFAULT '0',
+  PRIMARY KEY (`gamespace_id`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
\ No newline at end of file
@@ -0,0 +1,13 @@
+CREATE TABLE `promo_shard_moves` (
+  `gamespace_id` int(11) NOT NULL,
+  `move_source` varchar(64) NOT NULL DEFAULT '',
+  `move_target` varchar(64) NOT NULL DEFAULT '',
+  `move_token` varchar(32) NOT NULL DEFAULT '',
+  `move_status` varchar(32) NOT NULL DEFAULT 'running',
+  `move_stage` varchar(64) NOT NULL DEFAULT '',
+  `move_copied` json NOT NULL,
+  `move_error` varchar(255) NOT NULL DEFAULT '',
+  `move_updated` datetime NOT NULL,
+  PRIMARY KEY (`gamespace_id`),
+  KEY `move_status` (`move_status`,`move_updated`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
\ No newline at end of file
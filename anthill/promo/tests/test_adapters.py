@@ -0,0 +1,70 @@
+import unittest
+import ujson
+
+try:
+    from anthill.promo.model.promo import PromoAdapter, PromoRedemption
+    from anthill.promo.model.content import ContentAdapter
+except ImportError as e:
+    raise unittest.SkipTest("anthill-common is not available: " + str(e))
+
+
+class TestPromoAdapter(unittest.TestCase):
+    def test_select(self):
+        self.assertEqual(PromoAdapter.select(["code_amount"]), "`code_id`, `code_amount`")
+        self.assertEqual(PromoAdapter.select([]), "`code_id`")
+        self.assertEqual(PromoAdapter.select().count("AS `code_contents`"), 1)
+        self.assertEqual(len(PromoAdapter.select().split(", ")), len(PromoAdapter.COLUMNS))
+
+    def test_lazy_contents(self):
+        promo = PromoAdapter({"code_id": 5, "code_contents": '{"1": 2}', "code_bitmap": 1})
+
+        self.assertEqual(promo.code_id, "5")
+        self.assertTrue(promo.bitmap)
+        self.assertIsNone(promo.decoded)
+        self.assertEqual(promo.contents, {"1": 2})
+        self.assertIs(promo.contents, promo.decoded)
+
+        # only the id has been selected
+        promo = PromoAdapter({"code_id": 5})
+
+        self.assertIsNone(promo.contents)
+        self.assertIsNone(promo.key)
+
+
+class TestContentAdapter(unittest.TestCase):
+    def test_select(self):
+        self.assertEqual(ContentAdapter.select(ContentAdapter.NAME_COLUMNS), "`content_id`, `content_name`")
+        self.assertNotIn("content_name", ContentAdapter.select(["content_json"]))
+
+    def test_lazy_payload(self):
+        content = ContentAdapter({"content_id": 1, "content_name": "gold", "content_json": '{"gold": [1, 2]}'})
+
+        self.assertIsNone(content.decoded)
+        self.assertEqual(content.payload, {"gold": [1, 2]})
+        self.assertEqual(content.payload_json, '{"gold": [1, 2]}')
+
+        with self.assertRaises(AttributeError):
+            content.something = True
+
+
+class TestPromoRedemption(unittest.TestCase):
+    def test_dumps(self):
+        redemption = PromoRedemption([
+            (ContentAdapter({"content_id": 1, "content_json": '{"gold": 100, "name": "/ü"}'}), 2),
+            (ContentAdapter({"content_id": 2, "content_json": '[]'}), 1)
+        ])
+
+        self.assertEqual(ujson.loads(redemption.dumps()), redemption.dump())
+        self.assertEqual(redemption.dump(), {
+            "result": [
+                {"payload": {"gold": 100, "name": "/ü"}, "amount": 2},
+                {"payload": [], "amount": 1}
+            ]
+        })
+
+        # the payloads are not decoded for the response
+        content = ContentAdapter({"content_id": 1, "content_json": '{"a": 1}'})
+
+        self.assertEqual(PromoRedemption([(content, 3)]).dumps(), '{"result":[{"payload":{"a": 1},"amount":3}]}')
+        self.assertIsNone(content.decoded)
+        self.assertEqual(PromoRedemption([]).dumps(), '{"result":[]}')
@@ -0,0 +1,163 @@
+from tornado.testing import AsyncTestCase, gen_test
+
+from anthill.promo.admission import AdmissionControl, AdmissionRejected
+
+from unittest import mock
+
+import asyncio
+
+
+class TestAdmissionControl(AsyncTestCase):
+    async def hold(self, admission, gamespace_id, release, admitted=None):
+        """
+        Takes a slot, and keeps it until `release` is done
+        """
+
+        async with admission.acquire(gamespace_id):
+            if admitted is not None:
+                admitted.append(gamespace_id)
+            await release
+
+    async def settle(self):
+        for i in range(0, 5):
+            await asyncio.sleep(0)
+
+    @gen_test
+    async def test_alone_takes_every_slot(self):
+        admission = AdmissionControl(max_in_flight=4, max_queue=4, queue_timeout=1.0, max_share=0.5)
+        release = asyncio.get_event_loop().create_future()
+
+        tasks = [asyncio.ensure_future(self.hold(admission, 1, release)) for i in range(0, 8)]
+        await self.settle()
+
+        # nobody else waits, so the share does not apply
+        self.assertEqual(admission.in_flight, 4)
+        self.assertEqual(admission.queued, 4)
+
+        release.set_result(True)
+        await asyncio.gather(*tasks)
+
+        self.assertEqual(admission.in_flight, 0)
+        self.assertEqual(admission.admitted, 8)
+        self.assertEqual(admission.shed, 0)
+
+    @gen_test
+    async def test_share_while_others_wait(self):
+        admission = AdmissionControl(max_in_flight=4, max_queue=8, queue_timeout=1.0, max_share=0.5)
+        releases = [asyncio.get_event_loop().create_future() for i in range(0, 8)]
+        admitted = []
+
+        tasks = [asyncio.ensure_future(self.hold(admission, 1, releases[i], admitted)) for i in range(0, 4)]
+        await self.settle()
+        tasks += [asyncio.ensure_future(self.hold(admission, 1, releases[i], admitted)) for i in range(4, 6)]
+        tasks += [asyncio.ensure_future(self.hold(admission, 2, releases[i], admitted)) for i in range(6, 8)]
+        await self.settle()
+
+        self.assertEqual(admitted, [1, 1, 1, 1])
+
+        # gamespace 1 is over its share, so the freed slots go to gamespace 2 first
+        releases[0].set_result(True)
+        releases[1].set_result(True)
+        await self.settle()
+
+        self.assertEqual(admitted[4:], [2, 2])
+
+        for release in releases:
+            if not release.done():
+                release.set_result(True)
+
+        await asyncio.gather(*tasks)
+        self.assertEqual(admitted.count(1), 6)
+
+    @gen_test
+    async def test_weights(self):
+        admission = AdmissionControl(max_in_flight=1, max_queue=100, queue_timeout=1.0, weights={"1": 2})
+        admitted = []
+
+        first = asyncio.get_event_loop().create_future()
+        tasks = [asyncio.ensure_future(self.hold(admission, 3, first))]
+        await self.settle()
+
+        done = asyncio.get_event_loop().create_future()
+        done.set_result(True)
+
+        for i in range(0, 6):
+            tasks.append(asyncio.ensure_future(self.hold(admission, 1, done, admitted)))
+            tasks.append(asyncio.ensure_future(self.hold(admission, 2, done, admitted)))
+
+        await self.settle()
+        first.set_result(True)
+        await asyncio.gather(*tasks)
+
+        # while both wait, gamespace 1 gets twice as many slots
+        self.assertEqual(admitted[:6].count(1), 4)
+        self.assertEqual(admitted[:6].count(2), 2)
+
+    @gen_test
+    async def test_full_queue_makes_room(self):
+        admission = AdmissionControl(max_in_flight=1, max_queue=4, queue_timeout=1.0, max_share=0.5)
+        release = asyncio.get_event_loop().create_future()
+
+        tasks = [asyncio.ensure_future(self.hold(admission, 1, release)) for i in range(0, 5)]
+        await self.settle()
+
+        self.assertEqual(admission.queued, 4)
+
+        # the newest waiter of gamespace 1 (over its share of the queue) gives its place up
+        tasks.append(asyncio.ensure_future(self.hold(admission, 2, release)))
+        await self.settle()
+
+        self.assertEqual(admission.queued, 4)
+        self.assertEqual(admission.tenant_stats(1).shed, 1)
+
+        release.set_result(True)
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+
+        self.assertIsInstance(results[4], AdmissionRejected)
+        self.assertEqual(len([result for result in results if result is None]), 5)
+
+        # and when the queue is full of gamespaces within their share, a newcomer is rejected
+        admission = AdmissionControl(max_in_flight=1, max_queue=2, queue_timeout=1.0, max_share=0.5)
+        release = asyncio.get_event_loop().create_future()
+
+        tasks = [asyncio.ensure_future(self.hold(admission, gamespace_id, release)) for gamespace_id in [1, 2, 3]]
+        await self.settle()
+
+        with self.assertRaises(AdmissionRejected):
+            await self.hold(admission, 4, release)
+
+        release.set_result(True)
+        await asyncio.gather(*tasks)
+
+    @gen_test
+    async def test_timeout(self):
+        admission = AdmissionControl(max_in_flight=1, max_queue=4, queue_timeout=0.05)
+        release = asyncio.get_event_loop().create_future()
+
+        task = asyncio.ensure_future(self.hold(admission, 1, release))
+        await self.settle()
+
+        with self.assertRaises(AdmissionRejected):
+            await self.hold(admission, 1, release)
+
+        self.assertEqual(admission.timed_out, 1)
+        self.assertEqual(admission.queued, 0)
+
+        release.set_result(True)
+        await task
+
+    @gen_test
+    async def test_prune_idle(self):
+        admission = AdmissionControl(max_in_flight=4, max_queue=4, queue_timeout=1.0)
+
+        done = asyncio.get_event_loop().create_future()
+        done.set_result(True)
+
+        with mock.patch.object(AdmissionControl, "TENANT_IDLE_TIMEOUT", -1), \
+                mock.patch.object(AdmissionControl, "PRUNE_INTERVAL", -1):
+            await self.hold(admission, 1, done)
+            self.assertIsNotNone(admission.tenant_stats(1))
+
+            await self.hold(admission, 2, done)
+            self.assertIsNone(admission.tenant_stats(1))
+            self.assertIsNotNone(admission.tenant_stats(2))
@@ -0,0 +1,78 @@
+import unittest
+
+from anthill.promo.model.bitmap import BitmapChunk, split_id, join_id
+
+
+class TestBitmapChunk(unittest.TestCase):
+    def test_add_remove(self):
+        chunk = BitmapChunk()
+
+        self.assertTrue(chunk.add(5))
+        self.assertTrue(chunk.add(1))
+        self.assertFalse(chunk.add(5))
+        self.assertEqual(list(chunk), [1, 5])
+        self.assertIn(5, chunk)
+        self.assertNotIn(2, chunk)
+
+        self.assertTrue(chunk.remove(5))
+        self.assertFalse(chunk.remove(5))
+        self.assertEqual(chunk.cardinality, 1)
+
+    def test_array_dump_load(self):
+        chunk = BitmapChunk()
+
+        for value in [0, 65535, 300, 7]:
+            chunk.add(value)
+
+        data = chunk.dump()
+
+        self.assertEqual(data[0:1], BitmapChunk.TYPE_ARRAY)
+        # little-endian, whatever the platform is
+        self.assertEqual(data[1:5], b"\x00\x00\x07\x00")
+        self.assertEqual(len(data), 1 + 4 * 2)
+
+        loaded = BitmapChunk.load(data)
+
+        self.assertEqual(list(loaded), [0, 7, 300, 65535])
+        self.assertEqual(loaded.cardinality, 4)
+
+    def test_bitmap_conversion(self):
+        chunk = BitmapChunk()
+
+        for value in range(0, BitmapChunk.ARRAY_LIMIT + 1):
+            chunk.add(value * 2)
+
+        self.assertIsNotNone(chunk.bits)
+
+        data = chunk.dump()
+
+        self.assertEqual(data[0:1], BitmapChunk.TYPE_BITMAP)
+        self.assertEqual(len(data), 1 + BitmapChunk.BITMAP_SIZE)
+        self.assertEqual(data[1:2], b"\x55")
+
+        loaded = BitmapChunk.load(data)
+
+        self.assertEqual(loaded.cardinality, BitmapChunk.ARRAY_LIMIT + 1)
+        self.assertEqual(list(loaded), list(range(0, (BitmapChunk.ARRAY_LIMIT + 1) * 2, 2)))
+        self.assertIn(8192, loaded)
+        self.assertNotIn(8193, loaded)
+
+        # stays a bitmap until it gets down to the half of the limit
+        for value in range(0, BitmapChunk.ARRAY_LIMIT // 2):
+            loaded.remove(value * 2)
+
+        self.assertIsNotNone(loaded.bits)
+
+        self.assertTrue(loaded.remove(BitmapChunk.ARRAY_LIMIT))
+
+        self.assertIsNone(loaded.bits)
+        self.assertEqual(loaded.cardinality, BitmapChunk.ARRAY_LIMIT // 2)
+        self.assertEqual(list(BitmapChunk.load(loaded.dump())), list(loaded))
+
+    def test_split_join(self):
+        self.assertEqual(split_id(5), (0, 5))
+        self.assertEqual(split_id(65536 + 3), (1, 3))
+        self.assertEqual(split_id(0xFFFFFFFF), (0xFFFF, 0xFFFF))
+
+        for value in [0, 1, 65535, 65536, 123456789, 0xFFFFFFFF]:
+            self.assertEqual(join_id(*split_id(value)), value)
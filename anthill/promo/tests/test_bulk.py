@@ -0,0 +1,148 @@
+from tornado.testing import AsyncTestCase, gen_test
+
+import unittest
+
+try:
+    from anthill.promo.model.bulk import BulkFilter, BulkJobError, BulkJobAdapter, BulkJobsModel
+except ImportError as e:
+    raise unittest.SkipTest("anthill-common is not available: " + str(e))
+
+
+class TestBulkFilter(unittest.TestCase):
+    def test_parse_time(self):
+        self.assertEqual(BulkFilter.parse_time("2020-05-01"), "2020-05-01 00:00:00")
+        self.assertEqual(BulkFilter.parse_time("2020-05-01 10:20"), "2020-05-01 10:20:00")
+        self.assertEqual(BulkFilter.parse_time("2020-05-01 10:20:30.123456"), "2020-05-01 10:20:30")
+        self.assertEqual(BulkFilter.parse_time(" 2020-05-01T10:20:30 "), "2020-05-01 10:20:30")
+
+        for value in ["", "tomorrow", "2020-13-01", "1' OR '1'='1"]:
+            with self.assertRaises(BulkJobError):
+                BulkFilter.parse_time(value)
+
+    def test_validate(self):
+        with self.assertRaises(BulkJobError):
+            BulkFilter().validate()
+
+        with self.assertRaises(BulkJobError):
+            BulkFilter(expires_to="next week").validate()
+
+        code_filter = BulkFilter(expires_from="2020-05-01", expires_to="2020-06-01 12:00")
+        code_filter.validate()
+
+        self.assertEqual(code_filter.expires_from, "2020-05-01 00:00:00")
+        self.assertEqual(code_filter.expires_to, "2020-06-01 12:00:00")
+
+    def test_conditions(self):
+        conditions, args = BulkFilter(key_prefix="A_B%", content_id=5).conditions()
+
+        self.assertEqual(
+            conditions, "`code_stocked`=0 AND `code_key` LIKE %s AND JSON_CONTAINS_PATH(`code_contents`, 'one', %s)")
+        self.assertEqual(args, ["A\\_B\\%%", "$.\"5\""])
+
+    def test_dump_load(self):
+        code_filter = BulkFilter(key_prefix="AB", expires_from="2020-05-01 00:00:00", content_id="3")
+        loaded = BulkFilter.load(code_filter.dump())
+
+        self.assertEqual(loaded.dump(), code_filter.dump())
+
+
+class FakeConnection(object):
+    def __init__(self, log):
+        self.log = log
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        pass
+
+    def acquire(self, auto_commit=True):
+        return self
+
+    async def commit(self):
+        self.log.append("commit")
+
+    async def rollback(self):
+        self.log.append("rollback")
+
+    async def execute(self, query, *args):
+        self.log.append(query.split()[0] + " " + query.split("`")[1])
+        return 1
+
+    async def query(self, query, *args):
+        # every candidate still matches
+        return [{"code_id": 1}, {"code_id": 2}]
+
+
+class FakeShards(object):
+    def __init__(self, db):
+        self.database = db
+
+    def db(self, workload, gamespace_id):
+        return self.database
+
+
+class FakePromos(object):
+    def __init__(self, log, added):
+        self.log = log
+        self.added = list(added)
+
+    async def delete_promo_usages(self, gamespace_id, promo_ids):
+        self.log.append("usages {0}".format(promo_ids))
+
+    async def fill_pool_chunk(self, db, gamespace_id, pool_id, keys_count, expires, contents):
+        self.log.append("fill {0}".format(keys_count))
+        return self.added.pop(0)
+
+
+class TestBulkJobs(AsyncTestCase):
+    def model(self, added=()):
+        log = []
+        model = BulkJobsModel(FakeShards(FakeConnection(log)), FakePromos(log, added), chunk_size=10)
+        return model, log
+
+    @gen_test
+    async def test_delete_usages_first(self):
+        model, log = self.model()
+        job = BulkJobAdapter({
+            "job_id": 1, "job_action": BulkJobsModel.ACTION_DELETE, "job_filter": {"key_prefix": "AB"},
+            "job_last_id": 0
+        })
+
+        self.assertEqual(await model.__process_chunk__(1, job), 2)
+
+        # the usages are deleted in their own small transactions before the chunk transaction starts
+        self.assertEqual(log[0], "usages [1, 2]")
+        self.assertEqual(log[1:], [
+            "DELETE promo_code_users", "DELETE promo_code_usage_chunks", "DELETE promo_code",
+            "UPDATE promo_bulk_jobs", "commit"
+        ])
+
+    @gen_test
+    async def test_fill(self):
+        model, log = self.model(added=[0, 0, 7])
+        job = BulkJobAdapter({
+            "job_id": 1, "job_action": BulkJobsModel.ACTION_FILL_POOL, "job_total": 25, "job_processed": 18,
+            "job_args": {"pool_id": 1, "expires": "2030-01-01 00:00:00", "contents": {"1": 1}}
+        })
+
+        # the chunks that only ran into existing keys are tried again
+        self.assertEqual(await model.__fill_chunk__(1, job), 7)
+        self.assertEqual(log, ["fill 7", "fill 7", "fill 7", "UPDATE promo_bulk_jobs", "commit"])
+
+        job.processed = 25
+        self.assertEqual(await model.__fill_chunk__(1, job), 0)
+
+    @gen_test
+    async def test_fill_saturated(self):
+        model, log = self.model(added=[0] * BulkJobsModel.FILL_ATTEMPTS)
+        job = BulkJobAdapter({
+            "job_id": 1, "job_action": BulkJobsModel.ACTION_FILL_POOL, "job_total": 100, "job_processed": 0,
+            "job_args": {"pool_id": 1, "expires": "2030-01-01 00:00:00", "contents": {"1": 1}}
+        })
+
+        with self.assertRaises(BulkJobError):
+            await model.__fill_chunk__(1, job)
+
+        self.assertEqual(log.count("fill 10"), BulkJobsModel.FILL_ATTEMPTS)
+        self.assertEqual(log[-1], "rollback")
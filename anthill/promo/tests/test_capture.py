@@ -0,0 +1,77 @@
+import unittest
+import tempfile
+import shutil
+import os
+
+from anthill.promo.capture import CapturedRequest, TrafficRecorder, read_captured, SOURCE_HTTP, SOURCE_INTERNAL
+
+
+class TestCapturedRequest(unittest.TestCase):
+    def test_dump_parse(self):
+        request = CapturedRequest(1500000000.1234, SOURCE_HTTP, 5, 123456, "K0123456789ab", 409, 12.34)
+        parsed = CapturedRequest.parse(request.dump())
+
+        self.assertEqual(parsed.time, 1500000000.123)
+        self.assertEqual(parsed.source, SOURCE_HTTP)
+        self.assertEqual(parsed.gamespace_id, 5)
+        self.assertEqual(parsed.account, 123456)
+        self.assertEqual(parsed.key, "K0123456789ab")
+        self.assertEqual(parsed.status, 409)
+        self.assertEqual(parsed.latency, 12.3)
+        self.assertTrue(parsed.is_valid_key())
+        self.assertEqual(parsed.dump(), request.dump())
+
+
+class TestTrafficRecorder(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_sanitize(self):
+        recorder = TrafficRecorder(os.path.join(self.path, "log"), "salt")
+        other = TrafficRecorder(os.path.join(self.path, "log"), "pepper")
+
+        self.assertEqual(recorder.sanitize_key("abcd-efgh-jklm"), recorder.sanitize_key("ABCD-EFGH-JKLM"))
+        self.assertNotEqual(recorder.sanitize_key("ABCD-EFGH-JKLM"), other.sanitize_key("ABCD-EFGH-JKLM"))
+        self.assertNotIn("ABCD", recorder.sanitize_key("ABCD-EFGH-JKLM"))
+        self.assertEqual(recorder.sanitize_key("nonsense"), "X8")
+
+        self.assertEqual(recorder.sanitize_account(100), recorder.sanitize_account("100"))
+        self.assertNotEqual(recorder.sanitize_account(100), recorder.sanitize_account(101))
+
+    def test_sampled_by_key(self):
+        recorder = TrafficRecorder(os.path.join(self.path, "log"), "salt", sample_rate=0.5)
+        keys = ["AAAA-AAAA-{0:04d}".format(i) for i in range(0, 1000)]
+
+        sampled = [key for key in keys if recorder.sampled(key)]
+
+        # every request for the same key goes the same way
+        self.assertEqual(sampled, [key for key in keys if recorder.sampled(key.lower())])
+        self.assertTrue(400 < len(sampled) < 600)
+
+        self.assertTrue(all(TrafficRecorder(None, "salt", sample_rate=1.0).sampled(key) for key in keys))
+        self.assertFalse(any(TrafficRecorder(None, "salt", sample_rate=0.0).sampled(key) for key in keys))
+
+    def test_record_and_read(self):
+        first = TrafficRecorder(os.path.join(self.path, "log.0"), "salt")
+        second = TrafficRecorder(os.path.join(self.path, "log.1"), "salt")
+
+        first.record(SOURCE_HTTP, 1000.0, 1, 10, "ABCD-EFGH-JKLM", 200)
+        second.record(SOURCE_INTERNAL, 999.0, 1, 10, "ABCD-EFGH-JKLM", 409)
+        first.record(SOURCE_HTTP, 1001.0, 1, 11, "bad", 400)
+
+        first.flush()
+        second.flush()
+
+        requests = read_captured([os.path.join(self.path, "log.0"), os.path.join(self.path, "log.1")])
+
+        self.assertEqual([request.time for request in requests], [999.0, 1000.0, 1001.0])
+        self.assertEqual([request.status for request in requests], [409, 200, 400])
+
+        # the workers share the salt, so the same account and key match across their logs
+        self.assertEqual(requests[0].account, requests[1].account)
+        self.assertEqual(requests[0].key, requests[1].key)
+        self.assertFalse(requests[2].is_valid_key())
+
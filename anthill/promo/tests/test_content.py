@@ -0,0 +1,76 @@
+from tornado.testing import AsyncTestCase, gen_test
+
+from unittest import mock
+
+import unittest
+
+try:
+    from anthill.common import database
+    from anthill.promo.model import pools
+    from anthill.promo.model.content import ContentModel, ContentAdapter
+    from anthill.promo.model.pools import PoolDatabase, ADMIN, PLAYER
+except ImportError as e:
+    raise unittest.SkipTest("anthill-common is not available: " + str(e))
+
+
+class FakeDb(object):
+    async def query(self, query, *args):
+        return [{"content_name": "gold"}]
+
+
+class FakeShards(object):
+    """
+    Remembers the workloads the databases were asked for
+    """
+
+    def __init__(self):
+        self.workloads = []
+
+    def db(self, workload, gamespace_id):
+        self.workloads.append(workload)
+        return FakeDb()
+
+
+class FakePool(object):
+    def __init__(self, *args, **kwargs):
+        self.max_connections = kwargs.pop("max_connections")
+        self.wait_connection_timeout = kwargs.pop("wait_connection_timeout")
+        self._idle_seconds = kwargs.pop("idle_seconds")
+        self._args = args
+        self._kwargs = kwargs
+
+
+def parent_init(self, host=None, database=None, user=None, password=None, *args, **kwargs):
+    self.pool = FakePool(
+        max_connections=256, wait_connection_timeout=15, idle_seconds=15,
+        host=host, db=database, user=user, passwd=password, charset="utf8", **kwargs)
+
+
+class TestPoolSelection(AsyncTestCase):
+    @gen_test
+    async def test_list_contents(self):
+        shards = FakeShards()
+        contents = ContentModel(shards)
+
+        await contents.list_contents(1)
+        items = await contents.list_contents(1, columns=ContentAdapter.NAME_COLUMNS, workload=PLAYER)
+
+        self.assertEqual(shards.workloads, [ADMIN, PLAYER])
+        self.assertEqual([item.name for item in items], ["gold"])
+
+    def test_pool_size(self):
+        with mock.patch.object(database.Database, "__init__", parent_init), \
+                mock.patch.object(pools.tormysql, "ConnectionPool", FakePool):
+            db = PoolDatabase(8, host="localhost", database="promo", user="anthill", password="secret",
+                              wait_connection_timeout=3, init_command="SET SESSION innodb_lock_wait_timeout=1")
+
+        self.assertEqual(db.max_connections, 8)
+        self.assertEqual(db.pool.max_connections, 8)
+        self.assertEqual(db.pool.wait_connection_timeout, 3)
+
+        # the rest is left as the parent has set it up
+        self.assertEqual(db.pool._idle_seconds, 15)
+        self.assertEqual(db.pool._kwargs, {
+            "host": "localhost", "db": "promo", "user": "anthill", "passwd": "secret", "charset": "utf8",
+            "init_command": "SET SESSION innodb_lock_wait_timeout=1"
+        })
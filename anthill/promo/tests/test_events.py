@@ -0,0 +1,102 @@
+from tornado.testing import AsyncTestCase, gen_test
+
+import unittest
+
+try:
+    from anthill.promo.model.events import RedemptionEventsModel, RedemptionEventAdapter
+except ImportError as e:
+    raise unittest.SkipTest("anthill-common is not available: " + str(e))
+
+
+class FakeSequenceDb(object):
+    """
+    Keeps the sequences of the gamespaces and the events, the way the statements of the model would
+    """
+
+    def __init__(self):
+        self.sequences = {}
+        self.events = []
+        self.queries = []
+
+    async def insert(self, query, *args):
+        if "`promo_redemption_sequences`" in query:
+            gamespace_id, = args
+            self.sequences[gamespace_id] = self.sequences.get(gamespace_id, 0) + 1
+            return self.sequences[gamespace_id]
+
+        gamespace_id, event_seq, code_id, code_key, account_id = args
+        self.events.append({
+            "gamespace_id": gamespace_id,
+            "event_seq": event_seq,
+            "code_id": code_id,
+            "code_key": code_key,
+            "account_id": account_id,
+            "event_time": None
+        })
+        return len(self.events)
+
+    async def query(self, query, *args):
+        gamespace_id, after, limit = args
+
+        self.queries.append(query)
+
+        return sorted(
+            (event for event in self.events if event["gamespace_id"] == gamespace_id and event["event_seq"] > after),
+            key=lambda event: event["event_seq"])[:limit]
+
+
+class FakeShards(object):
+    def __init__(self, db):
+        self.database = db
+
+    def db(self, workload, gamespace_id):
+        return self.database
+
+
+class TestRedemptionEvents(AsyncTestCase):
+    @gen_test
+    async def test_disabled(self):
+        db = FakeSequenceDb()
+        events = RedemptionEventsModel(FakeShards(db))
+
+        await events.record(db, 1, 10, "AAAA-AAAA-AAAA", 100)
+
+        self.assertEqual(db.events, [])
+        self.assertEqual(db.sequences, {})
+
+    @gen_test
+    async def test_sequence_per_gamespace(self):
+        db = FakeSequenceDb()
+        events = RedemptionEventsModel(FakeShards(db), enabled=True)
+
+        await events.record(db, 1, 10, "AAAA-AAAA-AAAA", 100)
+        await events.record(db, 2, 20, "BBBB-BBBB-BBBB", 200)
+        await events.record(db, 1, 10, "AAAA-AAAA-AAAA", 101)
+
+        self.assertEqual([(event["gamespace_id"], event["event_seq"]) for event in db.events], [(1, 1), (2, 1), (1, 2)])
+
+        listed = await events.list_events(1, after=0, limit=100)
+
+        self.assertEqual([event.event_id for event in listed], ["1", "2"])
+        self.assertEqual([event.account_id for event in listed], ["100", "101"])
+
+        # the cursor is the sequence of the gamespace, not the auto-increment id of the row
+        listed = await events.list_events(1, after=1, limit=100)
+
+        self.assertEqual([event.dump()["id"] for event in listed], ["2"])
+        # no time-based visibility, the order is guaranteed by the sequence
+        self.assertNotIn("event_time", db.queries[-1])
+
+    def test_dump(self):
+        event = RedemptionEventAdapter({
+            "event_id": 500, "event_seq": 3, "code_id": 10, "code_key": "AAAA-AAAA-AAAA", "account_id": 100,
+            "event_time": "2020-05-01 00:00:00"
+        })
+
+        self.assertEqual(event.dump(), {
+            "id": "3",
+            "code_id": "10",
+            "key": "AAAA-AAAA-AAAA",
+            "account": "100",
+            "time": "2020-05-01 00:00:00"
+        })
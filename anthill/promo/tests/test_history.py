@@ -0,0 +1,131 @@
+from tornado.testing import AsyncTestCase, gen_test
+
+import unittest
+
+try:
+    from anthill.promo.model.promo import PromoModel
+    from anthill.promo.model.bitmap import BitmapChunk, split_id
+except ImportError as e:
+    raise unittest.SkipTest("anthill-common is not available: " + str(e))
+
+try:
+    from anthill.promo.handlers import InternalHandler
+except ImportError:
+    InternalHandler = None
+
+
+class FakeUsagesDb(object):
+    """
+    Keeps the usage records of an account and the bitmaps of the codes, the way the statements would read them
+    """
+
+    def __init__(self, records, bitmaps=None):
+        self.records = records
+        self.bitmaps = bitmaps or {}
+        self.queries = []
+
+    async def query(self, query, *args):
+        self.queries.append((query, args))
+
+        if "`promo_code_usage_chunks`" in query:
+            gamespace_id, chunk_id = args
+            return [
+                {"code_id": code_id, "code_key": code_key, "chunk_data": chunk.dump()}
+                for (code_id, code_key, bitmap_chunk_id), chunk in self.bitmaps.items()
+                if bitmap_chunk_id == chunk_id
+            ]
+
+        if "u.`record_id`<%s" in query:
+            gamespace_id, account_id, before, limit = args
+        else:
+            (gamespace_id, account_id, limit), before = args, None
+
+        records = sorted(self.records, key=lambda record: record["record_id"], reverse=True)
+        return [record for record in records if before is None or record["record_id"] < before][:limit]
+
+
+class FakeShards(object):
+    def __init__(self, db):
+        self.database = db
+
+    def db(self, workload, gamespace_id):
+        return self.database
+
+
+class FakeApplication(object):
+    def __init__(self, promos):
+        self.promos = promos
+
+
+def usage(record_id):
+    return {"record_id": record_id, "code_id": record_id * 10, "code_key": "KEY-" + str(record_id)}
+
+
+class TestAccountUsages(AsyncTestCase):
+    @gen_test
+    async def test_before(self):
+        db = FakeUsagesDb([usage(record_id) for record_id in range(1, 8)])
+        promos = PromoModel(FakeShards(db), None)
+
+        first = await promos.get_account_usages(1, 100, limit=3)
+        self.assertEqual([u.usage_id for u in first], ["7", "6", "5"])
+
+        second = await promos.get_account_usages(1, 100, limit=3, before=int(first[-1].usage_id))
+        self.assertEqual([u.usage_id for u in second], ["4", "3", "2"])
+        self.assertIn("u.`record_id`<%s", db.queries[-1][0])
+
+        last = await promos.get_account_usages(1, 100, limit=3, before=2)
+        self.assertEqual([u.dump() for u in last], [{"id": "1", "code_id": "10", "key": "KEY-1"}])
+
+        # the records of the codes converted to a bitmap are left to the bitmap listing
+        self.assertIn("`code_bitmap`", db.queries[-1][0])
+
+    @gen_test
+    async def test_bitmap_usages(self):
+        account_id = 70000
+        chunk_id, value = split_id(account_id)
+
+        used = BitmapChunk()
+        used.add(value)
+
+        other = BitmapChunk()
+        other.add(value + 1)
+
+        db = FakeUsagesDb([], bitmaps={
+            (1, "AAAA-AAAA-AAAA", chunk_id): used,
+            (2, "BBBB-BBBB-BBBB", chunk_id): other,
+            (3, "CCCC-CCCC-CCCC", chunk_id + 1): used
+        })
+
+        promos = PromoModel(FakeShards(db), None)
+        usages = await promos.get_account_bitmap_usages(1, str(account_id))
+
+        self.assertEqual([u.dump() for u in usages], [{"id": None, "code_id": "1", "key": "AAAA-AAAA-AAAA"}])
+
+
+@unittest.skipIf(InternalHandler is None, "handlers are not available")
+class TestAccountHistory(AsyncTestCase):
+    @gen_test
+    async def test_next(self):
+        used = BitmapChunk()
+        used.add(split_id(100)[1])
+
+        db = FakeUsagesDb([usage(record_id) for record_id in range(1, 6)], bitmaps={
+            (9, "ZZZZ-ZZZZ-ZZZZ", split_id(100)[0]): used
+        })
+
+        handler = InternalHandler(FakeApplication(PromoModel(FakeShards(db), None)))
+
+        page = await handler.get_account_history(gamespace="1", account="100", limit="2")
+        self.assertEqual([u["id"] for u in page["usages"]], ["5", "4"])
+        self.assertEqual(page["next"], "4")
+        # can't be paginated, so all of them go with the first page
+        self.assertEqual([u["key"] for u in page["bitmap_usages"]], ["ZZZZ-ZZZZ-ZZZZ"])
+
+        page = await handler.get_account_history(gamespace="1", account="100", limit="2", before=page["next"])
+        self.assertEqual([u["id"] for u in page["usages"]], ["3", "2"])
+        self.assertEqual(page["bitmap_usages"], [])
+
+        page = await handler.get_account_history(gamespace="1", account="100", limit="2", before=page["next"])
+        self.assertEqual([u["id"] for u in page["usages"]], ["1"])
+        self.assertIsNone(page["next"])
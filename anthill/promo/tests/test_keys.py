@@ -0,0 +1,59 @@
+import unittest
+
+try:
+    from anthill.promo.model.promo import PromoModel, PromoError
+except ImportError as e:
+    raise unittest.SkipTest("anthill-common is not available: " + str(e))
+
+
+class TestIntegerKeys(unittest.TestCase):
+    def test_round_trip(self):
+        model = PromoModel(None, None)
+
+        for key in ["0000-0000-0000", "ZZZZ-ZZZZ-ZZZZ", "ABCD-EFGH-0123", "0000-0000-0001", "1000-0000-0000"]:
+            self.assertEqual(PromoModel.decode_key(PromoModel.encode_key(key)), key)
+
+        for i in range(0, 100):
+            key = model.random()
+            self.assertEqual(PromoModel.decode_key(PromoModel.encode_key(key)), key)
+
+    def test_boundaries(self):
+        self.assertEqual(PromoModel.encode_key("0000-0000-0000"), 0)
+        self.assertEqual(PromoModel.encode_key("0000-0000-000Z"), 35)
+        self.assertEqual(PromoModel.encode_key("ZZZZ-ZZZZ-ZZZZ"), 36 ** 12 - 1)
+
+        # fits an unsigned BIGINT
+        self.assertLessEqual(36 ** 12, 2 ** 64)
+
+        self.assertEqual(PromoModel.decode_key(0), "0000-0000-0000")
+        self.assertEqual(PromoModel.decode_key(36 ** 12 - 1), "ZZZZ-ZZZZ-ZZZZ")
+
+    def test_invalid(self):
+        self.assertEqual(PromoModel.encode_key("abcd-efgh-0123"), PromoModel.encode_key("ABCD-EFGH-0123"))
+
+        for key in ["", "ABCD-EFGH", "ABCD-EFGH-01234", "ABCDEFGH0123", "ABCD-EFGH-012_", " ABCD-EFGH-0123"]:
+            self.assertIsNone(PromoModel.encode_key(key))
+
+    def test_lookups(self):
+        model = PromoModel(None, None)
+
+        self.assertEqual(model.key_columns("ABCD-EFGH-0123"), (["code_key"], ["ABCD-EFGH-0123"]))
+        self.assertEqual(model.__keys_condition__(["ABCD-EFGH-0123"]), ("`code_key` IN %s", [["ABCD-EFGH-0123"]]))
+
+        model = PromoModel(None, None, key_storage=PromoModel.KEY_STORAGE_INTEGER)
+        encoded = PromoModel.encode_key("ABCD-EFGH-0123")
+
+        with self.assertRaises(PromoError):
+            model.key_columns("nonsense")
+
+        self.assertEqual(model.key_columns("ABCD-EFGH-0123"), (["code_key", "code_key_int"], ["ABCD-EFGH-0123", encoded]))
+
+        # until the keys are backfilled, the codes are also looked up by the string keys
+        self.assertEqual(len(model.__key_lookups__("ABCD-EFGH-0123")), 2)
+        self.assertIn("`code_key` IN %s", model.__keys_condition__(["ABCD-EFGH-0123"])[0])
+
+        model.keys_backfilled = True
+
+        self.assertEqual(model.__key_lookups__("ABCD-EFGH-0123"), [("`code_key_int`=%s", encoded)])
+        self.assertEqual(model.__key_lookups__("nonsense"), [])
+        self.assertEqual(model.__keys_condition__(["ABCD-EFGH-0123"]), ("`code_key_int` IN %s", [[encoded]]))
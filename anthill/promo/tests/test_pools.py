@@ -0,0 +1,14 @@
+import unittest
+
+try:
+    from anthill.promo.model.pools import DatabasePools
+except ImportError as e:
+    raise unittest.SkipTest("anthill-common is not available: " + str(e))
+
+
+class TestDatabasePools(unittest.TestCase):
+    def test_lock_wait_timeout(self):
+        self.assertEqual(DatabasePools.__session__(None), {})
+        self.assertEqual(DatabasePools.__session__(1), {
+            "init_command": "SET SESSION innodb_lock_wait_timeout=1"
+        })
@@ -0,0 +1,118 @@
+from tornado.testing import AsyncTestCase, gen_test
+
+from unittest import mock
+
+import unittest
+
+try:
+    from anthill.common.database import DatabaseError
+    from anthill.promo.model import retry
+    from anthill.promo.model.retry import retry_transaction, is_retryable, TransactionRetriesExceeded
+except ImportError as e:
+    raise unittest.SkipTest("anthill-common is not available: " + str(e))
+
+
+class FakeClock(object):
+    """
+    Time that only moves when slept
+    """
+
+    def __init__(self):
+        self.now = 0.0
+        self.delays = []
+
+    def monotonic(self):
+        return self.now
+
+    async def sleep(self, delay):
+        self.delays.append(delay)
+        self.now += delay
+
+
+class FailingTransaction(object):
+    def __init__(self, errors, result="done"):
+        self.errors = list(errors)
+        self.result = result
+        self.attempts = 0
+
+    async def __call__(self):
+        self.attempts += 1
+
+        if self.errors:
+            raise self.errors.pop(0)
+
+        return self.result
+
+
+def deadlock():
+    return DatabaseError(retry.ER_LOCK_DEADLOCK, "Deadlock found when trying to get lock")
+
+
+class TestRetryTransaction(AsyncTestCase):
+    def setUp(self):
+        super(TestRetryTransaction, self).setUp()
+
+        self.clock = FakeClock()
+
+        # the jitter always takes the whole delay
+        patches = [
+            mock.patch.object(retry, "sleep", self.clock.sleep),
+            mock.patch.object(retry.time, "monotonic", self.clock.monotonic),
+            mock.patch.object(retry.random, "uniform", lambda low, high: high)
+        ]
+
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def test_is_retryable(self):
+        self.assertTrue(is_retryable(DatabaseError(retry.ER_LOCK_DEADLOCK, "Deadlock")))
+        self.assertTrue(is_retryable(DatabaseError(retry.ER_LOCK_WAIT_TIMEOUT, "Lock wait timeout exceeded")))
+        self.assertFalse(is_retryable(DatabaseError(1062, "Duplicate entry")))
+        self.assertFalse(is_retryable(DatabaseError()))
+        self.assertFalse(is_retryable(ValueError(retry.ER_LOCK_DEADLOCK)))
+
+    @gen_test
+    async def test_no_errors(self):
+        transaction = FailingTransaction([])
+
+        self.assertEqual(await retry_transaction(transaction, budget=1.0), ("done", 0))
+        self.assertEqual(self.clock.delays, [])
+
+    @gen_test
+    async def test_backoff(self):
+        transaction = FailingTransaction([deadlock() for i in range(0, 7)])
+
+        result = await retry_transaction(transaction, budget=10.0, base_delay=0.01, max_delay=0.5)
+
+        self.assertEqual(result, ("done", 7))
+        self.assertEqual(transaction.attempts, 8)
+        # doubled every time, up to max_delay
+        self.assertEqual(self.clock.delays, [0.01, 0.02, 0.04, 0.08, 0.16, 0.32, 0.5])
+
+    @gen_test
+    async def test_not_retryable(self):
+        transaction = FailingTransaction([DatabaseError(1062, "Duplicate entry")])
+
+        with self.assertRaises(DatabaseError):
+            await retry_transaction(transaction, budget=10.0)
+
+        self.assertEqual(transaction.attempts, 1)
+
+        transaction = FailingTransaction([ValueError("something else")])
+
+        with self.assertRaises(ValueError):
+            await retry_transaction(transaction, budget=10.0)
+
+    @gen_test
+    async def test_budget(self):
+        transaction = FailingTransaction([deadlock() for i in range(0, 100)])
+
+        with self.assertRaises(TransactionRetriesExceeded) as raised:
+            await retry_transaction(transaction, budget=0.2, base_delay=0.01, max_delay=0.5)
+
+        # 0.01 + 0.02 + 0.04 + 0.08 fits, the next 0.16 would not
+        self.assertEqual(raised.exception.retries, 4)
+        self.assertEqual(transaction.attempts, 5)
+        self.assertTrue(is_retryable(raised.exception.error))
+        self.assertLessEqual(self.clock.now, 0.2)
@@ -0,0 +1,223 @@
+from tornado.testing import AsyncTestCase, gen_test
+
+from unittest import mock
+
+import unittest
+
+try:
+    from anthill.promo.model import shards
+    from anthill.promo.model.shards import ShardMap, ShardMoving, ShardMoveLost, GamespaceMove, DEFAULT_SHARD
+    from anthill.promo.model.pools import ADMIN, PLAYER
+except ImportError as e:
+    raise unittest.SkipTest("anthill-common is not available: " + str(e))
+
+
+class FakeDb(object):
+    """
+    A database of a shard, answers the statements with `handler(shard_name, method, query, args)`
+    """
+
+    def __init__(self, shard_name, workload, log, handler):
+        self.shard_name = shard_name
+        self.workload = workload
+        self.log = log
+        self.handler = handler
+
+    async def __run__(self, method, query, args):
+        self.log.append((self.shard_name, method, query, args))
+        return self.handler(self.shard_name, method, query, args)
+
+    async def execute(self, query, *args):
+        return await self.__run__("execute", query, args)
+
+    async def get(self, query, *args):
+        return await self.__run__("get", query, args)
+
+    async def query(self, query, *args):
+        return await self.__run__("query", query, args)
+
+
+class FakePools(object):
+    def __init__(self, shard_name, log, handler):
+        self.shard_name = shard_name
+        self.log = log
+        self.handler = handler
+
+    def db(self, workload):
+        return FakeDb(self.shard_name, workload, self.log, self.handler)
+
+
+class TestShards(AsyncTestCase):
+    def shard_map(self, handler):
+        log = []
+
+        with mock.patch.object(shards, "DatabasePools", lambda **kwargs: FakePools(DEFAULT_SHARD, log, handler)):
+            shard_map = ShardMap({}, {}, move_batch_size=10)
+
+        shard_map.shards["big"] = FakePools("big", log, handler)
+        return shard_map, log
+
+    @staticmethod
+    def statements(log, text):
+        return [(shard_name, args) for shard_name, method, query, args in log if text in query]
+
+    @gen_test
+    async def test_routing(self):
+        def handler(shard_name, method, query, args):
+            return [
+                {"gamespace_id": 1, "shard_name": "big", "shard_moving": 0},
+                {"gamespace_id": 2, "shard_name": "big", "shard_moving": 1},
+                {"gamespace_id": 3, "shard_name": "gone", "shard_moving": 0}
+            ]
+
+        shard_map, log = self.shard_map(handler)
+        await shard_map.reload()
+
+        db = shard_map.db(PLAYER, 1)
+
+        self.assertEqual((db.shard_name, db.workload), ("big", PLAYER))
+        self.assertEqual(shard_map.db(ADMIN, "1").shard_name, "big")
+        self.assertEqual(shard_map.shard_of(1), "big")
+
+        # not in the map
+        self.assertEqual(shard_map.db(PLAYER, 4).shard_name, DEFAULT_SHARD)
+        self.assertEqual(shard_map.shard_of(4), DEFAULT_SHARD)
+
+        # being moved, or mapped to a shard that is not configured
+        for gamespace_id in [2, 3]:
+            with self.assertRaises(ShardMoving):
+                shard_map.db(PLAYER, gamespace_id)
+
+        self.assertEqual([db.shard_name for db in shard_map.all(PLAYER)], [DEFAULT_SHARD, "big"])
+
+    @gen_test
+    async def test_recover_moves(self):
+        stale = {
+            "gamespace_id": 1, "move_source": DEFAULT_SHARD, "move_target": "big", "move_token": "lost",
+            "move_copied": {"promo_code": 20}
+        }
+
+        def handler(shard_name, method, query, args):
+            if method == "query":
+                return [stale]
+            if "`promo_shard_map`" in query:
+                # nothing left marked as moving
+                return 0
+            return 1
+
+        shard_map, log = self.shard_map(handler)
+        loop = mock.Mock()
+
+        with mock.patch.object(shards.IOLoop, "current", return_value=loop):
+            await shard_map.recover_moves()
+
+        recover, = loop.spawn_callback.call_args[0]
+        move = recover.__self__
+
+        self.assertEqual(recover.__name__, "recover")
+        self.assertEqual((move.gamespace_id, move.source, move.target), (1, DEFAULT_SHARD, "big"))
+        self.assertEqual(move.copied["promo_code"], 20)
+
+        # claimed with a new token, only if still held by the old one
+        claim, = self.statements(log, "SET `move_token`=%s")
+        self.assertEqual(claim[1][0], move.token)
+        self.assertNotEqual(move.token, "lost")
+        self.assertEqual(claim[1][3], "lost")
+
+    @gen_test
+    async def test_recover_moves_claimed(self):
+        def handler(shard_name, method, query, args):
+            if method == "query":
+                return [{"gamespace_id": 1, "move_source": DEFAULT_SHARD, "move_target": "big", "move_token": "lost"}]
+            # recovered by another process already
+            return 0
+
+        shard_map, log = self.shard_map(handler)
+        loop = mock.Mock()
+
+        with mock.patch.object(shards.IOLoop, "current", return_value=loop):
+            await shard_map.recover_moves()
+
+        loop.spawn_callback.assert_not_called()
+
+    @gen_test
+    async def test_recover_switched(self):
+        def handler(shard_name, method, query, args):
+            if "`promo_shard_map`" in query:
+                return {"shard_name": "big"}
+            return 0 if "DELETE" in query else 1
+
+        shard_map, log = self.shard_map(handler)
+        move = GamespaceMove(shard_map, 1, DEFAULT_SHARD, "big", 10, settle_delay=0)
+
+        await move.recover()
+
+        # the gamespace is on the target already, so only the source is cleaned up
+        purged = self.statements(log, "DELETE")
+
+        self.assertEqual({shard_name for shard_name, args in purged}, {DEFAULT_SHARD})
+        self.assertEqual(len(purged), len(GamespaceMove.TABLES))
+        self.assertEqual(move.status, GamespaceMove.STATUS_COMPLETE)
+
+    @gen_test
+    async def test_recover_not_switched(self):
+        def handler(shard_name, method, query, args):
+            if method == "get":
+                return {"shard_name": DEFAULT_SHARD}
+            return 0 if "DELETE" in query else 1
+
+        shard_map, log = self.shard_map(handler)
+        move = GamespaceMove(shard_map, 1, DEFAULT_SHARD, "big", 10, settle_delay=0)
+
+        await move.recover()
+
+        # the copy is deleted from the target, and the gamespace is returned to the source
+        self.assertEqual({shard_name for shard_name, args in self.statements(log, "DELETE")}, {"big"})
+        self.assertEqual(self.statements(log, "INSERT INTO `promo_shard_map`")[-1][1], (1, DEFAULT_SHARD, 0))
+        self.assertEqual(shard_map.shard_of(1), DEFAULT_SHARD)
+        self.assertNotIn("1", shard_map.moving)
+        self.assertEqual((move.status, move.error), (GamespaceMove.STATUS_FAILED, "Interrupted"))
+
+    @gen_test
+    async def test_token_ownership(self):
+        owner = {"move_token": None, "move_status": GamespaceMove.STATUS_RUNNING}
+
+        def handler(shard_name, method, query, args):
+            if method == "get":
+                return owner
+            # nothing updated, either nothing has changed or the token is not ours
+            return 0
+
+        shard_map, log = self.shard_map(handler)
+        move = GamespaceMove(shard_map, 1, DEFAULT_SHARD, "big", 10, settle_delay=0)
+
+        owner["move_token"] = move.token
+        await move.__save__("copying promo_code")
+
+        owner["move_token"] = "another"
+
+        with self.assertRaises(ShardMoveLost):
+            await move.__save__("copying promo_code")
+
+        owner.update(move_token=move.token, move_status=GamespaceMove.STATUS_FAILED)
+
+        with self.assertRaises(ShardMoveLost):
+            await move.__save__("copying promo_code")
+
+    @gen_test
+    async def test_run_lost(self):
+        def handler(shard_name, method, query, args):
+            if method == "get":
+                return {"move_token": "another", "move_status": GamespaceMove.STATUS_RUNNING}
+            return 0 if "UPDATE `promo_shard_moves`" in query else 1
+
+        shard_map, log = self.shard_map(handler)
+        move = GamespaceMove(shard_map, 1, DEFAULT_SHARD, "big", 10, settle_delay=0)
+
+        await move.run()
+
+        # stopped at once: nothing is deleted, returned or finished on behalf of the new owner
+        self.assertEqual(self.statements(log, "DELETE"), [])
+        self.assertEqual(self.statements(log, "`move_status`=%s, `move_stage`=%s"), [])
+        self.assertEqual(len(self.statements(log, "INSERT INTO `promo_shard_map`")), 1)
+        self.assertEqual(move.status, GamespaceMove.STATUS_RUNNING)
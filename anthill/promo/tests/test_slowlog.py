@@ -0,0 +1,60 @@
+from tornado.testing import AsyncTestCase, gen_test
+
+import unittest
+
+try:
+    from anthill.common.database import DatabaseError
+    from anthill.common.model import Model
+    from anthill.promo.model.slowlog import SlowQueryLog
+except ImportError as e:
+    raise unittest.SkipTest("anthill-common is not available: " + str(e))
+
+
+class FakeTarget(object):
+    async def get(self, query, *args):
+        return {"code_id": 1}
+
+    async def execute(self, query, *args):
+        raise DatabaseError(1062, "Duplicate entry '5-ABCDEFGHJKLM' for key 'PRIMARY'")
+
+
+class FakeModel(Model):
+    def __init__(self, slow_log):
+        self.slow_log = slow_log
+
+    async def find(self, gamespace_id, method, *args):
+        return await self.slow_log.run(FakeTarget(), method, "SELECT  *\n FROM `promo_code`;", args)
+
+
+class TestSlowQueryLog(AsyncTestCase):
+    def test_describe_args(self):
+        self.assertEqual(
+            SlowQueryLog.describe_args((1, "ABCDEFGHJKLM", [1, 2, 3], None, 1.5)),
+            "int, str(12), list(3), NULL, float")
+
+        self.assertTrue(SlowQueryLog.describe_args(tuple(range(0, 100))).endswith("int, ..."))
+
+    @gen_test
+    async def test_record(self):
+        slow_log = SlowQueryLog(threshold=0)
+        model = FakeModel(slow_log)
+
+        await model.find(1, "get", "ABCDEFGHJKLM", 100500)
+        await model.find(2, "get", "ZZZZZZZZZZZZ")
+
+        with self.assertRaises(DatabaseError):
+            await model.find(1, "execute", "ABCDEFGHJKLM")
+
+        queries = slow_log.recent(1)
+
+        self.assertEqual(len(queries), 2)
+        self.assertEqual([query.gamespace_id for query in queries], [1, 1])
+        self.assertEqual(queries[1].method, "FakeModel.find")
+        self.assertEqual(queries[1].query, "SELECT * FROM `promo_code`;")
+
+        # neither the keys nor the accounts are kept
+        self.assertEqual(queries[1].args, "str(12), int")
+        self.assertNotIn("ABCDEFGHJKLM", queries[0].error)
+
+        self.assertEqual(len(slow_log.recent("2")), 1)
+        self.assertEqual(slow_log.recent(3), [])
@@ -0,0 +1,172 @@
+from tornado.testing import AsyncTestCase, gen_test
+
+from unittest import mock
+
+import unittest
+
+try:
+    from anthill.common.database import DuplicateError
+    from anthill.promo.model.stock import KeyStockModel
+    from anthill.promo.model.promo import PromoModel
+except ImportError as e:
+    raise unittest.SkipTest("anthill-common is not available: " + str(e))
+
+
+class FakeConnection(object):
+    """
+    Answers the statements with `handler(method, query, args)`, and remembers how the transaction ended
+    """
+
+    def __init__(self, handler):
+        self.handler = handler
+        self.statements = []
+        self.committed = 0
+        self.rolled_back = 0
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        pass
+
+    def acquire(self, auto_commit=True):
+        return self
+
+    async def commit(self):
+        self.committed += 1
+
+    async def rollback(self):
+        self.rolled_back += 1
+
+    async def __run__(self, method, query, args):
+        self.statements.append((method, query, args))
+        return self.handler(method, query, args)
+
+    async def execute(self, query, *args):
+        return await self.__run__("execute", query, args)
+
+    async def get(self, query, *args):
+        return await self.__run__("get", query, args)
+
+    async def insert(self, query, *args):
+        return await self.__run__("insert", query, args)
+
+    async def query(self, query, *args):
+        return await self.__run__("query", query, args)
+
+
+class FakeShards(object):
+    def __init__(self, db):
+        self.database = db
+
+    def db(self, workload, gamespace_id):
+        return self.database
+
+
+class TestKeyStock(AsyncTestCase):
+    def stock(self, handler, size=10, threshold=5):
+        db = FakeConnection(handler)
+        stock = KeyStockModel(FakeShards(db), PromoModel(None, None), size=size, threshold=threshold)
+        stock.__check__ = mock.Mock()
+        return stock, db
+
+    @gen_test
+    async def test_disabled(self):
+        stock, db = self.stock(None, size=0)
+
+        self.assertFalse(KeyStockModel(None, None).enabled())
+        self.assertEqual(await stock.take(1, 5, 1, "2030-01-01 00:00:00", {}), [])
+        self.assertEqual(db.statements, [])
+
+    @gen_test
+    async def test_take(self):
+        stocked = [
+            {"stock_id": 1, "code_id": 10, "code_key": "AAAA-AAAA-AAAA"},
+            {"stock_id": 2, "code_id": 11, "code_key": "BBBB-BBBB-BBBB"}
+        ]
+
+        def handler(method, query, args):
+            if "SKIP LOCKED" in query:
+                return stocked
+            if "UPDATE `promo_code`" in query:
+                return len(args[-1])
+            return len(args[0])
+
+        stock, db = self.stock(handler)
+
+        keys = await stock.take(1, 5, 3, "2030-01-01 00:00:00", {"1": 1})
+
+        self.assertEqual(keys, ["AAAA-AAAA-AAAA", "BBBB-BBBB-BBBB"])
+        self.assertEqual(db.committed, 1)
+        self.assertIn("DELETE", db.statements[-1][1])
+        self.assertEqual(db.statements[-1][2], ([1, 2],))
+
+        # got less than asked, so the stock is refilled right away
+        stock.__check__.assert_called_once_with(1, short=True)
+
+    @gen_test
+    async def test_take_out_of_sync(self):
+        def handler(method, query, args):
+            if "SKIP LOCKED" in query:
+                return [{"stock_id": 1, "code_id": 10, "code_key": "AAAA-AAAA-AAAA"}]
+            # the code has been taken from the stock another way
+            return 0
+
+        stock, db = self.stock(handler)
+
+        self.assertEqual(await stock.take(1, 1, 3, "2030-01-01 00:00:00", {}), [])
+        self.assertEqual(db.rolled_back, 1)
+        self.assertFalse(any("DELETE" in query for method, query, args in db.statements))
+
+    @gen_test
+    async def test_reserve(self):
+        inserted = []
+
+        def handler(method, query, args):
+            if "COUNT(*)" in query:
+                return {"count": 7}
+            if method == "insert":
+                inserted.append(args)
+                # the second key collides with an existing code
+                if len(inserted) == 2:
+                    raise DuplicateError(1062, "Duplicate entry")
+                return len(inserted)
+            return 1
+
+        stock, db = self.stock(handler, size=10)
+
+        # only up to the size
+        self.assertEqual(await stock.__reserve__(db, 1, None), 2)
+        self.assertEqual(len(inserted), 3)
+        self.assertEqual(db.committed, 1)
+
+        # the refills of the same stock are serialized before the level is counted
+        self.assertIn("`promo_code_stock_refills`", db.statements[0][1])
+
+        stock_insert = db.statements[-1]
+        self.assertIn("INSERT INTO `promo_code_stock`", stock_insert[1])
+        self.assertEqual(len(stock_insert[2]), 2 * 3)
+
+        # not below the threshold
+        self.assertEqual(await stock.__reserve__(db, 1, 5), 0)
+
+    @gen_test
+    async def test_refill(self):
+        levels = [0, 4, 8, 10]
+
+        def handler(method, query, args):
+            if "COUNT(*)" in query:
+                return {"count": levels.pop(0)}
+            if method == "insert":
+                return 1
+            return 0
+
+        stock, db = self.stock(handler, size=10, threshold=5)
+
+        with mock.patch.object(KeyStockModel, "REFILL_BATCH", 4):
+            await stock.refill(1, threshold=5)
+
+        # once started, goes on until full
+        self.assertEqual(levels, [])
+        self.assertEqual(stock.refilling, set())
+        self.assertIn("LEFT JOIN", db.statements[0][1])
@@ -0,0 +1,197 @@
+from unittest import mock
+
+import unittest
+import signal
+
+try:
+    from anthill.promo import workers
+    from anthill.promo.workers import WorkerSupervisor
+except ImportError as e:
+    raise unittest.SkipTest("anthill-common is not available: " + str(e))
+
+try:
+    from anthill.promo.server import PromoServer
+except ImportError:
+    PromoServer = None
+
+
+class WorkerExit(Exception):
+    pass
+
+
+class FakeProcesses(object):
+    """
+    Stands for the processes of the supervisor: forks give out new pids, and the children exit with
+    `waitpid(supervisor)` returning (pid, status), or (0, 0) while nobody has exited. Time only moves when slept.
+    """
+
+    def __init__(self, waitpid):
+        self.now = 0.0
+        self.next_pid = 100
+        self.forks = []
+        self.killed = []
+        self.supervisor = None
+        self.handler = waitpid
+
+    def fork(self):
+        self.next_pid += 1
+        self.forks.append((self.next_pid, self.now))
+        return self.next_pid
+
+    def waitpid(self, pid, options):
+        return self.handler(self.supervisor)
+
+    def kill(self, pid, sig):
+        self.killed.append((pid, sig))
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, delay):
+        self.now += delay
+
+    def run(self, supervisor, target=None):
+        self.supervisor = supervisor
+
+        patches = [
+            mock.patch.object(workers.os, "fork", self.fork),
+            mock.patch.object(workers.os, "waitpid", self.waitpid),
+            mock.patch.object(workers.os, "kill", self.kill),
+            mock.patch.object(workers.time, "monotonic", self.monotonic),
+            mock.patch.object(workers.time, "sleep", self.sleep),
+            mock.patch.object(workers.signal, "signal")
+        ]
+
+        for patch in patches:
+            patch.start()
+
+        try:
+            supervisor.run([], target or mock.Mock())
+        finally:
+            for patch in patches:
+                patch.stop()
+
+
+def exited(code):
+    return code << 8
+
+
+class TestWorkerSupervisor(unittest.TestCase):
+    def test_restart(self):
+        def waitpid(supervisor):
+            if len(processes.forks) == 2 and 101 in supervisor.workers:
+                return 101, exited(1)
+
+            if len(processes.forks) == 3 and not supervisor.stopping:
+                supervisor.__stop__(signal.SIGTERM, None)
+
+            if supervisor.stopping and supervisor.workers:
+                return next(iter(supervisor.workers)), exited(0)
+
+            return 0, 0
+
+        processes = FakeProcesses(waitpid)
+        supervisor = WorkerSupervisor(count=2, restart_delay=1.0)
+
+        processes.run(supervisor)
+
+        self.assertEqual([pid for pid, started in processes.forks], [101, 102, 103])
+
+        # the worker that has exited is started again under the same id, after the delay
+        restarted, started = processes.forks[-1]
+        self.assertGreaterEqual(started, 1.0)
+        self.assertEqual(sorted(processes.killed), [(102, signal.SIGTERM), (restarted, signal.SIGTERM)])
+        self.assertEqual(supervisor.workers, {})
+        self.assertEqual(supervisor.restarts, {})
+
+    def test_restart_same_id(self):
+        ids = []
+
+        def waitpid(supervisor):
+            if not ids:
+                ids.append(supervisor.workers[101])
+                return 101, exited(1)
+
+            if len(ids) == 1 and 103 in supervisor.workers:
+                ids.append(supervisor.workers[103])
+                supervisor.__stop__(signal.SIGTERM, None)
+
+            if supervisor.workers:
+                return next(iter(supervisor.workers)), exited(0)
+
+            return 0, 0
+
+        processes = FakeProcesses(waitpid)
+        processes.run(WorkerSupervisor(count=2, restart_delay=0.5))
+
+        # so the maintenance keeps running on worker 0
+        self.assertEqual(ids, [0, 0])
+
+    def test_no_restart_when_stopping(self):
+        def waitpid(supervisor):
+            if not supervisor.stopping:
+                supervisor.__stop__(signal.SIGTERM, None)
+
+            if supervisor.workers:
+                # killed by SIGTERM on the way out
+                return next(iter(supervisor.workers)), signal.SIGTERM
+
+            return 0, 0
+
+        processes = FakeProcesses(waitpid)
+        supervisor = WorkerSupervisor(count=3)
+
+        processes.run(supervisor)
+
+        self.assertEqual(len(processes.forks), 3)
+        self.assertEqual(supervisor.restarts, {})
+
+    def test_kill(self):
+        def waitpid(supervisor):
+            if not supervisor.stopping:
+                supervisor.__stop__(signal.SIGTERM, None)
+
+            # nobody stops until killed
+            if supervisor.killed and supervisor.workers:
+                return next(iter(supervisor.workers)), signal.SIGKILL
+
+            return 0, 0
+
+        processes = FakeProcesses(waitpid)
+        supervisor = WorkerSupervisor(count=2, drain_timeout=5.0)
+
+        processes.run(supervisor)
+
+        killed = [pid for pid, sig in processes.killed if sig == signal.SIGKILL]
+
+        self.assertEqual(sorted(killed), [101, 102])
+        self.assertGreater(processes.now, 5.0 + WorkerSupervisor.SHUTDOWN_GRACE)
+
+    def test_worker_process(self):
+        target = mock.Mock(side_effect=[None, ValueError("failed")])
+        supervisor = WorkerSupervisor(count=1)
+
+        with mock.patch.object(workers.os, "fork", return_value=0), \
+                mock.patch.object(workers.os, "_exit", side_effect=WorkerExit) as exit_mock, \
+                mock.patch.object(workers.signal, "signal"), \
+                mock.patch.object(workers.random, "seed") as seed:
+
+            for worker_id in [0, 1]:
+                with self.assertRaises(WorkerExit):
+                    supervisor.__spawn__(worker_id, ["socket"], target)
+
+        self.assertEqual(target.call_args_list, [mock.call(0, ["socket"]), mock.call(1, ["socket"])])
+        self.assertEqual(exit_mock.call_args_list, [mock.call(0), mock.call(1)])
+        self.assertEqual(seed.call_count, 2)
+        self.assertEqual(supervisor.workers, {})
+
+
+@unittest.skipIf(PromoServer is None, "the server is not available")
+class TestMaintenanceWorker(unittest.TestCase):
+    def test_runs_maintenance(self):
+        server = mock.Mock(spec=PromoServer)
+
+        # a single process, or the first of the workers
+        for worker_id, expected in [(None, True), (0, True), (1, False), (7, False)]:
+            server.worker_id = worker_id
+            self.assertEqual(PromoServer.runs_maintenance(server), expected)
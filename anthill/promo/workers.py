@@ -0,0 +1,176 @@
+from anthill.common.server import ServerError
+
+import tornado.netutil
+
+import logging
+import random
+import signal
+import time
+import os
+
+
+def bind_sockets(listen):
+    """
+    Binds the sockets described by the `listen` option (port:N or unix:PATH), the same way Server.listen_server
+    does, so they can be shared by the worker processes.
+    """
+
+    listen_group = listen.split(":")
+
+    if len(listen_group) < 2:
+        raise ServerError("Failed to listen on " + listen + ": bad format")
+
+    kind, addresses = listen_group[0], listen_group[1:]
+    sockets = []
+
+    if kind == "port":
+        for port in addresses:
+            sockets.extend(tornado.netutil.bind_sockets(int(port), "127.0.0.1"))
+    elif kind == "unix":
+        for sock in addresses:
+            sockets.append(tornado.netutil.bind_unix_socket(sock, mode=0o777))
+    else:
+        raise ServerError("Failed to listen on " + listen + ": unsupported kind")
+
+    logging.info("Listening '{0}' on '{1}'".format(kind, addresses))
+    return sockets
+
+
+class WorkerSupervisor(object):
+    """
+    Runs the service in several worker processes that accept connections from the same sockets, so the requests
+    are spread over several cores.
+
+    Every worker is a separate process that creates its own application, with its own database pools and caches.
+    A worker that exits unexpectedly is started again after `restart_delay` seconds. On SIGTERM or SIGINT every
+    worker is asked to shut down (it stops accepting connections and finishes the requests in progress for up to
+    `drain_timeout` seconds), the ones still running SHUTDOWN_GRACE seconds after that are killed.
+
+    Usage:
+
+    WorkerSupervisor(count=8).run(bind_sockets(options.listen), lambda worker_id, sockets: ...)
+
+    """
+
+    POLL_INTERVAL = 0.1
+    # time a worker has to stop its models and exit once it is done waiting for the requests in progress
+    SHUTDOWN_GRACE = 10.0
+
+    def __init__(self, count, restart_delay=1.0, drain_timeout=30.0):
+        self.count = count
+        self.restart_delay = restart_delay
+        self.drain_timeout = drain_timeout
+
+        # pid => worker_id
+        self.workers = {}
+        # worker_id => when to start it again
+        self.restarts = {}
+
+        self.stopping = False
+        self.deadline = None
+        self.killed = False
+
+    def run(self, sockets, target):
+        signal.signal(signal.SIGTERM, self.__stop__)
+        signal.signal(signal.SIGINT, self.__stop__)
+
+        for worker_id in range(0, self.count):
+            self.__spawn__(worker_id, sockets, target)
+
+        while self.workers or (self.restarts and not self.stopping):
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                pid, status = 0, 0
+
+            if pid:
+                self.__exited__(pid, status)
+                continue
+
+            if self.stopping:
+                if not self.killed and time.monotonic() > self.deadline:
+                    self.__kill__()
+            else:
+                now = time.monotonic()
+
+                for worker_id, restart_at in list(self.restarts.items()):
+                    if now >= restart_at:
+                        del self.restarts[worker_id]
+                        self.__spawn__(worker_id, sockets, target)
+
+            time.sleep(WorkerSupervisor.POLL_INTERVAL)
+
+        logging.info("All workers stopped")
+
+    def __spawn__(self, worker_id, sockets, target):
+        pid = os.fork()
+
+        if pid:
+            self.workers[pid] = worker_id
+            logging.info("Started worker {0} (pid {1})".format(worker_id, pid))
+            return
+
+        # the worker process
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+
+        # otherwise every worker would generate the very same promo code keys
+        random.seed()
+
+        exit_code = 0
+
+        # noinspection PyBroadException
+        try:
+            target(worker_id, sockets)
+        except Exception:
+            logging.exception("Worker {0} failed".format(worker_id))
+            exit_code = 1
+
+        os._exit(exit_code)
+
+    def __exited__(self, pid, status):
+        worker_id = self.workers.pop(pid, None)
+
+        if worker_id is None:
+            return
+
+        if os.WIFSIGNALED(status):
+            reason = "killed by signal {0}".format(os.WTERMSIG(status))
+        else:
+            reason = "exit code {0}".format(os.WEXITSTATUS(status))
+
+        if self.stopping:
+            logging.info("Worker {0} (pid {1}) stopped: {2}".format(worker_id, pid, reason))
+            return
+
+        logging.error("Worker {0} (pid {1}) exited unexpectedly: {2}, restarting in {3} seconds".format(
+            worker_id, pid, reason, self.restart_delay))
+
+        self.restarts[worker_id] = time.monotonic() + self.restart_delay
+
+    # noinspection PyUnusedLocal
+    def __stop__(self, sig, frame):
+        if self.stopping:
+            return
+
+        logging.warning("Caught signal: {0}, stopping the workers".format(sig))
+
+        self.stopping = True
+        self.deadline = time.monotonic() + self.drain_timeout + WorkerSupervisor.SHUTDOWN_GRACE
+
+        for pid in list(self.workers.keys()):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def __kill__(self):
+        self.killed = True
+
+        for pid, worker_id in list(self.workers.items()):
+            logging.warning("Worker {0} (pid {1}) did not stop in time, killing".format(worker_id, pid))
+
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass